@@ -1,57 +1,99 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import signal
 import sys
 from pathlib import Path
 import logging
 import os
+from typing import Tuple
 
-logging.basicConfig(level=logging.DEBUG)
+from nodemonitor import NodemonitorConfiguration, GlobalState, Jenkins, InfluxWriter, tasks, NodeRegistry
+from nodemonitor.checkpoint import Checkpointer
+from nodemonitor.history import HistoryStore
+from nodemonitor.metrics import MetricsServer
+from nodemonitor.predictor import LoadPredictor
+from nodemonitor.reload import ConfigReloader
+from nodemonitor.trace import TraceRecorder
 
-from nodemonitor import NodemonitorConfiguration, GlobalState, Jenkins, InfluxWriter, tasks, SchedulerConfig
-
-logging.getLogger("asyncssh").setLevel(logging.WARNING)
-
-def initialize_state() -> GlobalState:
+def initialize_state() -> Tuple[GlobalState, ConfigReloader]:
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config-file", default="config.ini", dest="config_file",
                         help="Configuration file with all manager options")
+    parser.add_argument("-l", "--log-level", default="INFO", dest="log_level",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging verbosity")
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    logging.getLogger("asyncssh").setLevel(logging.WARNING)
+
     config = NodemonitorConfiguration.parse_configfile(args.config_file)
 
+    history = predictor = None
+    if config.history_file is not None:
+        history = HistoryStore(config.history_file)
+        predictor = LoadPredictor(history, lead_time=config.prewarm_lead_time,
+                                  prewarm_threshold=config.prewarm_threshold,
+                                  max_prewarm_nodes=config.max_prewarm_nodes)
+
+    # Every controller gets its own registry of the same physical nodes
+    nodes = [node_config.create_node() for node_config in config.nodes]
+    jenkins_instances = [
+        Jenkins(controller.url, controller.username, controller.token, registry=NodeRegistry(nodes),
+                connection_limit=controller.connection_limit, request_timeout=controller.request_timeout,
+                name=controller.name, stream_responses=controller.stream_responses)
+        for controller in config.controllers
+    ]
+
     global_state = GlobalState(
-        jenkins_instance=Jenkins(config.jenkins.url, config.jenkins.username, config.jenkins.token),
-        influx_writer=InfluxWriter(config.influx.hostname, config.influx.database, config.influx.username, config.influx.password),
+        jenkins_instance=jenkins_instances[0],
+        other_jenkins_instances=jenkins_instances[1:],
+        influx_writer=InfluxWriter(config.influx.hostname, config.influx.database, config.influx.username,
+                                   config.influx.password, batch_size=config.influx.batch_size,
+                                   flush_interval=config.influx.flush_interval,
+                                   max_buffered_points=config.influx.max_buffered_points),
         privileged_ssh_config=config.agent_ssh_config,
-        task_config=SchedulerConfig(config.idle_time_before_launch, config.idle_time_before_shutdown, config.node_priority),
+        task_config=config.scheduler_config(),
         poll_frequency=config.poll_frequency,
+        min_poll_frequency=config.min_poll_frequency,
+        max_poll_frequency=config.max_poll_frequency,
+        metrics_server=(MetricsServer(config.metrics_host, config.metrics_port)
+                        if config.metrics_port is not None else None),
+        history=history,
+        predictor=predictor,
+        checkpointer=Checkpointer(config.state_file) if config.state_file is not None else None,
+        recorder=TraceRecorder(config.trace_file) if config.trace_file is not None else None,
     )
 
-    return global_state
+    return global_state, ConfigReloader(args.config_file, config)
 
-async def main(global_state):
+async def main(global_state, reloader):
     await global_state.initialize()
+    # Edits to the config file are picked up within seconds; SIGHUP picks them up right away
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reloader.request, global_state)
     while True:
         all_tasks = [
             tasks.poll_running_jobs(global_state),
             tasks.node_manager(global_state),
+            reloader.watch(global_state),
         ]
 
         await asyncio.gather(*all_tasks)
 
         logging.info("Shutdown detected. Resetting tasks")
-        global_state.shutdown = False
+        global_state.reset()
 
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    global_state = initialize_state()
+    global_state, reloader = initialize_state()
     try:
-        loop.run_until_complete(main(global_state))
+        loop.run_until_complete(main(global_state, reloader))
     except Exception:
         logging.exception("Unexpected exception. Trying to restart")
+    finally:
+        loop.run_until_complete(global_state.close())
 
     logging.error("Exiting!")
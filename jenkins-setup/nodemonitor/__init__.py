@@ -3,6 +3,7 @@ from .influx import InfluxWriter
 from .nodes import SSHConfig
 from .globalstate import GlobalState, SchedulerConfig
 from .config import NodemonitorConfiguration
+from .registry import NodeRegistry
 
 __all__ = ["Jenkins", "InfluxWriter", "SSHConfig", "GlobalState", "SchedulerConfig",
-           "NodemonitorConfiguration"]
+           "NodemonitorConfiguration", "NodeRegistry"]
@@ -0,0 +1,163 @@
+""" Tracks how long queued jobs wait, per label, against a service level objective (SLO)
+
+Every poll's queue delta feeds three rolling windows per label (what a job waits for, or
+"any" if the wait reason could not be parsed):
+
+- wait: from inQueueSince until the job leaves the queue,
+- stuck: how long a job stayed stuck (Jenkins' "all nodes of label ... are offline"), and
+- wake_to_start: from the node monitor waking nodes for a job until the job leaves the queue.
+
+A job that is cancelled also leaves the queue, so it counts as started. The p50, p95 and p99 of
+each window are exported as gauges and written to influx. A label is at risk of missing its SLO
+when the p95 of its recent waits, or the age of its oldest queued job, exceeds risk_fraction of
+the SLO; the scheduler then plans wakeups for the fastest drain rather than its usual policy.
+"""
+import collections
+import logging
+from typing import TYPE_CHECKING, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import clock
+from .jenkins import Delta, QueuedJob
+from .metrics import REGISTRY
+
+if TYPE_CHECKING:
+    from .influx import InfluxWriter
+
+LOGGER = logging.getLogger(__name__)
+
+KINDS = ("wait", "stuck", "wake_to_start")
+QUANTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+
+QUEUE_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200)
+QUEUE_SECONDS = REGISTRY.histogram("nodemonitor_queue_seconds", "Time queued jobs spent waiting, stuck, or "
+                                   "waiting after their nodes were woken", ["kind", "label"], buckets=QUEUE_BUCKETS)
+QUEUE_QUANTILES = REGISTRY.gauge("nodemonitor_queue_seconds_quantile", "Quantiles of the queue times over the "
+                                 "rolling window", ["kind", "label", "quantile"])
+SLO_AT_RISK = REGISTRY.gauge("nodemonitor_queue_slo_at_risk", "Whether queued jobs of a label are at risk of "
+                             "missing the queue wait SLO", ["label"])
+
+
+def quantile(values: Sequence[float], q: float) -> float:
+    """ The nearest-rank q quantile of values """
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def queue_label(job: QueuedJob) -> str:
+    """ What job waits for: its label expression, the agents it can run on, or "any" """
+    if job.waiting_for is None:
+        return "any"
+    if "nodes" in job.waiting_for:
+        return ",".join(sorted(job.waiting_for["nodes"]))
+    return job.waiting_for["label"].strip()
+
+
+class RollingWindow:
+    """ The values observed over the last window seconds (at most max_samples of them) """
+
+    def __init__(self, window: float = 3600, max_samples: int = 1000):
+        self.window = window
+        self._samples: Deque[Tuple[float, float]] = collections.deque(maxlen=max_samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, value: float, when: float):
+        self._samples.append((when, value))
+
+    def values(self, now: float) -> List[float]:
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+        return [value for _, value in self._samples]
+
+    def quantiles(self, now: float) -> Dict[str, float]:
+        values = self.values(now)
+        if not values:
+            return dict()
+        return {name: quantile(values, q) for name, q in QUANTILES}
+
+
+class QueueAnalytics:
+
+    def __init__(self, window: float = 3600, max_samples: int = 1000, risk_fraction: float = 0.8):
+        self.window = window
+        self.max_samples = max_samples
+        # A label is at risk once its waits reach this fraction of the SLO
+        self.risk_fraction = risk_fraction
+        self.windows: Dict[Tuple[str, str], RollingWindow] = dict()
+        # The jobs are the QueueTracker's objects, which persist until they leave the queue
+        self._stuck_since: Dict[QueuedJob, float] = dict()
+        self._woken_at: Dict[QueuedJob, float] = dict()
+        # When the oldest queued job of each label was queued
+        self._oldest: Dict[str, float] = dict()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {len(self.windows)} windows over {self.window} seconds>"
+
+    def observe(self, kind: str, label: str, seconds: float, when: float):
+        key = (kind, label)
+        if key not in self.windows:
+            self.windows[key] = RollingWindow(self.window, self.max_samples)
+        self.windows[key].add(seconds, when)
+        QUEUE_SECONDS.observe(seconds, kind=kind, label=label)
+
+    def update(self, queue: Iterable[QueuedJob], delta: Delta, now: Optional[float] = None) -> List[Tuple[str, str]]:
+        """ Records what changed with the latest queue snapshot. Returns the (kind, label) windows that changed """
+        now = clock.now() if now is None else now
+        changed = dict()
+        for job in delta.added + delta.changed:
+            if job.stuck:
+                self._stuck_since.setdefault(job, now)
+            elif job in self._stuck_since:
+                self._observe(changed, "stuck", job, now - self._stuck_since.pop(job), now)
+        for job in delta.removed:
+            self._observe(changed, "wait", job, now - job.queued_since.timestamp(), now)
+            if job in self._stuck_since:
+                self._observe(changed, "stuck", job, now - self._stuck_since.pop(job), now)
+            if job in self._woken_at:
+                self._observe(changed, "wake_to_start", job, now - self._woken_at.pop(job), now)
+
+        self._oldest = dict()
+        for job in queue:
+            label = queue_label(job)
+            self._oldest[label] = min(self._oldest.get(label, now), job.queued_since.timestamp())
+        return list(changed)
+
+    def _observe(self, changed: dict, kind: str, job: QueuedJob, seconds: float, now: float):
+        label = queue_label(job)
+        self.observe(kind, label, max(seconds, 0), now)
+        changed[(kind, label)] = None
+
+    def record_wake(self, jobs: Iterable[QueuedJob], when: Optional[float] = None):
+        """ Starts the wake-to-start clock of jobs that nodes were just woken for (unless it already runs) """
+        when = clock.now() if when is None else when
+        for job in jobs:
+            self._woken_at.setdefault(job, when)
+
+    def quantiles(self, kind: str, label: str, now: Optional[float] = None) -> Dict[str, float]:
+        window = self.windows.get((kind, label))
+        if window is None:
+            return dict()
+        return window.quantiles(clock.now() if now is None else now)
+
+    def at_risk(self, label: str, slo: float, now: Optional[float] = None) -> bool:
+        """ Whether jobs waiting for label are close to waiting longer than slo seconds """
+        now = clock.now() if now is None else now
+        limit = self.risk_fraction * slo
+        oldest = self._oldest.get(label)
+        waited = now - oldest if oldest is not None else 0
+        at_risk = waited > limit or self.quantiles("wait", label, now).get("p95", 0) > limit
+        SLO_AT_RISK.set(int(at_risk), label=label)
+        return at_risk
+
+    def publish(self, keys: Iterable[Tuple[str, str]], influx_writer: Optional["InfluxWriter"] = None,
+                now: Optional[float] = None):
+        """ Refreshes the quantile gauges (and writes an influx point) for each (kind, label) window """
+        now = clock.now() if now is None else now
+        for kind, label in keys:
+            quantiles = self.quantiles(kind, label, now)
+            for name, value in quantiles.items():
+                QUEUE_QUANTILES.set(value, kind=kind, label=label, quantile=name)
+            if influx_writer is not None and quantiles:
+                influx_writer.add_point("queue_latency", dict(kind=kind, label=label),
+                                        dict(count=len(self.windows[(kind, label)]), **quantiles))
@@ -0,0 +1,4 @@
+""" Benchmarks of the scheduler against local stand-ins. Run with python -m nodemonitor.benchmark """
+from .fakes import FakeBMC, FakeFleet, FakeInflux, FakeJenkins, FakeNode
+
+__all__ = ["FakeBMC", "FakeFleet", "FakeInflux", "FakeJenkins", "FakeNode"]
@@ -0,0 +1,123 @@
+""" Benchmarks a scheduling cycle against local stand-ins for Jenkins, influx and the agents
+
+Example:
+
+    python -m nodemonitor.benchmark --agents 10 100 1000 --cycles 5 --http-latency 0.01
+
+For each fleet size, every cycle does what the scheduler does each poll: fetch the queue and
+the computers, probe every node, decide what to wake and what to shut down, and collect the
+telemetry of the powered-on nodes over SSH. The median time of each stage and the number
+of Jenkins requests per cycle are reported.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from .. import tasks
+from ..globalstate import GlobalState, SchedulerConfig
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import SSHConfig
+from ..probe import PROBER
+from .fakes import FakeFleet, FakeInflux, FakeJenkins
+
+STAGES = ["poll", "probe", "wake decision", "shutdown decision", "telemetry", "cycle"]
+
+
+async def benchmark_fleet(num_agents: int, args: argparse.Namespace) -> Dict[str, float]:
+    jenkins = FakeJenkins(latency=args.http_latency, failure_rate=args.failure_rate)
+    influx = FakeInflux(latency=args.http_latency)
+    fleet = FakeFleet(num_agents, jenkins, up_fraction=args.up_fraction, ssh_latency=args.ssh_latency,
+                      down_mode=args.down_mode)
+    await jenkins.start()
+    await influx.start()
+    await fleet.start()
+    for _ in range(int(num_agents * args.queue_per_agent)):
+        jenkins.enqueue(random.choice(["linux", "cuda"]))
+
+    ssh_config = SSHConfig("benchmark", "benchmark")
+    state = GlobalState(
+        jenkins_instance=Jenkins(jenkins.url, "benchmark", "token", registry=fleet.registry()),
+        influx_writer=InfluxWriter(influx.url, "benchmark", "benchmark", "benchmark"),
+        privileged_ssh_config=ssh_config,
+        task_config=SchedulerConfig(0, 0, [], probe_concurrency=args.probe_concurrency),
+        poll_frequency=30,
+    )
+    timings: Dict[str, List[float]] = defaultdict(list)
+    try:
+        await state.initialize()
+        for _ in range(args.cycles):
+            requests_before = jenkins.total_requests
+            cycle_start = start = time.perf_counter()
+            queue_delta, computer_delta = await state.poll_controllers()
+            state.publish_queue(state.queued_jobs(), queue_delta, computer_delta)
+            timings["poll"].append(time.perf_counter() - start)
+            timings["requests"].append(jenkins.total_requests - requests_before)
+
+            start = time.perf_counter()
+            # Every cycle probes afresh, rather than reusing the last cycle's results
+            PROBER.clear()
+            availability = await tasks._probe_fleet(state)
+            timings["probe"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            tasks._plan_wakeups(state, availability)
+            timings["wake decision"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for node, available in availability.items():
+                if available:
+                    tasks._is_idle(state, node)
+            timings["shutdown decision"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await tasks._collect_telemetry(state, availability)
+            timings["telemetry"].append(time.perf_counter() - start)
+            timings["cycle"].append(time.perf_counter() - cycle_start)
+    finally:
+        for node in state.registry:
+            node.ssh.close()
+        await state.close()
+        await fleet.stop()
+        await jenkins.stop()
+        await influx.stop()
+
+    return {stage: statistics.median(values) for stage, values in timings.items()}
+
+
+async def main(args: argparse.Namespace):
+    results = dict()
+    for num_agents in args.agents:
+        results[num_agents] = await benchmark_fleet(num_agents, args)
+        if not args.json:
+            row = results[num_agents]
+            print(f"{num_agents:>6} agents: " + "; ".join(f"{stage} {row[stage] * 1000:.1f} ms" for stage in STAGES) +
+                  f"; {row['requests']:.0f} Jenkins requests per cycle")
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Fleet sizes (number of Jenkins agents; two agents per node) to benchmark")
+    parser.add_argument("--cycles", type=int, default=5, help="Scheduling cycles to time for each fleet size")
+    parser.add_argument("--up-fraction", type=float, default=0.5, help="Fraction of the nodes that are powered on")
+    parser.add_argument("--queue-per-agent", type=float, default=0.5, help="Queued jobs per agent")
+    parser.add_argument("--http-latency", type=float, default=0, help="Seconds added to every Jenkins/influx response")
+    parser.add_argument("--ssh-latency", type=float, default=0, help="Seconds added to every SSH command")
+    parser.add_argument("--failure-rate", type=float, default=0, help="Fraction of Jenkins requests that fail")
+    parser.add_argument("--down-mode", choices=["blackhole", "refuse"], default="blackhole",
+                        help="Whether powered-off nodes time out (like real hardware) or refuse connections")
+    parser.add_argument("--probe-concurrency", type=int, default=32, help="Nodes whose telemetry is collected at the same time")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("asyncssh").setLevel(logging.ERROR)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,529 @@
+""" Local stand-ins for Jenkins, influx, the agents' SSH servers and their BMCs
+
+Everything listens on 127.0.0.1 (each fake node on its own port), and each fake can add a fixed
+latency to its responses and fail a fraction of them, so the scheduler code can be exercised
+without touching the real cluster.
+"""
+import asyncio
+import collections
+import hashlib
+import json
+import pathlib
+import random
+import re
+import socket
+import stat
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncssh
+from aiohttp import BasicAuth, web
+
+from ..fleet import MAINTENANCE_MESSAGE
+from ..nodes import Node
+from ..registry import NodeRegistry
+
+
+class _FakeHTTPServer:
+    """ Common plumbing: an aiohttp app on a random local port that counts its requests """
+
+    def __init__(self, latency: float = 0, failure_rate: float = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests: Dict[str, int] = collections.Counter()
+        self.app = web.Application(middlewares=[self._middleware])
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        self.requests[request.path] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise web.HTTPServiceUnavailable(text="Injected failure")
+        return await handler(request)
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class FakeJenkins(_FakeHTTPServer):
+    """ Serves computer/api/json, queue/api/json and job builds from in-memory agents and queue items
+
+    Label names are only included when the tree= parameter asks for them, and with etags=True
+    responses carry an ETag and honor If-None-Match, like Jenkins behind a caching proxy. Agents
+    can be toggled temporarily offline, and building manage-jenkins/agents-online puts them all
+    back online, except those taken offline for maintenance.
+    """
+
+    def __init__(self, latency: float = 0, failure_rate: float = 0, etags: bool = False):
+        super().__init__(latency, failure_rate)
+        self.etags = etags
+        self.bytes_sent = 0
+        # displayName -> dict(labels, numExecutors, busyExecutors, offline, temporarilyOffline, offlineCauseReason)
+        self.computers: Dict[str, Dict[str, Any]] = dict()
+        self.queue: List[Dict[str, Any]] = []
+        self.builds: List[str] = []
+        self._next_id = 1
+        self.app.router.add_get("/computer/api/json", self._computers)
+        self.app.router.add_get("/computer/{name}/api/json", self._computer)
+        self.app.router.add_post("/computer/{name}/toggleOffline", self._toggle_offline)
+        self.app.router.add_get("/queue/api/json", self._queue)
+        self.app.router.add_post("/{path:job/.+}/build", self._build)
+
+    def add_computer(self, name: str, labels: List[str], num_executors: int = 2, busy_executors: int = 0,
+                     offline: bool = False):
+        self.computers[name] = dict(labels=labels, numExecutors=num_executors, busyExecutors=busy_executors,
+                                    offline=offline, temporarilyOffline=False, offlineCauseReason="")
+
+    def enqueue(self, label: str, stuck: bool = False) -> int:
+        if stuck:
+            why = f"All nodes of label ‘{label}’ are offline"
+        else:
+            why = f"Waiting for next available executor on ‘{label}’"
+        job_id = self._next_id
+        self._next_id += 1
+        self.queue.append(dict(id=job_id, stuck=stuck, why=why, inQueueSince=int(time.time() * 1000)))
+        return job_id
+
+    def _json_response(self, request: web.Request, data: Any) -> web.Response:
+        body = json.dumps(data).encode("utf-8")
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.etags and request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=dict(ETag=etag))
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type="application/json", headers=dict(ETag=etag) if self.etags else None)
+
+    async def _computers(self, request: web.Request) -> web.Response:
+        with_names = "name" in request.query.get("tree", "name")
+        computers = [
+            dict(displayName=name, offline=computer["offline"] or computer["temporarilyOffline"],
+                 numExecutors=computer["numExecutors"],
+                 assignedLabels=[dict(name=label, busyExecutors=computer["busyExecutors"]) if with_names
+                                 else dict(busyExecutors=computer["busyExecutors"])
+                                 for label in [name] + computer["labels"]])
+            for name, computer in self.computers.items()
+        ]
+        return self._json_response(request, dict(computer=computers))
+
+    async def _computer(self, request: web.Request) -> web.Response:
+        computer = self.computers.get(request.match_info["name"])
+        if computer is None:
+            return web.Response(status=404, text="Not found")
+        return self._json_response(request, dict(idle=computer["busyExecutors"] == 0,
+                                                 temporarilyOffline=computer["temporarilyOffline"]))
+
+    async def _toggle_offline(self, request: web.Request) -> web.Response:
+        computer = self.computers.get(request.match_info["name"])
+        if computer is None:
+            return web.Response(status=404, text="Not found")
+        computer["temporarilyOffline"] = not computer["temporarilyOffline"]
+        offline_message = request.query.get("offlineMessage", "")
+        computer["offlineCauseReason"] = offline_message if computer["temporarilyOffline"] else ""
+        return web.Response(status=302, headers=dict(Location=f"/computer/{request.match_info['name']}/api/json"))
+
+    async def _queue(self, request: web.Request) -> web.Response:
+        return self._json_response(request, dict(items=self.queue))
+
+    async def _build(self, request: web.Request) -> web.Response:
+        self.builds.append(request.match_info["path"])
+        if request.match_info["path"] == "job/manage-jenkins/job/agents-online":
+            for computer in self.computers.values():
+                if computer["offlineCauseReason"] != MAINTENANCE_MESSAGE:
+                    computer["temporarilyOffline"] = False
+                    computer["offlineCauseReason"] = ""
+        return web.Response(status=201)
+
+
+class FakeInflux(_FakeHTTPServer):
+    """ Accepts /write requests and counts the points in them """
+
+    def __init__(self, latency: float = 0, failure_rate: float = 0):
+        super().__init__(latency, failure_rate)
+        self.points = 0
+        self.app.router.add_post("/write", self._write)
+
+    async def _write(self, request: web.Request) -> web.Response:
+        body = await request.text()
+        self.points += len([line for line in body.split("\n") if line])
+        return web.Response(status=204)
+
+
+class FakeBMC(_FakeHTTPServer):
+    """ A Redfish service that switches a FakeNode on and off
+
+    The node has power while it is up, while it boots (for boot_time seconds) and while it hangs.
+    With hang_on_boot, it powers on but its SSH server never comes up until it is power cycled;
+    with hang_on_shutdown, it ignores graceful shutdowns. The stand-in ipmitool and snmpget/snmpset
+    scripts (see write_ipmitool and write_snmp) make the same requests, so the IPMI and PDU
+    backends can be tested against it too. Any user name is accepted with the right password.
+    """
+
+    SYSTEM = "/redfish/v1/Systems/1"
+
+    def __init__(self, node: "FakeNode", password: str = "password", boot_time: float = 0.1,
+                 latency: float = 0, failure_rate: float = 0):
+        super().__init__(latency, failure_rate)
+        self.node = node
+        self.password = password
+        self.boot_time = boot_time
+        self.hang_on_boot = False
+        self.hang_on_shutdown = False
+        self.hung = False
+        # Every ResetType requested
+        self.resets: List[str] = []
+        self._boot: Optional[asyncio.Future] = None
+        self.app.router.add_get(self.SYSTEM, self._system)
+        self.app.router.add_post(f"{self.SYSTEM}/Actions/ComputerSystem.Reset", self._reset)
+
+    @property
+    def powered(self) -> bool:
+        return self.node.is_up or self.hung or (self._boot is not None and not self._boot.done())
+
+    def _authorized(self, request: web.Request) -> bool:
+        try:
+            auth = BasicAuth.decode(request.headers.get("Authorization", ""))
+        except ValueError:
+            return False
+        return auth.password == self.password
+
+    async def _system(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.Response(status=401, text="Unauthorized")
+        return web.json_response(dict(Id="1", PowerState="On" if self.powered else "Off"))
+
+    async def _reset(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.Response(status=401, text="Unauthorized")
+        reset_type = (await request.json()).get("ResetType")
+        self.resets.append(reset_type)
+        if reset_type == "On":
+            if not self.powered:
+                self._boot = asyncio.ensure_future(self._power_on())
+        elif reset_type == "GracefulShutdown":
+            if self.powered and not self.hang_on_shutdown:
+                await self._power_off()
+        elif reset_type == "ForceOff":
+            await self._power_off()
+        elif reset_type == "ForceRestart":
+            await self._power_off()
+            self.hang_on_boot = False
+            self._boot = asyncio.ensure_future(self._power_on())
+        else:
+            return web.Response(status=400, text=f"Unknown ResetType {reset_type}")
+        return web.Response(status=204)
+
+    async def _power_on(self):
+        await asyncio.sleep(self.boot_time)
+        if self.hang_on_boot:
+            self.hung = True
+        else:
+            await self.node.power_on()
+
+    async def _power_off(self):
+        if self._boot is not None:
+            self._boot.cancel()
+        self.hung = False
+        await self.node.power_off()
+
+    def _write_script(self, path: pathlib.Path, body: str) -> pathlib.Path:
+        path.write_text(f"#!{sys.executable}\nimport base64, json, os, sys, urllib.request\n"
+                        f"URL = {self.url + self.SYSTEM!r}\n\n"
+                        "def request(password, reset_type=None):\n"
+                        "    data = json.dumps(dict(ResetType=reset_type)).encode() if reset_type else None\n"
+                        "    url = URL + '/Actions/ComputerSystem.Reset' if reset_type else URL\n"
+                        "    auth = base64.b64encode(f'user:{password}'.encode()).decode()\n"
+                        "    req = urllib.request.Request(url, data=data, headers={'Authorization': f'Basic {auth}', "
+                        "'Content-Type': 'application/json'})\n"
+                        "    try:\n"
+                        "        with urllib.request.urlopen(req) as resp:\n"
+                        "            return json.loads(resp.read() or b'{}')\n"
+                        "    except urllib.error.HTTPError as err:\n"
+                        "        sys.exit(f'Error: {err}')\n\n" + body)
+        path.chmod(path.stat().st_mode | stat.S_IXUSR)
+        return path
+
+    def write_ipmitool(self, directory: pathlib.Path) -> pathlib.Path:
+        """ Writes a stand-in for "ipmitool -E ... chassis power on|off|soft|reset|status" """
+        return self._write_script(pathlib.Path(directory) / "ipmitool", (
+            "password, action = os.environ.get('IPMI_PASSWORD', ''), sys.argv[-1]\n"
+            "if action == 'status':\n"
+            "    print(f\"Chassis Power is {request(password)['PowerState'].lower()}\")\n"
+            "else:\n"
+            "    request(password, dict(on='On', off='ForceOff', soft='GracefulShutdown', "
+            "reset='ForceRestart')[action])\n"
+            "    print(f'Chassis Power Control: {action}')\n"
+        ))
+
+    def write_snmp(self, directory: pathlib.Path) -> Tuple[pathlib.Path, pathlib.Path]:
+        """ Writes stand-ins for snmpget and snmpset of an APC outlet (1 on, 2 off, 3 reboot) """
+        snmpget = self._write_script(pathlib.Path(directory) / "snmpget", (
+            "password = sys.argv[sys.argv.index('-c') + 1]\n"
+            "print(1 if request(password)['PowerState'] == 'On' else 2)\n"
+        ))
+        snmpset = self._write_script(pathlib.Path(directory) / "snmpset", (
+            "password = sys.argv[sys.argv.index('-c') + 1]\n"
+            "request(password, {'1': 'On', '2': 'ForceOff', '3': 'ForceRestart'}[sys.argv[-1]])\n"
+            "print(f'{sys.argv[-4]} = INTEGER: {sys.argv[-1]}')\n"
+        ))
+        return snmpget, snmpset
+
+
+class _FakeSSHServer(asyncssh.SSHServer):
+
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return True
+
+
+class _Exit(Exception):
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+class FakeNode:
+    """ An SSH server on a local port that answers the commands the node monitor runs
+
+    When the node is "down", the port either refuses connections (down_mode="refuse") or, like
+    a powered-off machine, never answers (down_mode="blackhole"), so connecting times out.
+
+    Commands run in a tiny shell that knows just enough for the node monitor and the fleet runner:
+    "users", "echo" (optionally into a file), "cat", "head", "test -e", "rm -f", "sleep", "exit",
+    "true", "false", "docker ps", "nvidia-smi", "sudo reboot" and "sudo shutdown now", joined with
+    ";", "&&" and "||". The files live in the files dict; those under /var/run (a tmpfs) are lost
+    on reboot. /proc/loadavg and /proc/stat come from load_average and cpu_ticks.
+    """
+
+    def __init__(self, name: str, port: int, host_key: asyncssh.SSHKey, ssh_latency: float = 0,
+                 down_mode: str = "blackhole"):
+        self.name = name
+        self.port = port
+        self.host_key = host_key
+        self.ssh_latency = ssh_latency
+        self.down_mode = down_mode
+        self.users = "jenkins"
+        self.commands: List[str] = []
+        self.files: Dict[str, str] = dict()
+        self.load_average = (0.0, 0.0, 0.0)
+        # user, nice, system, idle, iowait, irq, softirq, steal
+        self.cpu_ticks = [0, 0, 0, 0, 0, 0, 0, 0]
+        self.containers: List[str] = []
+        self.gpu_processes: List[str] = []
+        # How long a reboot keeps the node down
+        self.reboot_time = 0.5
+
+        self._server: Optional[asyncssh.SSHAcceptor] = None
+        self._blackhole: List[socket.socket] = []
+
+    @property
+    def is_up(self) -> bool:
+        return self._server is not None
+
+    async def power_on(self):
+        self._close_blackhole()
+        if self._server is None:
+            self._server = await asyncssh.create_server(
+                _FakeSSHServer, "127.0.0.1", self.port, server_host_keys=[self.host_key],
+                process_factory=self._handle, reuse_address=True,
+            )
+
+    async def power_off(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.down_mode == "blackhole" and not self._blackhole:
+            self._open_blackhole()
+
+    async def close(self):
+        """ Stops listening altogether """
+        await self.power_off()
+        self._close_blackhole()
+
+    async def _handle(self, process: asyncssh.SSHServerProcess):
+        command = process.command or ""
+        self.commands.append(command)
+        if self.ssh_latency:
+            await asyncio.sleep(self.ssh_latency)
+        power_actions: List[str] = []
+        status = 0
+        try:
+            for sequence in command.split(";"):
+                status = 0
+                for operator, simple_command in _split_conditionals(sequence):
+                    if (operator == "&&" and status != 0) or (operator == "||" and status == 0):
+                        continue
+                    status = await self._run(simple_command, process, power_actions)
+        except _Exit as exit_:
+            status = exit_.status
+        process.exit(status)
+        if "shutdown" in power_actions:
+            asyncio.ensure_future(self.power_off())
+        elif "reboot" in power_actions:
+            asyncio.ensure_future(self._reboot())
+
+    async def _run(self, command: str, process: asyncssh.SSHServerProcess, power_actions: List[str]) -> int:
+        """ Runs one simple command and returns its exit status """
+        command = command.replace("2>/dev/null", "").strip()
+        redirect = None
+        if ">" in command:
+            command, redirect = (part.strip() for part in command.split(">", 1))
+        words = command.split()
+        if words[:1] == ["sudo"]:
+            words = words[1:]
+        if not words:
+            return 0
+        name, args = words[0], words[1:]
+        output, status = "", 0
+        if name == "users":
+            output = f"{self.users}\n"
+        elif name == "echo":
+            output = " ".join(args) + "\n"
+        elif name in ("cat", "head"):
+            contents = self._read(args[-1]) if args else None
+            if contents is None:
+                status = 1
+            else:
+                output = contents if name == "cat" else contents.splitlines(keepends=True)[0]
+        elif name == "docker":
+            output = "".join(f"{container}\n" for container in self.containers)
+        elif name == "nvidia-smi":
+            output = "".join(f"{process}\n" for process in self.gpu_processes)
+        elif name == "test":
+            status = 0 if args and args[-1] in self.files else 1
+        elif name == "rm":
+            self.files.pop(args[-1], None)
+        elif name == "sleep":
+            await asyncio.sleep(float(args[0]))
+        elif name == "exit":
+            raise _Exit(int(args[0]) if args else 0)
+        elif name in ("shutdown", "reboot"):
+            power_actions.append(name)
+        elif name == "false":
+            status = 1
+        elif name != "true":
+            output, status = f"{name}: command not found\n", 127
+        if redirect is not None:
+            self.files[redirect] = output
+        elif output:
+            (process.stdout if status == 0 else process.stderr).write(output)
+        return status
+
+    def _read(self, path: str) -> Optional[str]:
+        if path == "/proc/loadavg":
+            return " ".join(f"{load:.2f}" for load in self.load_average) + " 1/100 1000\n"
+        if path == "/proc/stat":
+            return "cpu  " + " ".join(str(ticks) for ticks in self.cpu_ticks) + " 0 0\ncpu0 0 0 0 0 0 0 0 0 0 0\n"
+        return self.files.get(path)
+
+    async def _reboot(self):
+        await self.power_off()
+        for path in [path for path in self.files if path.startswith("/var/run/")]:
+            del self.files[path]
+        await asyncio.sleep(self.reboot_time)
+        await self.power_on()
+
+    def _open_blackhole(self):
+        # A listening socket that is never accepted from, with its (tiny) backlog already full, makes
+        # new connection attempts hang exactly like they do for a machine that is switched off
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", self.port))
+        listener.listen(0)
+        self._blackhole.append(listener)
+        for _ in range(3):
+            filler = socket.socket()
+            filler.setblocking(False)
+            try:
+                filler.connect(("127.0.0.1", self.port))
+            except BlockingIOError:
+                pass
+            self._blackhole.append(filler)
+
+    def _close_blackhole(self):
+        for sock in self._blackhole:
+            sock.close()
+        self._blackhole.clear()
+
+
+# Fake nodes listen below the usual ephemeral port range (32768+), so the client sockets the
+# benchmark opens can never grab a port that a powered-off node will need again later
+_next_port = 20000
+
+
+def _split_conditionals(sequence: str) -> List[Tuple[Optional[str], str]]:
+    """ Splits "a && b || c" into [(None, "a"), ("&&", "b"), ("||", "c")] """
+    parts = re.split(r"(&&|\|\|)", sequence)
+    return [(None, parts[0])] + [(parts[i], parts[i + 1]) for i in range(1, len(parts), 2)]
+
+
+def _free_port() -> int:
+    global _next_port
+    while True:
+        port, _next_port = _next_port, _next_port + 1
+        with socket.socket() as sock:
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return port
+
+
+class FakeFleet:
+    """ A fleet of fake nodes, each backing a "<name>" and a "<name>-cuda" agent in a FakeJenkins """
+
+    def __init__(self, num_agents: int, jenkins: FakeJenkins, up_fraction: float = 0.5, ssh_latency: float = 0,
+                 down_mode: str = "blackhole", executors: int = 2):
+        self.jenkins = jenkins
+        self.up_fraction = up_fraction
+        host_key = asyncssh.generate_private_key("ssh-ed25519")
+        self.nodes = [
+            FakeNode(f"node{i:04d}", _free_port(), host_key, ssh_latency=ssh_latency, down_mode=down_mode)
+            for i in range((num_agents + 1) // 2)
+        ]
+        for node in self.nodes:
+            jenkins.add_computer(node.name, ["linux"], num_executors=executors)
+            jenkins.add_computer(f"{node.name}-cuda", ["cuda"], num_executors=1)
+
+    async def start(self):
+        num_up = int(round(len(self.nodes) * self.up_fraction))
+        for index, node in enumerate(self.nodes):
+            if index < num_up:
+                await node.power_on()
+            else:
+                await node.power_off()
+
+    async def stop(self):
+        for node in self.nodes:
+            await node.close()
+
+    def registry(self) -> NodeRegistry:
+        """ A registry whose nodes point at the fake SSH servers """
+        return NodeRegistry(
+            Node(node.name, "127.0.0.1", "00:00:00:00:00:00", aliases=[f"{node.name}-cuda"], port=node.port)
+            for node in self.nodes
+        )
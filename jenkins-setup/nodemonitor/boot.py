@@ -0,0 +1,98 @@
+""" Staggered power-on of nodes
+
+Switching a rack of machines on at once draws a burst of inrush current that can trip a
+breaker, so the BootScheduler limits how many nodes are booting at the same time and leaves
+a minimum gap between consecutive power-ons. Nodes are powered on in the order they are
+given (the planner returns them in node_priority order), and each boot resolves as soon as
+its node is reachable, so the first executor comes online without waiting for the rest.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from .history import HistoryStore
+from .metrics import REGISTRY
+from .nodes import Node
+from .wol import WakeOnLan
+
+LOGGER = logging.getLogger(__name__)
+
+BOOTS_IN_PROGRESS = REGISTRY.gauge("nodemonitor_boots_in_progress", "Nodes powered on that are not available yet")
+
+
+class BootScheduler:
+
+    def __init__(self, sender: Optional[WakeOnLan] = None, max_concurrent_boots: int = 2, stagger: float = 10,
+                 boot_timeout: float = 120, history: Optional[HistoryStore] = None):
+        self.sender = sender or WakeOnLan()
+        self.history = history
+        self.max_concurrent_boots = max_concurrent_boots
+        self.stagger = stagger
+        self.boot_timeout = boot_timeout
+        self._booting: Optional[asyncio.Semaphore] = None
+        self._power_on_lock: Optional[asyncio.Lock] = None
+        self._last_power_on: Optional[float] = None
+        self._in_progress = 0
+        # Boots not finished yet, so a node asked for again (say, planned while it pre-warms) is powered on once
+        self._boots: Dict[Node, asyncio.Future] = dict()
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}; {self.max_concurrent_boots} at a time; {self.stagger} s apart; "
+                f"{self._in_progress} booting>")
+
+    def _ensure_primitives(self):
+        # Created on first use so they belong to the running event loop
+        if self._booting is None:
+            self._booting = asyncio.Semaphore(self.max_concurrent_boots)
+            self._power_on_lock = asyncio.Lock()
+
+    async def boot(self, node: Node) -> bool:
+        """ Powers node on when a boot slot frees up and the stagger has elapsed. Returns whether it came up """
+        self._ensure_primitives()
+        async with self._booting:
+            async with self._power_on_lock:
+                loop = asyncio.get_event_loop()
+                if self._last_power_on is not None:
+                    wait = self._last_power_on + self.stagger - loop.time()
+                    if wait > 0:
+                        LOGGER.debug(f"Waiting {wait:.1f} seconds before powering on {node.name}")
+                        await asyncio.sleep(wait)
+                self._last_power_on = loop.time()
+            self._in_progress += 1
+            BOOTS_IN_PROGRESS.set(self._in_progress)
+            try:
+                available = await node.wakeup(self.sender, self.boot_timeout)
+                # Not when the node was already awake: time_woken is then from its last real boot
+                if available and self.history is not None and node.last_boot_seconds is not None:
+                    self.history.record_boot(node.name, node.last_boot_seconds)
+                return available
+            except OSError as err:
+                LOGGER.error(f"Could not wake up {node.name}: {err}")
+                return False
+            finally:
+                self._in_progress -= 1
+                BOOTS_IN_PROGRESS.set(self._in_progress)
+
+    def boot_all(self, nodes: List[Node]) -> List[asyncio.Future]:
+        """ Schedules a boot of every node, in order. Each future resolves as soon as its node is up """
+        # Semaphores and locks wake their waiters first-in first-out, so nodes power on in list order
+        for node in nodes:
+            if node not in self._boots:
+                self._boots[node] = asyncio.ensure_future(self.boot(node))
+                self._boots[node].add_done_callback(lambda _, node=node: self._boots.pop(node, None))
+        return [self._boots[node] for node in nodes]
+
+    def is_booting(self, node: Node) -> bool:
+        """ Whether a boot of node was scheduled and has not finished yet """
+        return node in self._boots
+
+    def reconfigure(self, max_concurrent_boots: int, stagger: float, boot_timeout: float):
+        """ Applies new limits (e.g., from a reloaded config). Boots already waiting keep the old concurrency """
+        if max_concurrent_boots != self.max_concurrent_boots and self._booting is not None:
+            self._booting = asyncio.Semaphore(max_concurrent_boots)
+        self.max_concurrent_boots = max_concurrent_boots
+        self.stagger = stagger
+        self.boot_timeout = boot_timeout
+
+    def close(self):
+        self.sender.close()
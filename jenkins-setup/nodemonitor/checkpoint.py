@@ -0,0 +1,164 @@
+""" Checkpoints of the scheduler state, so a restart picks up where the last process left off
+
+The checkpoint is a small JSON document with each controller's agents (labels, executors and
+when each last finished a job) and last queue, and the nodes' wake and shutdown times. It is
+written to a temporary file that then replaces the checkpoint, so a crash mid-write never
+leaves a torn file behind, and it is only written when its contents changed. The agents' busy
+executors and job finish times change on nearly every poll while builds run, so changes to
+those alone are written at most every min_interval seconds.
+
+Restoring the agents before the first fetch from Jenkins also means their labels are not
+downloaded again, and restoring the queue means the first poll only reports what actually
+changed while the process was down.
+"""
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, Union
+
+from .jenkins import Jenkins
+from .nodes import AgentStatus, JenkinsAgent
+
+if TYPE_CHECKING:
+    from .globalstate import GlobalState
+
+LOGGER = logging.getLogger(__name__)
+
+# Checkpoints of any other version are ignored, and the node monitor starts cold
+CHECKPOINT_VERSION = 2
+
+
+def write_atomic(path: pathlib.Path, data: bytes):
+    """ Replaces path with data such that readers see either the old or the new contents """
+    temporary = path.with_name(f".{path.name}.tmp")
+    with temporary.open("wb") as checkpoint_file:
+        checkpoint_file.write(data)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary, path)
+
+
+def _snapshot_controller(jenkins: Jenkins) -> Dict[str, Any]:
+    return dict(
+        agents={
+            agent.name: dict(labels=agent.labels, status=agent.status.value, num_executors=agent.num_executors,
+                             busy_executors=agent.busy_executors,
+                             time_last_job_finished=agent.time_last_job_finished)
+            for agent in jenkins.nodes.values()
+        },
+        queue=[
+            dict(id=job.id, stuck=job.stuck, why=job.reason, inQueueSince=int(job.queued_since.timestamp() * 1000))
+            for job in jenkins.queue.jobs.values()
+        ],
+    )
+
+
+def snapshot(state: "GlobalState") -> Dict[str, Any]:
+    return dict(
+        version=CHECKPOINT_VERSION,
+        controllers={jenkins.name: _snapshot_controller(jenkins) for jenkins in state.jenkins_instances},
+        nodes={node.name: dict(time_woken=node.time_woken, time_shutdown=node.time_shutdown)
+               for node in state.registry},
+    )
+
+
+def _without_timers(checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+    """ The checkpoint without the fields that change on every poll while builds run """
+    return dict(checkpoint, controllers={
+        name: dict(controller, agents={
+            agent_name: {key: value for key, value in agent.items()
+                         if key not in ("busy_executors", "time_last_job_finished")}
+            for agent_name, agent in controller["agents"].items()
+        })
+        for name, controller in checkpoint["controllers"].items()
+    })
+
+
+def restore(state: "GlobalState", checkpoint: Dict[str, Any]):
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {checkpoint.get('version')}")
+    # Parse everything before changing anything, so a bad checkpoint leaves the state untouched
+    restored = []
+    for jenkins in state.jenkins_instances:
+        controller = checkpoint["controllers"].get(jenkins.name)
+        if controller is None:
+            continue
+        agents = [JenkinsAgent(name, agent["labels"], AgentStatus(agent["status"]), agent["num_executors"],
+                               agent["busy_executors"], time_last_job_finished=agent["time_last_job_finished"])
+                  for name, agent in controller["agents"].items() if name not in jenkins.nodes]
+        queue = [dict(id=item["id"], stuck=item["stuck"], why=item["why"], inQueueSince=item["inQueueSince"])
+                 for item in controller["queue"]]
+        restored.append((jenkins, agents, queue))
+    node_times = [(state.registry.node(name), times["time_woken"], times["time_shutdown"])
+                  for name, times in checkpoint["nodes"].items()]
+
+    for jenkins, agents, queue in restored:
+        for agent in agents:
+            jenkins.add_agent(agent)
+        jenkins.queue.update(queue)
+    for node, time_woken, time_shutdown in node_times:
+        if node is not None:
+            node.time_woken, node.time_shutdown = time_woken, time_shutdown
+
+
+class Checkpointer:
+    """ Saves the state to, and restores it from, a checkpoint file """
+
+    def __init__(self, path: Union[str, pathlib.Path], min_interval: float = 300):
+        self.path = pathlib.Path(path)
+        # Seconds between checkpoints that only differ in the agents' busy executors and job finish times
+        self.min_interval = min_interval
+        self._last_saved: Optional[bytes] = None
+        # (monotonic time, the checkpoint without those fields) of the last write
+        self._last_write: Optional[Tuple[float, bytes]] = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {self.path}>"
+
+    def save(self, state: "GlobalState", force: bool = False) -> bool:
+        """ Writes a checkpoint if anything changed since the last one. Returns whether it wrote one
+
+        Unless forced, one that only differs in the agents' busy executors and job finish times is
+        only written min_interval seconds after the last one.
+        """
+        checkpoint = snapshot(state)
+        data = json.dumps(checkpoint, sort_keys=True).encode("utf-8")
+        if data == self._last_saved:
+            return False
+        structure = json.dumps(_without_timers(checkpoint), sort_keys=True).encode("utf-8")
+        now = time.monotonic()
+        if (not force and self._last_write is not None and structure == self._last_write[1]
+                and now - self._last_write[0] < self.min_interval):
+            return False
+        try:
+            write_atomic(self.path, data)
+        except OSError as err:
+            LOGGER.warning(f"Could not write the checkpoint {self.path}: {err}")
+            return False
+        self._last_saved = data
+        self._last_write = (now, structure)
+        return True
+
+    def load(self, state: "GlobalState") -> bool:
+        """ Restores the last checkpoint, if there is a usable one """
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            LOGGER.warning(f"Could not read the checkpoint {self.path}: {err}")
+            return False
+        try:
+            restore(state, json.loads(data))
+        except (ValueError, KeyError, TypeError) as err:
+            LOGGER.warning(f"Ignoring the unusable checkpoint {self.path}: {err}")
+            return False
+        self._last_saved = data
+        age = time.time() - os.path.getmtime(self.path)
+        num_agents = sum(len(jenkins.nodes) for jenkins in state.jenkins_instances)
+        num_jobs = sum(len(jenkins.queue) for jenkins in state.jenkins_instances)
+        LOGGER.info(f"Restored {num_agents} agents and {num_jobs} queued jobs from a checkpoint taken "
+                    f"{age:.0f} seconds ago")
+        return True
@@ -0,0 +1,67 @@
+""" The time the scheduler goes by
+
+Everything that schedules work reads the wall-clock time through now(), so the simulator can run
+the real scheduling code on a virtual clock. A VirtualTimeLoop's time jumps straight to the next
+timer whenever nothing is ready to run, so asyncio.sleep and timeouts take no real time on it.
+That only holds while nothing waits for real I/O, which is why the simulator keeps Jenkins and
+the nodes in-process.
+"""
+import asyncio
+import selectors
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+_source: Callable[[], float] = time.time
+
+
+def now() -> float:
+    """ Seconds since the epoch, on the clock in use """
+    return _source()
+
+
+@contextmanager
+def using(source: Callable[[], float]) -> Iterator[None]:
+    """ Makes now() read source for the duration of the with statement """
+    global _source
+    previous, _source = _source, source
+    try:
+        yield
+    finally:
+        _source = previous
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """ Never blocks: when no file descriptor is ready, the loop's clock skips ahead by the timeout """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.loop.advance(timeout)
+        elif not events and timeout is None:
+            raise RuntimeError("Nothing is scheduled on the virtual clock, so it would wait forever")
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """ An event loop whose clock starts at start (seconds since the epoch) and only moves between timers """
+
+    def __init__(self, start: float = 0):
+        selector = _VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.start = start
+        self._elapsed = 0.0
+
+    def time(self) -> float:
+        return self._elapsed
+
+    def now(self) -> float:
+        return self.start + self._elapsed
+
+    def advance(self, seconds: float):
+        self._elapsed += seconds
@@ -1,24 +1,83 @@
 """ Reads a configuration file. Example is shown below
 
+Secrets are encrypted with python -m nodemonitor.encryption -p <password> -t <secret>... (secrets
+encrypted together share a key, which is derived only once). The running node monitor reloads the
+file when it changes; see reload.py for what needs a restart.
+
 [JENKINS]
 url = https://jenkins.jasonswails.com
 username = myuser
 token = encrypted-secret-token
+connection_limit = 4    # optional; pooled keep-alive connections to Jenkins
+request_timeout = 30    # optional; seconds
+stream_responses = no   # optional; decode the queue item by item as it arrives (for very large queues)
+
+[JENKINS staging]       # optional; more controllers whose agents run on the same nodes
+url = https://staging.jenkins.jasonswails.com
+username = myuser
+token = encrypted-secret-token
 
 [AGENTS]
 username = username
 password = encrypted-password-or-ssh-key-passcode
 private_key = encrypted-contents-of-ssh-key-file
+keepalive_interval = 30         # optional; seconds between SSH keepalives
+connection_idle_timeout = 600   # optional; close cached SSH connections idle this long
 
 [INFLUX]
 username = username
 password = encrypted-password
 hostname = 192.168.1.55
 database = name-of-db
+batch_size = 500            # optional; points per write request
+flush_interval = 10         # optional; seconds between writes
+max_buffered_points = 10000 # optional; oldest points are dropped beyond this
+
+[NODE Supergirl]                # one section per physical machine
+ip = 192.168.1.143
+mac = 2C:F0:5D:27:5E:AA
+aliases = Supergirl-cuda        # optional; other agents running on this machine
+capacity = 4                    # optional; most jobs the machine runs at once across agents
+port = 22                       # optional; SSH port
+broadcast = 192.168.1.255       # optional; where wake-on-lan packets are sent (default: the /24 broadcast)
+power = 350                     # optional; watts the machine draws while on (default 200)
+boot_time = 90                  # optional; seconds it takes to boot, until the history has learned it (default 60)
+power_backend = wol             # optional; wol (default), ipmi, redfish or pdu
+bmc = 192.168.2.143             # ipmi and redfish; the BMC's address (or the Redfish service's URL)
+bmc_username = admin
+bmc_password = encrypted-password
+bmc_verify_ssl = yes            # optional; no for a BMC with a self-signed certificate
+pdu = 192.168.2.10              # pdu; the switched PDU's address, and the outlet the machine is plugged into
+pdu_outlet = 4
+pdu_community = encrypted-snmp-write-community
+
+[METRICS]                       # optional; serves http://host:port/metrics
+host = 0.0.0.0
+port = 9100
 
 [SCHEDULER]
 idle_time_before_launch = 300   # seconds
 idle_time_before_shutdown = 300 # seconds
+poll_frequency = 30             # seconds between polls of Jenkins
+min_poll_frequency = 5          # optional; seconds between polls while jobs are queued
+max_poll_frequency = 120        # optional; polling backs off up to this while idle
+probe_concurrency = 32          # optional; nodes whose telemetry is collected at the same time
+max_concurrent_boots = 2        # optional; nodes powering on at the same time
+boot_stagger = 10               # optional; minimum seconds between power-ons
+boot_timeout = 120              # optional; seconds to wait for a woken node to come up
+state_file = state.json         # optional; checkpoint of the scheduler state for warm restarts
+history_file = history.jsonl    # optional; learn boot times and load to pre-warm nodes and pick shutdown times
+trace_file = trace.jsonl.gz     # optional; record the queue, agents and power events to replay in the simulator
+prewarm_lead_time = 1800        # optional; seconds ahead to look for expected jobs
+prewarm_threshold = 1           # optional; expected jobs that warrant pre-warming a node
+max_prewarm_nodes = 2           # optional; most nodes pre-warmed at once
+busy_load_average = 1.0         # optional; an idle node with a higher 1-minute load is not shut down
+busy_cpu_utilization = 0.25     # optional; nor one whose CPUs were busier than this since the last check
+ignored_containers = node-exporter*  # optional; docker containers that do not keep a node up
+drain_before_shutdown = yes     # optional; take the agents offline in Jenkins (and recheck them) before shutting down
+wake_policy = priority          # optional; priority (node_priority order), power (fewest watts) or drain (fastest boots)
+queue_wait_slo = 900            # optional; seconds most (95%) jobs should wait in the queue; wake faster when at risk
+queue_wait_slos = cuda=600      # optional; the same per label
 node_priority = Supergirl,
                 Wonder Woman,
                 Green Lantern,
@@ -33,16 +92,40 @@ from __future__ import annotations
 import configparser
 import pathlib
 import os
-from dataclasses import dataclass
-from typing import List, Optional, Callable
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Callable
 
 from asyncssh import SSHKey, import_private_key
 
-from .encryption import decrypt
-from .nodes import SSHConfig
+from .encryption import SecretStore
+from .globalstate import SchedulerConfig
+from .nodes import Node, SSHConfig
+from .planner import WAKE_POLICIES
+from .power import PowerBackend, WakeOnLanPower, create_power_backend
+from .telemetry import BusyPolicy
 
 
 PASSWORD = os.environ.get("NODEMONITOR_ENCRYPTION_PASSWORD", None)
+# Secrets already decrypted, by password, so reloading the config decrypts only what changed
+_SECRET_STORES: Dict[str, SecretStore] = dict()
+
+
+def _secret_store() -> SecretStore:
+    if PASSWORD is None:
+        raise ValueError("Must set a decryption password environment variable NODEMONITOR_ENCRYPTION_PASSWORD")
+    if PASSWORD not in _SECRET_STORES:
+        _SECRET_STORES.clear()
+        _SECRET_STORES[PASSWORD] = SecretStore(PASSWORD)
+    return _SECRET_STORES[PASSWORD]
+
+
+def decrypt(string: str) -> str:
+    return _secret_store().decrypt(string)
+
+
+# The encrypted keys of each section
+SECRETS = dict(JENKINS=("token",), AGENTS=("password", "private_key"), INFLUX=("password",),
+               NODE=("bmc_password", "pdu_community"))
 
 
 @dataclass
@@ -50,15 +133,22 @@ class JenkinsConfig:
     url: str
     username: str
     token: str
+    connection_limit: int = 4
+    request_timeout: float = 30
+    name: str = "jenkins"
+    stream_responses: bool = False
 
     def __repr__(self):
-        return f"<JenkinsConfig; url={self.url}; username={self.username}; token={self.token}>"
+        return (f"<JenkinsConfig {self.name}; url={self.url}; username={self.username}; token={self.token}; "
+                f"connection_limit={self.connection_limit}; request_timeout={self.request_timeout}; "
+                f"stream_responses={self.stream_responses}>")
 
     @classmethod
-    def create(cls, url: str, username: str, token: str) -> JenkinsConfig:
-        if PASSWORD is None:
-            raise ValueError("Must set a decryption password environment variable NODEMONITOR_ENCRYPTION_PASSWORD")
-        return JenkinsConfig(url=url, username=username, token=decrypt(token, PASSWORD))
+    def create(cls, url: str, username: str, token: str, connection_limit: str = "4",
+               request_timeout: str = "30", name: str = "jenkins", stream_responses: str = "no") -> JenkinsConfig:
+        return JenkinsConfig(url=url, username=username, token=decrypt(token),
+                             connection_limit=int(connection_limit), request_timeout=float(request_timeout),
+                             name=name, stream_responses=stream_responses.lower() in ("yes", "true", "on", "1"))
 
 
 @dataclass
@@ -67,16 +157,60 @@ class InfluxConfig:
     username: str
     password: str
     database: str
+    batch_size: int = 500
+    flush_interval: float = 10
+    max_buffered_points: int = 10000
 
     def __repr__(self):
         return (f"<InfluxConfig; hostname={self.hostname}; username={self.username}; "
-                f"password={self.password}; database={self.database}>")
+                f"password={self.password}; database={self.database}; batch_size={self.batch_size}; "
+                f"flush_interval={self.flush_interval}; max_buffered_points={self.max_buffered_points}>")
 
     @classmethod
-    def create(cls, hostname: str, username: str, password: str, database: str) -> InfluxConfig:
-        if PASSWORD is None:
-            raise ValueError("Must set a decryption password environment variable NODEMONITOR_ENCRYPTION_PASSWORD")
-        return InfluxConfig(hostname=hostname, username=username, password=decrypt(password, PASSWORD), database=database)
+    def create(cls, hostname: str, username: str, password: str, database: str, batch_size: str = "500",
+               flush_interval: str = "10", max_buffered_points: str = "10000") -> InfluxConfig:
+        return InfluxConfig(hostname=hostname, username=username, password=decrypt(password),
+                            database=database, batch_size=int(batch_size), flush_interval=float(flush_interval),
+                            max_buffered_points=int(max_buffered_points))
+
+
+@dataclass
+class NodeConfig:
+    name: str
+    ip: str
+    mac: str
+    aliases: List[str]
+    capacity: Optional[int] = None
+    port: int = 22
+    broadcast: Optional[str] = None
+    power: Optional[float] = None
+    boot_time: Optional[float] = None
+    power_backend: PowerBackend = field(default_factory=WakeOnLanPower)
+
+    @classmethod
+    def create(cls, name: str, ip: str, mac: str, aliases: str = "", capacity: Optional[str] = None,
+               port: str = "22", broadcast: Optional[str] = None, power: Optional[str] = None,
+               boot_time: Optional[str] = None, power_backend: str = "wol", bmc: Optional[str] = None,
+               bmc_username: Optional[str] = None, bmc_password: Optional[str] = None, bmc_verify_ssl: str = "yes",
+               pdu: Optional[str] = None, pdu_outlet: Optional[str] = None,
+               pdu_community: Optional[str] = None) -> NodeConfig:
+        backend = create_power_backend(
+            power_backend.strip().lower(), bmc=bmc, bmc_username=bmc_username,
+            bmc_password=decrypt(bmc_password) if bmc_password else None,
+            bmc_verify_ssl=bmc_verify_ssl.lower() in ("yes", "true", "on", "1"), pdu=pdu,
+            pdu_outlet=int(pdu_outlet) if pdu_outlet else None,
+            pdu_community=decrypt(pdu_community) if pdu_community else None,
+        )
+        return NodeConfig(name=name, ip=ip, mac=mac,
+                          aliases=[alias.strip() for alias in aliases.split(",") if alias.strip()],
+                          capacity=int(capacity) if capacity else None, port=int(port), broadcast=broadcast,
+                          power=float(power) if power else None, boot_time=float(boot_time) if boot_time else None,
+                          power_backend=backend)
+
+    def create_node(self) -> Node:
+        return Node(self.name, self.ip, self.mac, aliases=self.aliases, capacity=self.capacity, port=self.port,
+                    broadcast=self.broadcast, power=self.power, boot_time=self.boot_time,
+                    power_backend=self.power_backend)
 
 
 @dataclass
@@ -86,35 +220,111 @@ class NodemonitorConfiguration:
     poll_frequency: int
     node_priority: List[str]
 
-    jenkins: JenkinsConfig
+    # The [JENKINS] section first, then any [JENKINS <name>] sections
+    controllers: List[JenkinsConfig]
     agent_ssh_config: SSHConfig
     influx: Optional[InfluxConfig] = None
+    nodes: List[NodeConfig] = field(default_factory=list)
+    metrics_host: str = "0.0.0.0"
+    metrics_port: Optional[int] = None
+    probe_concurrency: int = 32
+    max_concurrent_boots: int = 2
+    boot_stagger: float = 10
+    boot_timeout: float = 120
+    state_file: Optional[pathlib.Path] = None
+    history_file: Optional[pathlib.Path] = None
+    trace_file: Optional[pathlib.Path] = None
+    prewarm_lead_time: float = 1800
+    prewarm_threshold: float = 1
+    max_prewarm_nodes: int = 2
+    min_poll_frequency: int = 5
+    max_poll_frequency: Optional[int] = None
+    busy_policy: BusyPolicy = field(default_factory=BusyPolicy)
+    drain_before_shutdown: bool = True
+    wake_policy: str = "priority"
+    queue_wait_slo: Optional[float] = None
+    queue_wait_slos: Dict[str, float] = field(default_factory=dict)
 
     @classmethod
     def parse_configfile(cls, filename: pathlib.Path) -> NodemonitorConfiguration:
         parser = configparser.ConfigParser()
         parser.read(filename)
-        jenkins_config = JenkinsConfig.create(**parser["JENKINS"])
+        # Decrypt every secret in one go (each distinct key is derived once), so a wrong password
+        # fails before anything is built
+        _secret_store().decrypt_all(
+            parser[section][key] for section in parser.sections()
+            for key in SECRETS.get(section.split(" ")[0], ()) if key in parser[section]
+        )
+        controllers = [JenkinsConfig.create(**parser["JENKINS"])]
+        controllers.extend(JenkinsConfig.create(name=section[len("JENKINS "):].strip(), **parser[section])
+                           for section in parser.sections() if section.startswith("JENKINS "))
+        if len({controller.name for controller in controllers}) != len(controllers):
+            raise ValueError("Every Jenkins controller must have a unique name")
         influx_config = InfluxConfig.create(**parser["INFLUX"]) if "INFLUX" in parser else None
         ssh_config_kwargs = dict(**parser["AGENTS"])
         if "private_key" in ssh_config_kwargs:
-            ssh_config_kwargs["private_key"] = decrypt(ssh_config_kwargs["private_key"], PASSWORD)
+            ssh_config_kwargs["private_key"] = decrypt(ssh_config_kwargs["private_key"])
         if "password" in ssh_config_kwargs:
-            ssh_config_kwargs["password"] = decrypt(ssh_config_kwargs["password"], PASSWORD)
+            ssh_config_kwargs["password"] = decrypt(ssh_config_kwargs["password"])
         else:
             ssh_config_kwargs["password"] = None
         ssh_config = SSHConfig.create(**ssh_config_kwargs)
+        nodes = [NodeConfig.create(section[len("NODE "):].strip(), **parser[section])
+                 for section in parser.sections() if section.startswith("NODE ")]
         kwargs = dict(
             idle_time_before_launch=int(parser["SCHEDULER"].get("idle_time_before_launch", 300)),
             idle_time_before_shutdown=int(parser["SCHEDULER"].get("idle_time_before_shutdown", 300)),
             poll_frequency=int(parser["SCHEDULER"].get("poll_frequency", 30)),
+            probe_concurrency=int(parser["SCHEDULER"].get("probe_concurrency", 32)),
+            max_concurrent_boots=int(parser["SCHEDULER"].get("max_concurrent_boots", 2)),
+            boot_stagger=float(parser["SCHEDULER"].get("boot_stagger", 10)),
+            boot_timeout=float(parser["SCHEDULER"].get("boot_timeout", 120)),
+            state_file=(pathlib.Path(parser["SCHEDULER"]["state_file"])
+                        if "state_file" in parser["SCHEDULER"] else None),
+            history_file=(pathlib.Path(parser["SCHEDULER"]["history_file"])
+                          if "history_file" in parser["SCHEDULER"] else None),
+            trace_file=(pathlib.Path(parser["SCHEDULER"]["trace_file"])
+                        if "trace_file" in parser["SCHEDULER"] else None),
+            prewarm_lead_time=float(parser["SCHEDULER"].get("prewarm_lead_time", 1800)),
+            prewarm_threshold=float(parser["SCHEDULER"].get("prewarm_threshold", 1)),
+            max_prewarm_nodes=int(parser["SCHEDULER"].get("max_prewarm_nodes", 2)),
+            min_poll_frequency=int(parser["SCHEDULER"].get("min_poll_frequency", 5)),
+            max_poll_frequency=(int(parser["SCHEDULER"]["max_poll_frequency"])
+                                if "max_poll_frequency" in parser["SCHEDULER"] else None),
             node_priority=[x.strip() for x in parser["SCHEDULER"].get("node_priority", "").split(",")],
+            busy_policy=BusyPolicy(
+                max_load_average=float(parser["SCHEDULER"].get("busy_load_average", 1.0)),
+                max_cpu_utilization=float(parser["SCHEDULER"].get("busy_cpu_utilization", 0.25)),
+                ignored_containers=tuple(x.strip() for x in parser["SCHEDULER"].get("ignored_containers", "").split(",")
+                                         if x.strip()),
+            ),
+            drain_before_shutdown=parser["SCHEDULER"].get("drain_before_shutdown", "yes").lower() in
+            ("yes", "true", "on", "1"),
+            wake_policy=parser["SCHEDULER"].get("wake_policy", "priority").strip().lower(),
+            queue_wait_slo=(float(parser["SCHEDULER"]["queue_wait_slo"])
+                            if "queue_wait_slo" in parser["SCHEDULER"] else None),
+            queue_wait_slos={label.strip(): float(seconds) for label, seconds in
+                             (x.rsplit("=", 1) for x in parser["SCHEDULER"].get("queue_wait_slos", "").split(",")
+                              if x.strip())},
             agent_ssh_config=ssh_config,
             influx=influx_config,
-            jenkins=jenkins_config,
+            nodes=nodes,
+            metrics_host=parser["METRICS"].get("host", "0.0.0.0") if "METRICS" in parser else "0.0.0.0",
+            metrics_port=int(parser["METRICS"].get("port", 9100)) if "METRICS" in parser else None,
+            controllers=controllers,
         )
+        if kwargs["wake_policy"] not in WAKE_POLICIES:
+            raise ValueError(f"wake_policy must be one of {', '.join(WAKE_POLICIES)}, not {kwargs['wake_policy']!r}")
         return cls(**kwargs)
 
+    def scheduler_config(self) -> SchedulerConfig:
+        return SchedulerConfig(self.idle_time_before_launch, self.idle_time_before_shutdown, self.node_priority,
+                               self.probe_concurrency, max_concurrent_boots=self.max_concurrent_boots,
+                               boot_stagger=self.boot_stagger, boot_timeout=self.boot_timeout,
+                               busy_policy=self.busy_policy, drain_before_shutdown=self.drain_before_shutdown,
+                               wake_policy=self.wake_policy, queue_wait_slo=self.queue_wait_slo,
+                               queue_wait_slos=self.queue_wait_slos)
+
 
 if __name__ == "__main__":
     import argparse
@@ -137,6 +347,11 @@ if __name__ == "__main__":
         print(f"config.agent_ssh_config.{attr} = {getattr(config.agent_ssh_config, attr)}")
 
     print()
-    print(repr(config.jenkins))
+    for node in config.nodes:
+        print(repr(node))
+
+    print()
+    for controller in config.controllers:
+        print(repr(controller))
     print()
     print(repr(config.influx))
@@ -1,42 +1,112 @@
+""" Encrypts and decrypts the secrets in the config file with a password
+
+Secrets are encrypted with AES-GCM under a key derived from the password with PBKDF2-HMAC-SHA256.
+The ciphertext starts with "v2:" and carries its salt and iteration count, so the work factor can
+be raised for new secrets while old ones still decrypt. Unprefixed ciphertexts are the original
+format (AES-CBC under the SHA-256 of the password) and still decrypt as well.
+
+Deriving a key is deliberately slow, so derived keys are cached per (password, salt, iterations).
+Secrets encrypted together share a salt, and decrypting all of them derives their key only once.
+"""
 from builtins import bytes
 import base64
+import functools
+import hashlib
+import struct
+from typing import Dict, Iterable, List, Optional
+
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
 from Crypto import Random
 
-__all__ = ["encrypt", "decrypt"]
+__all__ = ["encrypt", "decrypt", "decrypt_all", "SecretStore"]
 
-def encrypt(string: str, password: str) -> str:
+V2_PREFIX = "v2:"
+DEFAULT_ITERATIONS = 200000
+SALT_SIZE = 16
+NONCE_SIZE = 12
+TAG_SIZE = 16
+_V2_HEADER = struct.Struct(f">{SALT_SIZE}sI{NONCE_SIZE}s{TAG_SIZE}s")
+
+def encrypt(string: str, password: str, iterations: int = DEFAULT_ITERATIONS, salt: Optional[bytes] = None) -> str:
     """
-    It returns an encrypted string which can be decrypted just by the 
-    password.
+    It returns an encrypted string which can be decrypted just by the
+    password. Pass the same salt to encrypt several secrets under one key.
     """
-    key = password_to_key(password.encode("utf-8"))
-    IV = make_initialization_vector()
-    encryptor = AES.new(key, AES.MODE_CBC, IV)
-
-    # store the IV at the beginning and encrypt
-    return encode(IV + encryptor.encrypt(pad_string(string.encode("utf-8"))))
+    salt = salt if salt is not None else make_salt()
+    key = derive_key(password, salt, iterations)
+    nonce = Random.new().read(NONCE_SIZE)
+    encryptor = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = encryptor.encrypt_and_digest(string.encode("utf-8"))
+    return V2_PREFIX + encode(_V2_HEADER.pack(salt, iterations, nonce, tag) + ciphertext)
 
 def decrypt(string: str, password: str) -> str:
+    # Values in the config file may be quoted
+    string = string.strip().strip('"')
+    if string.startswith(V2_PREFIX):
+        data = decode(string[len(V2_PREFIX):])
+        salt, iterations, nonce, tag = _V2_HEADER.unpack_from(data)
+        decryptor = AES.new(derive_key(password, salt, iterations), AES.MODE_GCM, nonce=nonce)
+        # Raises ValueError if the password is wrong or the ciphertext was tampered with
+        return decryptor.decrypt_and_verify(data[_V2_HEADER.size:], tag).decode("utf-8")
+    return _decrypt_v1(string, password)
+
+def decrypt_all(strings: Iterable[str], password: str) -> List[str]:
+    """ Decrypts many secrets, deriving each distinct key only once """
+    return SecretStore(password).decrypt_all(strings)
+
+def _decrypt_v1(string: str, password: str) -> str:
     key = password_to_key(password.encode("utf-8"))
 
     string = decode(string)
 
     # extract the IV from the beginning
-    IV = string[:AES.block_size]  
+    IV = string[:AES.block_size]
     decryptor = AES.new(key, AES.MODE_CBC, IV)
 
     string = decryptor.decrypt(string[AES.block_size:])
     return unpad_string(string).decode("utf-8")
 
+@functools.lru_cache(maxsize=64)
+def derive_key(password: str, salt: bytes, iterations: int) -> bytes:
+    """
+    Stretch the password into a 256 bit AES key with PBKDF2, which takes
+    (tunably) long enough to make guessing the password expensive.
+    """
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=32)
+
+@functools.lru_cache(maxsize=8)
 def password_to_key(password):
     """
     Use SHA-256 over our password to get a proper-sized AES key.
-    This hashes our password into a 256 bit string. 
+    This hashes our password into a 256 bit string. Only used for the
+    original (unversioned) ciphertexts.
     """
     return SHA256.new(password).digest()
 
+def make_salt():
+    return Random.new().read(SALT_SIZE)
+
+
+class SecretStore:
+    """ Decrypts secrets with one password, remembering the plaintexts
+
+    Reloading a config file whose secrets did not change then decrypts nothing at all
+    """
+
+    def __init__(self, password: str):
+        self._password = password
+        self._plaintexts: Dict[str, str] = dict()
+
+    def decrypt(self, string: str) -> str:
+        plaintext = self._plaintexts.get(string)
+        if plaintext is None:
+            plaintext = self._plaintexts[string] = decrypt(string, self._password)
+        return plaintext
+
+    def decrypt_all(self, strings: Iterable[str]) -> List[str]:
+        return [self.decrypt(string) for string in strings]
+
 def make_initialization_vector():
     """
     An initialization vector (IV) is a fixed-size input to a cryptographic
@@ -83,22 +153,29 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-p", "--password", dest="password", required=True,
                         help="Password to convert to an encryption key")
-    parser.add_argument("-t", "--text", dest="text", required=True,
-                        help="The text to encrypt (or decrypt) with the password")
+    parser.add_argument("-t", "--text", dest="texts", required=True, nargs="+",
+                        help="The text(s) to encrypt (or decrypt) with the password. Texts encrypted "
+                             "together share a key, which is then derived only once when decrypting them")
     parser.add_argument("-f", "--file", dest="is_file", default=False, action="store_true",
                         help="If true, text is a file name")
     parser.add_argument("-d", "--decrypt", action="store_true", dest="decrypt",
                         default=False, help="Use this flag to decrypt instead of encrypt")
+    parser.add_argument("-i", "--iterations", dest="iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="PBKDF2 iterations for the key (more is slower to guess, and to decrypt)")
 
     args = parser.parse_args()
 
-    if args.is_file:
-        with open(args.text, "r") as f:
-            text = f.read()
-    else:
-        text = args.text
+    texts = []
+    for text in args.texts:
+        if args.is_file:
+            with open(text, "r") as f:
+                text = f.read()
+        texts.append(text)
 
     if args.decrypt:
-        print(decrypt(text, args.password))
+        for plaintext in decrypt_all(texts, args.password):
+            print(plaintext)
     else:
-        print(encrypt(text, args.password))
+        salt = make_salt()
+        for text in texts:
+            print(encrypt(text, args.password, iterations=args.iterations, salt=salt))
@@ -0,0 +1,362 @@
+""" Runs commands across the fleet of nodes over SSH
+
+Commands run on many nodes at once (at most concurrency at a time), each with its own timeout,
+and every node's result is yielded as soon as it finishes. For maintenance (e.g., updating and
+rebooting the nodes, which ubuntu-nodes/update-and-reboot.yml does), the runner can coordinate
+with the node monitor:
+
+* it marks each node as under maintenance first, so the monitor does not shut it down mid-way,
+* it waits until no agent on the node is running a job, then marks the agents temporarily
+  offline on every controller (so Jenkins assigns them no new build) and puts them back online
+  when it is done, and
+* it reboots the node afterwards if it needs one (/var/run/reboot-required exists) and waits
+  for it to come back.
+
+From the command line (the node monitor's config file provides the nodes and credentials):
+
+    python -m nodemonitor.fleet --label linux --when-idle --reboot-if-needed -- \\
+        "sudo apt-get update && sudo apt-get -y dist-upgrade"
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterable, List, Optional, Sequence, Tuple
+
+import asyncssh
+
+from .jenkins import Jenkins
+from .nodes import JenkinsAgent, Node, SSHConfig
+from .telemetry import MAINTENANCE_MARKER, MAINTENANCE_TOKEN
+
+LOGGER = logging.getLogger(__name__)
+
+REBOOT_REQUIRED_COMMAND = "test -e /var/run/reboot-required"
+REBOOT_COMMAND = "sudo reboot"
+# The agents-online job (put-compute-agents-online.groovy), which the node monitor builds whenever it
+# boots a node, leaves agents that are offline for this reason alone
+MAINTENANCE_MESSAGE = "Under maintenance by nodemonitor.fleet"
+
+
+@dataclass
+class CommandResult:
+    """ The outcome of running a command on one node """
+    node: str
+    exit_status: Optional[int] = None
+    stdout: str = ""
+    stderr: str = ""
+    # Why the command could not run (or finish) at all
+    error: Optional[str] = None
+    seconds: float = 0
+    rebooted: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.exit_status == 0
+
+    def __str__(self):
+        if self.error is not None:
+            outcome = f"error: {self.error}"
+        else:
+            outcome = f"exit status {self.exit_status}"
+        return f"{self.node}: {outcome} after {self.seconds:.1f} seconds{' (rebooted)' if self.rebooted else ''}"
+
+
+@dataclass
+class FleetSummary:
+    """ The results from every node """
+    results: List[CommandResult] = field(default_factory=list)
+
+    @property
+    def succeeded(self) -> List[CommandResult]:
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self) -> List[CommandResult]:
+        return [result for result in self.results if not result.ok]
+
+    def __str__(self):
+        summary = f"{len(self.succeeded)} of {len(self.results)} nodes succeeded"
+        if self.failed:
+            summary += "; failed: " + ", ".join(sorted(result.node for result in self.failed))
+        return summary
+
+
+def select_nodes(nodes: Iterable[Node], names: Sequence[str] = (), labels: Sequence[str] = (),
+                 controllers: Iterable[Jenkins] = ()) -> List[Node]:
+    """ The nodes named (by node or agent name), or running an agent with one of labels, on any controller
+
+    Every node is selected if neither names nor labels are given.
+    """
+    nodes = list(nodes)
+    if not names and not labels:
+        return nodes
+    selected = {node for node in nodes if set(node.agent_names) & set(names)}
+    for jenkins in controllers:
+        for label in labels:
+            selected.update(agent.node for agent in jenkins.registry.agents_with_label(label)
+                            if agent.node is not None)
+    return [node for node in nodes if node in selected]
+
+
+class FleetRunner:
+    """ Runs a command on many nodes concurrently
+
+    concurrency bounds how many nodes are worked on at once (including waiting for them to go idle,
+    so it is also how many nodes are taken out of service at a time), and timeout bounds the command
+    on each node. With when_idle, the runner marks each node as under maintenance for at most
+    maintenance_ttl seconds, waits (up to idle_timeout seconds, polling the controllers every
+    idle_poll seconds) until none of the node's agents is running a job, and keeps the agents
+    temporarily offline while the command runs.
+    """
+
+    def __init__(self, ssh_config: SSHConfig, concurrency: int = 8, timeout: float = 600,
+                 controllers: Sequence[Jenkins] = (), when_idle: bool = False, idle_timeout: float = 3600,
+                 idle_poll: float = 30, maintenance_ttl: float = 7200, reboot_if_needed: bool = False,
+                 reboot_timeout: float = 300):
+        if when_idle and not controllers:
+            raise ValueError("Waiting for nodes to go idle needs the Jenkins controllers to ask")
+        self.ssh_config = ssh_config
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.controllers = list(controllers)
+        self.when_idle = when_idle
+        self.idle_timeout = idle_timeout
+        self.idle_poll = idle_poll
+        self.maintenance_ttl = maintenance_ttl
+        self.reboot_if_needed = reboot_if_needed
+        self.reboot_timeout = reboot_timeout
+
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._last_refresh = None
+
+    async def run(self, nodes: Iterable[Node], command: str) -> AsyncIterator[CommandResult]:
+        """ Yields each node's result as soon as it is done """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_on(node: Node) -> CommandResult:
+            async with semaphore:
+                return await self.run_on(node, command)
+
+        pending = [asyncio.ensure_future(run_on(node)) for node in dict.fromkeys(nodes)]
+        try:
+            for next_result in asyncio.as_completed(pending):
+                yield await next_result
+        finally:
+            # The caller stopped early (or was cancelled)
+            for task in pending:
+                task.cancel()
+
+    async def run_all(self, nodes: Iterable[Node], command: str) -> FleetSummary:
+        summary = FleetSummary()
+        async for result in self.run(nodes, command):
+            summary.results.append(result)
+        return summary
+
+    async def run_on(self, node: Node, command: str) -> CommandResult:
+        """ Runs the command on a single node (marking it, waiting for it to go idle and rebooting it as asked) """
+        start = time.perf_counter()
+        result = CommandResult(node.name)
+        try:
+            if not await node.is_available():
+                result.error = "not available"
+                return result
+            if self.when_idle:
+                await asyncio.wait_for(self._mark(node), self.timeout)
+            drained: List[Tuple[Jenkins, JenkinsAgent]] = []
+            try:
+                if self.when_idle:
+                    deadline = time.monotonic() + self.idle_timeout
+                    if not await self._wait_until_idle(node, deadline):
+                        result.error = f"still busy after {self.idle_timeout} seconds"
+                        return result
+                    if not await self._drain(node, drained):
+                        result.error = "could not take every agent offline"
+                        return result
+                    if not await self._wait_until_drained(node, deadline):
+                        result.error = f"still busy after {self.idle_timeout} seconds"
+                        return result
+                LOGGER.info(f"Running '{command}' on {node.name}")
+                completed = await asyncio.wait_for(node.run_ssh_command(self.ssh_config, command), self.timeout)
+                result.exit_status = completed.exit_status
+                result.stdout, result.stderr = completed.stdout or "", completed.stderr or ""
+                if result.ok and self.reboot_if_needed:
+                    result.rebooted = await self._reboot_if_needed(node)
+            finally:
+                if drained:
+                    await self._undrain(node, drained)
+                if self.when_idle:
+                    await self._unmark(node)
+        except asyncio.TimeoutError:
+            result.error = f"timed out after {self.timeout} seconds"
+        except (asyncssh.Error, OSError) as err:
+            result.error = str(err) or err.__class__.__name__
+        finally:
+            result.seconds = time.perf_counter() - start
+        return result
+
+    async def _mark(self, node: Node):
+        expires = time.time() + self.maintenance_ttl
+        await node.run_ssh_command(self.ssh_config, f"echo {MAINTENANCE_TOKEN} {expires:.0f} > {MAINTENANCE_MARKER}")
+
+    async def _unmark(self, node: Node):
+        try:
+            await asyncio.wait_for(node.run_ssh_command(self.ssh_config, f"rm -f {MAINTENANCE_MARKER}"),
+                                   self.timeout)
+        except (asyncio.TimeoutError, asyncssh.Error, OSError) as err:
+            LOGGER.warning(f"Could not clear the maintenance marker on {node.name} (it expires by itself): {err}")
+
+    async def _refresh_controllers(self):
+        """ Fetches the agents from every controller, at most once every idle_poll seconds for all nodes """
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            if self._last_refresh is not None and time.monotonic() - self._last_refresh < self.idle_poll:
+                return
+            await asyncio.gather(*[jenkins.fetch_computers() for jenkins in self.controllers])
+            self._last_refresh = time.monotonic()
+
+    def _busy_agents(self, node: Node) -> List[str]:
+        return [f"{jenkins.name}/{agent.name}" for jenkins in self.controllers
+                for agent in jenkins.registry.agents_on(node) if agent.busy_executors]
+
+    async def _wait_until_idle(self, node: Node, deadline: float) -> bool:
+        while True:
+            await self._refresh_controllers()
+            busy = self._busy_agents(node)
+            if not busy:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            LOGGER.info(f"Waiting for {', '.join(busy)} on {node.name} to finish their jobs")
+            await asyncio.sleep(min(self.idle_poll, max(deadline - time.monotonic(), 0)))
+
+    def _online_agents(self, node: Node) -> List[Tuple[Jenkins, JenkinsAgent]]:
+        return [(jenkins, agent) for jenkins in self.controllers
+                for agent in jenkins.registry.agents_on(node) if agent.is_online()]
+
+    async def _drain(self, node: Node, drained: List[Tuple[Jenkins, JenkinsAgent]]) -> bool:
+        """ Takes the node's agents offline, adding those it toggled to drained. Returns whether it could """
+        agents = self._online_agents(node)
+        toggled = await asyncio.gather(*[jenkins.set_temporarily_offline(agent.name, True, MAINTENANCE_MESSAGE)
+                                         for jenkins, agent in agents])
+        drained.extend(agent for agent, changed in zip(agents, toggled) if changed)
+        if None in toggled:
+            LOGGER.warning(f"Could not take every agent on {node.name} offline")
+            return False
+        return True
+
+    async def _wait_until_drained(self, node: Node, deadline: float) -> bool:
+        """ Waits until the offline agents finish any build Jenkins assigned them since the last poll """
+        agents = self._online_agents(node)
+        while True:
+            agent_states = await asyncio.gather(*[jenkins.agent_state(agent.name) for jenkins, agent in agents])
+            busy = [agent.name for (_, agent), agent_state in zip(agents, agent_states)
+                    if agent_state is None or not agent_state["idle"]]
+            if not busy:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            LOGGER.info(f"{', '.join(busy)} on {node.name} took a build (or could not be checked). Waiting")
+            await asyncio.sleep(min(self.idle_poll, max(deadline - time.monotonic(), 0)))
+
+    async def _undrain(self, node: Node, drained: List[Tuple[Jenkins, JenkinsAgent]]):
+        LOGGER.info(f"Putting the agents on {node.name} back online")
+        toggled = await asyncio.gather(*[jenkins.set_temporarily_offline(agent.name, False)
+                                         for jenkins, agent in drained])
+        if None in toggled:
+            LOGGER.warning(f"Could not put every agent on {node.name} back online")
+
+    async def _reboot_if_needed(self, node: Node) -> bool:
+        """ Reboots the node if it needs to be, and waits for it to come back. Returns whether it rebooted """
+        check = await node.run_ssh_command(self.ssh_config, REBOOT_REQUIRED_COMMAND)
+        if check.exit_status != 0:
+            return False
+        LOGGER.info(f"{node.name} needs a reboot. Rebooting")
+        try:
+            await node.run_ssh_command(self.ssh_config, REBOOT_COMMAND, retry=False)
+        except asyncssh.misc.ConnectionLost:
+            LOGGER.info(f"Connection lost while rebooting {node.name}")
+        finally:
+            node.ssh.close()
+        # Give it time to go down before waiting for it to come back up
+        deadline = time.monotonic() + self.reboot_timeout
+        while await node.is_available(max_age=0):
+            if time.monotonic() >= deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(1)
+        if not await node.wait_until_available(max(deadline - time.monotonic(), 0)):
+            raise asyncio.TimeoutError()
+        LOGGER.info(f"{node.name} is back up after its reboot")
+        return True
+
+
+async def _main(args) -> int:
+    from .config import NodemonitorConfiguration
+    from .registry import NodeRegistry
+
+    config = NodemonitorConfiguration.parse_configfile(args.config_file)
+    # Every controller gets its own registry of the same physical nodes, like in the node monitor
+    nodes = [node_config.create_node() for node_config in config.nodes]
+    controllers = []
+    if args.labels or args.when_idle:
+        controllers = [
+            Jenkins(controller.url, controller.username, controller.token, registry=NodeRegistry(nodes),
+                    connection_limit=controller.connection_limit, request_timeout=controller.request_timeout,
+                    name=controller.name)
+            for controller in config.controllers
+        ]
+    try:
+        await asyncio.gather(*[jenkins.fetch_computers() for jenkins in controllers])
+        selected = select_nodes(nodes, args.nodes, args.labels, controllers)
+        if not selected:
+            print("No nodes matched")
+            return 1
+        runner = FleetRunner(config.agent_ssh_config, concurrency=args.concurrency, timeout=args.timeout,
+                             controllers=controllers, when_idle=args.when_idle, idle_timeout=args.idle_timeout,
+                             reboot_if_needed=args.reboot_if_needed)
+        summary = FleetSummary()
+        async for result in runner.run(selected, " ".join(args.command)):
+            summary.results.append(result)
+            print(result)
+            for stream in (result.stdout, result.stderr):
+                for line in stream.splitlines():
+                    print(f"    {line}")
+        print(summary)
+        return 0 if not summary.failed else 2
+    finally:
+        for jenkins in controllers:
+            await jenkins.close()
+        for node in nodes:
+            node.ssh.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import pathlib
+    import sys
+
+    parser = argparse.ArgumentParser(description="Runs a command on every (or some) node(s) concurrently")
+    parser.add_argument("-c", "--config-file", dest="config_file", default="config.ini", type=pathlib.Path,
+                        help="The node monitor's config file")
+    parser.add_argument("-n", "--node", dest="nodes", action="append", default=[],
+                        help="Run on this node (or the node of this agent). May be repeated")
+    parser.add_argument("--label", dest="labels", action="append", default=[],
+                        help="Run on nodes with an agent carrying this label. May be repeated")
+    parser.add_argument("-j", "--concurrency", type=int, default=8, help="Nodes worked on at the same time")
+    parser.add_argument("-t", "--timeout", type=float, default=600, help="Seconds the command may take on each node")
+    parser.add_argument("--when-idle", dest="when_idle", action="store_true",
+                        help="Keep the node monitor from shutting the nodes down, and wait until no jobs run on "
+                             "them before running the command")
+    parser.add_argument("--idle-timeout", dest="idle_timeout", type=float, default=3600,
+                        help="Seconds to wait for a node to go idle before giving up on it")
+    parser.add_argument("--reboot-if-needed", dest="reboot_if_needed", action="store_true",
+                        help="Reboot the nodes that need it after the command, and wait for them to come back")
+    parser.add_argument("-l", "--log-level", default="WARNING", dest="log_level",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging verbosity")
+    parser.add_argument("command", nargs="+", help="The command to run")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    logging.getLogger("asyncssh").setLevel(logging.WARNING)
+    sys.exit(asyncio.run(_main(args)))
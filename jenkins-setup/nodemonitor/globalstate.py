@@ -1,11 +1,27 @@
 """ A global state of the running process """
+import asyncio
 import enum
+import logging
 from dataclasses import dataclass, field
-from typing import List, Dict, Union
+from typing import Awaitable, List, Dict, Optional, Set, Tuple, Union
 
+from . import clock
+from .analytics import QueueAnalytics
+from .boot import BootScheduler
+from .checkpoint import Checkpointer
+from .history import HistoryStore
 from .influx import InfluxWriter
-from .jenkins import Jenkins, QueuedJob
+from .jenkins import Delta, Jenkins, QueuedJob
+from .metrics import MetricsServer
 from .nodes import Node, JenkinsAgent, SSHConfig
+from .planner import node_boot_time
+from .predictor import LoadPredictor
+from .registry import NodeRegistry
+from .telemetry import BusyPolicy
+from .trace import TraceRecorder
+
+LOGGER = logging.getLogger(__name__)
+
 
 class NodeStatus(str, enum.Enum):
     Busy = 'Busy'
@@ -16,7 +32,26 @@ class NodeStatus(str, enum.Enum):
 class SchedulerConfig:
     idle_time_before_launch: float
     idle_time_before_shutdown: float
-    node_priority: List[Node]
+    node_priority: List[str]
+    probe_concurrency: int = 32
+    # At most max_concurrent_boots nodes power on at once, at least boot_stagger seconds apart
+    max_concurrent_boots: int = 2
+    boot_stagger: float = 10
+    boot_timeout: float = 120
+    # What, besides its agents, keeps an idle node from being shut down
+    busy_policy: BusyPolicy = field(default_factory=BusyPolicy)
+    # Mark a node's agents temporarily offline (and check they are still idle) before shutting it down
+    drain_before_shutdown: bool = True
+    # Which powered-off nodes cover the queue: "priority" (node_priority order), "power" (fewest
+    # watts) or "drain" (every job started soonest). See planner
+    wake_policy: str = "priority"
+    # Seconds a job should wait in the queue at most (the p95), by default and per label. While a
+    # label is at risk of missing it, wakeups are planned for the fastest drain. See analytics
+    queue_wait_slo: Optional[float] = None
+    queue_wait_slos: Dict[str, float] = field(default_factory=dict)
+
+    def slo(self, label: str) -> Optional[float]:
+        return self.queue_wait_slos.get(label, self.queue_wait_slo)
 
 
 @dataclass
@@ -27,6 +62,26 @@ class GlobalState:
     privileged_ssh_config: SSHConfig
     task_config: SchedulerConfig
     poll_frequency: Union[float, int]
+    # Polling speeds up to min_poll_frequency while jobs are queued and backs off up to
+    # max_poll_frequency (default 4x poll_frequency) while the queue stays empty
+    min_poll_frequency: Union[float, int] = 5
+    max_poll_frequency: Optional[Union[float, int]] = None
+    metrics_server: Optional[MetricsServer] = None
+    # Built from task_config by default
+    boot_scheduler: Optional[BootScheduler] = None
+    # Without a predictor, nothing is pre-warmed and every node uses idle_time_before_shutdown
+    history: Optional[HistoryStore] = None
+    predictor: Optional[LoadPredictor] = None
+    # Saves the agents, node timers and queue every poll and restores them on startup
+    checkpointer: Optional[Checkpointer] = None
+    # Queue wait, stuck and wake-to-start times per label
+    analytics: QueueAnalytics = field(default_factory=QueueAnalytics)
+    # Records the Jenkins responses and power events for the simulator
+    recorder: Optional[TraceRecorder] = None
+
+    # More controllers whose agents run on the same nodes. Each has its own registry of the same
+    # Node objects, and a node is only shut down once it is idle on every controller
+    other_jenkins_instances: List[Jenkins] = field(default_factory=list)
 
     # Populated from Jenkins
     job_queue: List[QueuedJob] = field(default_factory=list)
@@ -34,11 +89,218 @@ class GlobalState:
     shutdown: bool = False
     initialized: bool = False
     last_time_queue_empty: float = 0
+    # Incremented every time the poller publishes a new job queue
+    snapshot_version: int = 0
+    # Number of consecutive snapshots in which the job queue was empty
+    empty_snapshots: int = 0
+    # What changed in the queue and the computers with the latest snapshot
+    queue_delta: Delta = field(default_factory=Delta)
+    computer_delta: Delta = field(default_factory=Delta)
+
+    _snapshot_published: Optional[asyncio.Event] = field(default=None, repr=False)
+    _poll_requested: Optional[asyncio.Event] = field(default=None, repr=False)
+    _reload_requested: Optional[asyncio.Event] = field(default=None, repr=False)
+    # Work started by the tasks that they do not wait for (pre-warming boots)
+    _background: Set[asyncio.Future] = field(default_factory=set, repr=False)
+
+    def __post_init__(self):
+        if self.max_poll_frequency is None:
+            self.max_poll_frequency = 4 * self.poll_frequency
+        if self.boot_scheduler is None:
+            self.boot_scheduler = BootScheduler(max_concurrent_boots=self.task_config.max_concurrent_boots,
+                                                stagger=self.task_config.boot_stagger,
+                                                boot_timeout=self.task_config.boot_timeout,
+                                                history=self.history)
 
     async def initialize(self):
         if self.initialized:
             return
-        await self.jenkins_instance.fetch_computers()
-        queued_jobs = await self.jenkins_instance.get_queue()
-        self.job_queue.extend(queued_jobs)
+        self._snapshot_published = asyncio.Event()
+        self._poll_requested = asyncio.Event()
+        self._reload_requested = asyncio.Event()
+        self.influx_writer.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.checkpointer is not None:
+            self.checkpointer.load(self)
+        if self.recorder is not None:
+            self.recorder.record_nodes(self.registry)
+            for jenkins in self.jenkins_instances:
+                jenkins.recorder = self.recorder
+        queue_delta, computer_delta = await self.poll_controllers()
+        self.publish_queue(self.queued_jobs(), queue_delta, computer_delta)
         self.initialized = True
+
+    @property
+    def jenkins_instances(self) -> List[Jenkins]:
+        return [self.jenkins_instance, *self.other_jenkins_instances]
+
+    @property
+    def registry(self) -> NodeRegistry:
+        """ The registry of the first controller; every controller's registry holds the same nodes """
+        return self.jenkins_instance.registry
+
+    def agents_on(self, node: Node) -> List[JenkinsAgent]:
+        """ The agents that run on node, across every controller """
+        return [agent for jenkins in self.jenkins_instances for agent in jenkins.registry.agents_on(node)]
+
+    def queued_jobs(self) -> List[QueuedJob]:
+        """ The last fetched queue of every controller """
+        return [job for jenkins in self.jenkins_instances for job in jenkins.queue.jobs.values()]
+
+    async def poll_controllers(self) -> Tuple[Optional[Delta], Delta]:
+        """ Fetches the queue and the computers of every controller concurrently
+
+        Returns the merged changes to the queues (None if no queue could be fetched) and to the computers
+        """
+        async def poll(jenkins: Jenkins) -> Tuple[Optional[Delta], Optional[Delta]]:
+            return await jenkins.update_queue(), await jenkins.fetch_computers()
+
+        results = await asyncio.gather(*[poll(jenkins) for jenkins in self.jenkins_instances])
+        for jenkins, (queue_delta, _) in zip(self.jenkins_instances, results):
+            if queue_delta is None:
+                LOGGER.warning(f"Could not fetch the queue of {jenkins.name}. Keeping its last one")
+        queue_deltas = [queue_delta for queue_delta, _ in results if queue_delta is not None]
+        computer_delta = Delta.merge([computer_delta for _, computer_delta in results if computer_delta is not None])
+        return (Delta.merge(queue_deltas) if queue_deltas else None), computer_delta
+
+    def publish_queue(self, queued_jobs: List[QueuedJob], queue_delta: Optional[Delta] = None,
+                      computer_delta: Optional[Delta] = None) -> bool:
+        """ Replaces the job queue with a new snapshot and wakes up every task waiting for one
+
+        Returns True if the queue just went from empty to non-empty
+        """
+        was_empty = not self.job_queue
+        # Replace rather than mutate, so readers of the previous snapshot are never affected
+        self.job_queue = list(queued_jobs)
+        self.queue_delta = queue_delta or Delta()
+        self.computer_delta = computer_delta or Delta()
+        if self.history is not None:
+            self._record_history()
+        self.analytics.publish(self.analytics.update(self.job_queue, self.queue_delta), self.influx_writer)
+        if self.job_queue:
+            self.empty_snapshots = 0
+        else:
+            self.empty_snapshots += 1
+            self.last_time_queue_empty = clock.now()
+        self.snapshot_version += 1
+        # Waiters hold a reference to the old event, so setting it and swapping in a fresh one
+        # wakes every one of them exactly once
+        event, self._snapshot_published = self._snapshot_published, asyncio.Event()
+        event.set()
+        return was_empty and bool(self.job_queue)
+
+    def _record_history(self):
+        for job in self.queue_delta.added:
+            self.history.record_arrival(job.queued_since.timestamp())
+        nodes = {agent.node: None for agent in self.computer_delta.added + self.computer_delta.changed
+                 if agent.node is not None}
+        for node in nodes:
+            agents = self.agents_on(node)
+            if not any(agent.is_online() for agent in agents):
+                self.history.observe_node_down(node.name)
+            else:
+                self.history.observe_node(node.name, any(agent.busy_executors for agent in agents))
+
+    def record_power(self, node: Node, on: bool):
+        """ Notes that node was powered on, or told to shut down """
+        self.influx_writer.write_point(node.name, int(on))
+        if not on and self.history is not None:
+            self.history.observe_node_down(node.name)
+        if self.recorder is not None:
+            self.recorder.record_power(node.name, on)
+
+    def run_in_background(self, awaitable: Awaitable):
+        """ Runs awaitable without making the caller wait for it. Whatever is still running is cancelled on close """
+        future = asyncio.ensure_future(awaitable)
+        self._background.add(future)
+        future.add_done_callback(self._background_done)
+
+    def _background_done(self, future: asyncio.Future):
+        self._background.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.error("Background task failed", exc_info=future.exception())
+
+    def save_checkpoint(self, force: bool = False):
+        if self.checkpointer is not None:
+            self.checkpointer.save(self, force)
+
+    def boot_time(self, node: Node) -> float:
+        """ Seconds node is expected to take to boot """
+        if self.predictor is None:
+            return node_boot_time(node)
+        return self.predictor.boot_time(node)
+
+    def shutdown_threshold(self, node: Node) -> float:
+        """ Seconds node must be idle before it is shut down """
+        if self.predictor is None:
+            return self.task_config.idle_time_before_shutdown
+        return self.predictor.shutdown_threshold(node, self.task_config.idle_time_before_shutdown)
+
+    async def wait_for_snapshot(self, after_version: int, timeout: float) -> bool:
+        """ Waits until a snapshot newer than after_version is published. Returns False on timeout """
+        if self.snapshot_version > after_version or self.shutdown:
+            return True
+        try:
+            await asyncio.wait_for(self._snapshot_published.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def request_poll(self):
+        """ Asks the poller to fetch a new snapshot right away instead of waiting out its interval """
+        self._poll_requested.set()
+
+    async def wait_for_poll_request(self, timeout: float):
+        """ Sleeps for timeout seconds, or until a task requests a poll """
+        try:
+            await asyncio.wait_for(self._poll_requested.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._poll_requested.clear()
+
+    def request_reload(self):
+        """ Asks the config reloader to check the config file right away """
+        if self._reload_requested is not None:
+            self._reload_requested.set()
+
+    async def wait_for_reload_request(self, timeout: float):
+        """ Sleeps for timeout seconds, or until a reload (or a shutdown) is requested """
+        try:
+            await asyncio.wait_for(self._reload_requested.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._reload_requested.clear()
+
+    def request_shutdown(self):
+        """ Flags the tasks to stop and wakes up any that are waiting """
+        self.shutdown = True
+        if self._snapshot_published is not None:
+            self._snapshot_published.set()
+            self._poll_requested.set()
+            self._reload_requested.set()
+
+    def reset(self):
+        """ Prepares the state for relaunching the tasks after a shutdown """
+        self.shutdown = False
+        self._snapshot_published = asyncio.Event()
+        self._poll_requested = asyncio.Event()
+        self._reload_requested = asyncio.Event()
+
+    async def close(self):
+        """ Flushes buffered metrics and releases the pooled network connections held by the clients """
+        background = list(self._background)
+        for future in background:
+            future.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        self.save_checkpoint(force=True)
+        for jenkins in self.jenkins_instances:
+            await jenkins.close()
+        await self.influx_writer.close()
+        self.boot_scheduler.close()
+        if self.history is not None:
+            self.history.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
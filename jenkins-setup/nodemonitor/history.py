@@ -0,0 +1,120 @@
+""" A persistent record of boot durations, job arrivals and idle gaps
+
+Each event is appended to a JSON-lines file as it happens, so the history survives restarts
+and the LoadPredictor can learn from weeks of it. Only the most recent events of each kind are
+kept in memory, and the file is rewritten with just those on startup so it never grows without
+bound.
+"""
+import collections
+import json
+import logging
+import os
+import pathlib
+from typing import Deque, Dict, List, Optional, Union
+
+from . import clock
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HistoryStore:
+
+    def __init__(self, path: Optional[Union[str, pathlib.Path]] = None, max_arrivals: int = 20000,
+                 max_events_per_node: int = 200):
+        self.path = pathlib.Path(path) if path is not None else None
+        self.max_events_per_node = max_events_per_node
+        # Times (epoch seconds) at which jobs entered the queue
+        self.arrivals: Deque[float] = collections.deque(maxlen=max_arrivals)
+        # node name -> seconds from wake-on-lan until the node was reachable
+        self.boots: Dict[str, Deque[float]] = dict()
+        # node name -> seconds between the node going idle and getting its next job
+        self.idle_gaps: Dict[str, Deque[float]] = dict()
+        self._idle_since: Dict[str, float] = dict()
+        self._file = None
+        if self.path is not None:
+            self._load()
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}; {self.path}; {len(self.arrivals)} arrivals; "
+                f"{len(self.boots)} nodes with boots; {len(self.idle_gaps)} nodes with idle gaps>")
+
+    def record_arrival(self, when: float):
+        self._record(dict(event="arrival", time=when))
+
+    def record_boot(self, node_name: str, seconds: float, when: Optional[float] = None):
+        self._record(dict(event="boot", node=node_name, seconds=seconds, time=when or clock.now()))
+
+    def record_idle_gap(self, node_name: str, seconds: float, when: Optional[float] = None):
+        self._record(dict(event="idle_gap", node=node_name, seconds=seconds, time=when or clock.now()))
+
+    def observe_node(self, node_name: str, busy: bool, when: Optional[float] = None):
+        """ Tracks when a node goes idle, recording the idle gap once it gets a job again """
+        when = when or clock.now()
+        if not busy:
+            self._idle_since.setdefault(node_name, when)
+        elif node_name in self._idle_since:
+            self.record_idle_gap(node_name, when - self._idle_since.pop(node_name), when)
+
+    def observe_node_down(self, node_name: str):
+        """ Stops timing the node's idle gap, since the time it spends shut down is no gap between jobs """
+        self._idle_since.pop(node_name, None)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _per_node(self, events: Dict[str, Deque[float]], node_name: str) -> Deque[float]:
+        if node_name not in events:
+            events[node_name] = collections.deque(maxlen=self.max_events_per_node)
+        return events[node_name]
+
+    def _apply(self, event: dict):
+        kind = event["event"]
+        if kind == "arrival":
+            self.arrivals.append(event["time"])
+        elif kind == "boot":
+            self._per_node(self.boots, event["node"]).append(event["seconds"])
+        elif kind == "idle_gap":
+            self._per_node(self.idle_gaps, event["node"]).append(event["seconds"])
+        else:
+            raise ValueError(f"Unknown history event {kind}")
+
+    def _record(self, event: dict):
+        self._apply(event)
+        if self.path is None:
+            return
+        try:
+            if self._file is None:
+                self._file = self.path.open("a")
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+        except OSError as err:
+            LOGGER.warning(f"Could not write to the history file {self.path}: {err}")
+
+    def _events(self) -> List[dict]:
+        events = [dict(event="arrival", time=when) for when in self.arrivals]
+        for kind, per_node in (("boot", self.boots), ("idle_gap", self.idle_gaps)):
+            for node_name, values in per_node.items():
+                events.extend(dict(event=kind, node=node_name, seconds=value) for value in values)
+        return events
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        lines = 0
+        with self.path.open() as history_file:
+            for line in history_file:
+                lines += 1
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError) as err:
+                    LOGGER.warning(f"Skipping a bad line in {self.path}: {err}")
+        events = self._events()
+        LOGGER.info(f"Loaded {len(events)} events from {self.path}")
+        if lines > len(events):
+            # Compact the file down to the events that are still kept
+            temporary = self.path.with_name(self.path.name + ".tmp")
+            with temporary.open("w") as history_file:
+                history_file.writelines(json.dumps(event) + "\n" for event in events)
+            os.replace(temporary, self.path)
@@ -1,27 +1,170 @@
-""" Wrapper around influx to write events """
+""" Wrapper around influx to write events
+
+Points are buffered in memory and written in batches by a background task, so recording a
+metric never waits on the network. If influx is unreachable, the unwritten batch is put back
+at the front of the (bounded) buffer and retried with an exponential backoff. When the buffer
+is full, the oldest points are dropped first.
+"""
+import asyncio
+import collections
 import logging
+import time
+from typing import Any, Deque, Dict, Optional
+
 import aiohttp
 
+from .metrics import REGISTRY
+
 LOGGER = logging.getLogger(__name__)
 
+BUFFERED_POINTS = REGISTRY.gauge("nodemonitor_influx_buffered_points", "Points waiting to be written to influx")
+DROPPED_POINTS = REGISTRY.counter("nodemonitor_influx_dropped_points_total",
+                                  "Points dropped because the influx buffer was full")
+
+
+def _escape(value: str, special: str) -> str:
+    value = value.replace("\\", "\\\\")
+    for char in special:
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+def _format_field(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        # Integers are deliberately written without the "i" suffix so they are stored as floats,
+        # matching the type of the fields that have always been written
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def format_line(measurement: str, tags: Dict[str, str], fields: Dict[str, Any], timestamp_ns: int) -> str:
+    """ Formats a single point in the influx line protocol """
+    key = _escape(measurement, ", ")
+    for tag, value in sorted(tags.items()):
+        key += f",{_escape(tag, ',= ')}={_escape(str(value), ',= ')}"
+    field_set = ",".join(f"{_escape(field, ',= ')}={_format_field(value)}" for field, value in fields.items())
+    return f"{key} {field_set} {timestamp_ns}"
+
 
 class InfluxWriter:
 
-    def __init__(self, url: str, db: str, username: str, password: str):
+    def __init__(self, url: str, db: str, username: str, password: str,
+                 batch_size: int = 500,
+                 flush_interval: float = 10,
+                 max_buffered_points: int = 10000,
+                 max_backoff: float = 300,
+                 request_timeout: float = 10):
         self.url = url
         self.db = db
         self.username = username
         self._password = password
 
-    async def write_point(self, node_name: str, power_mode: int):
-        node_name = node_name.replace(" ", "\\ ")
-        data = f"node_power,node_name={node_name} value={power_mode}"
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.username, self._password)) as session:
-            async with session.post(
-                f"{self.url}/write", params=dict(db=self.db), data=data
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.dropped_points = 0
+
+        self._buffer: Deque[str] = collections.deque(maxlen=max_buffered_points)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {self.url}/{self.db}; {len(self._buffer)} buffered points>"
+
+    @property
+    def buffered_points(self) -> int:
+        return len(self._buffer)
+
+    def write_point(self, node_name: str, power_mode: int):
+        self.add_point("node_power", dict(node_name=node_name), dict(value=power_mode))
+
+    def add_point(self, measurement: str, tags: Dict[str, str], fields: Dict[str, Any],
+                  timestamp_ns: Optional[int] = None):
+        """ Queues a point for writing. This never blocks; the point is sent by the flush task """
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped_points += 1
+            DROPPED_POINTS.inc()
+        self._buffer.append(format_line(measurement, tags, fields, timestamp_ns))
+        if len(self._buffer) >= self.batch_size and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def start(self):
+        """ Launches the background flush task on the running event loop """
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_requested = asyncio.Event()
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        """ Stops the flush task, makes one last attempt to write what is buffered, and closes the session """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def flush(self) -> bool:
+        """ Writes everything currently buffered. Returns False (keeping the points) on failure """
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            written = False
+            try:
+                written = await self._post("\n".join(batch))
+            finally:
+                if not written:
+                    # Put the batch back in front so ordering is preserved on the next attempt
+                    self._buffer.extendleft(reversed(batch))
+            if not written:
+                BUFFERED_POINTS.set(len(self._buffer))
+                return False
+        BUFFERED_POINTS.set(0)
+        return True
+
+    async def _flush_loop(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            if await self.flush():
+                backoff = self.flush_interval
+            else:
+                backoff = min(backoff * 2, self.max_backoff)
+                LOGGER.warning(f"Influx write failed; {len(self._buffer)} points buffered. Retrying in {backoff} s")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.username, self._password),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self._session
+
+    async def _post(self, data: str) -> bool:
+        try:
+            async with self.session.post(
+                f"{self.url}/write", params=dict(db=self.db, precision="ns"), data=data.encode("utf-8")
             ) as resp:
-                try:
-                    resp.raise_for_status()
-                except aiohttp.ClientResponseError:
+                if resp.status >= 400:
                     text = await resp.text()
-                    LOGGER.exception(f"Failed to log influxdb event: {text}")
+                    LOGGER.error(f"Failed to log influxdb events: {resp.status} [{text}]")
+                    # Client errors (e.g., a malformed point) will never succeed, so do not retry them
+                    return 400 <= resp.status < 500 and resp.status != 429
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            LOGGER.warning(f"Could not reach influx at {self.url}: {err}")
+            return False
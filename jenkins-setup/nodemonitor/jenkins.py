@@ -1,16 +1,39 @@
 """ A set of classes for monitoring Jenkins job queues and states """
+import asyncio
+import collections
 import datetime
+import hashlib
 import logging
 import re
+from dataclasses import dataclass, field
 from functools import wraps
-from typing import List, Dict, Any, Union
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from urllib.parse import quote
 
 import aiohttp
 
+from .jsonstream import iter_array, loads
+from .metrics import REGISTRY, STAGE_SECONDS
 from .nodes import JenkinsAgent, AgentStatus, Node
+from .registry import NodeRegistry
+
+if TYPE_CHECKING:
+    from .trace import TraceRecorder
 
 LOGGER = logging.getLogger(__name__)
 
+# Labeled by route (queue, computers, agent_state, toggle_offline or build) rather than by URL, which
+# holds agent and job names
+REQUESTS = REGISTRY.counter("nodemonitor_jenkins_requests_total", "Requests made to Jenkins", ["endpoint", "status"])
+UNCHANGED = REGISTRY.counter("nodemonitor_jenkins_unchanged_responses_total",
+                             "Jenkins responses that were not decoded because they had not changed", ["endpoint"])
+
+# Only the fields the scheduler uses, so Jenkins does not serialize (and send) every task and action
+QUEUE_TREE = "items[id,stuck,why,inQueueSince]"
+COMPUTER_TREE = "computer[displayName,offline,numExecutors,assignedLabels[busyExecutors]]"
+# Label names are only needed when agents are first seen
+COMPUTER_TREE_WITH_LABELS = "computer[displayName,offline,numExecutors,assignedLabels[busyExecutors,name]]"
+
 
 def _aio_ignore_exceptions(*exc_types):
     def decorator(func):
@@ -25,31 +48,65 @@ def _aio_ignore_exceptions(*exc_types):
     return decorator
 
 
+@dataclass
+class Delta:
+    """ What changed between two consecutive fetches of the queue or of the computers """
+    added: List[Any] = field(default_factory=list)
+    removed: List[Any] = field(default_factory=list)
+    changed: List[Any] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        return f"+{len(self.added)} -{len(self.removed)} ~{len(self.changed)}"
+
+    @classmethod
+    def merge(cls, deltas: List["Delta"]) -> "Delta":
+        merged = cls()
+        for delta in deltas:
+            merged.added.extend(delta.added)
+            merged.removed.extend(delta.removed)
+            merged.changed.extend(delta.changed)
+        return merged
+
+
+# Marks a QueuedJob whose wait reason still needs to be parsed
+_UNPARSED = object()
+
+
 class QueuedJob:
 
-    all_nodes_offline = re.compile(r'^All nodes of label .([\w&]+). are offline')
-    waiting_for_node = re.compile(r'^Waiting for next available executor on .(\w+).')
+    __slots__ = ("id", "stuck", "reason", "waiting_for", "queued_since")
+
+    # Labels may be expressions like ‘linux&&cuda’ and agent names may contain spaces and dashes
+    all_nodes_offline = re.compile(r'^All nodes of label .([\w&|!() \-]+). are offline')
+    waiting_for_node = re.compile(r'^Waiting for next available executor on .([\w&|!() \-]+).')
     some_nodes_offline = re.compile(r'.([\w \-]+). is offline')
 
-    def __init__(self, id: int, stuck: bool, reason: str, queued_since: datetime.datetime):
+    def __init__(self, id: int, stuck: bool, reason: str, queued_since: datetime.datetime,
+                 waiting_for: Optional[Dict[str, Union[List[str], str]]] = _UNPARSED):
         self.id = id
         self.stuck = stuck
-        self.waiting_for = self._extract_wait_from_reason(reason)
+        self.reason = reason
+        self.waiting_for = self.parse_reason(stuck, reason) if waiting_for is _UNPARSED else waiting_for
         self.queued_since = queued_since
 
     def __repr__(self):
         stuck = 'stuck ' if self.stuck else ''
         return f'<{self.__class__.__name__} {self.id}; {stuck}waiting for {self.waiting_for} since {self.queued_since.isoformat()}>'
 
-    def _extract_wait_from_reason(self, reason: str) -> Dict[str, Union[List[str], str]]:
-        if self.stuck:
-            rematch = self.all_nodes_offline.match(reason)
+    @classmethod
+    def parse_reason(cls, stuck: bool, reason: str) -> Optional[Dict[str, Union[List[str], str]]]:
+        """ Extracts the label (or list of agents) a job is waiting for from the reason Jenkins gives """
+        if stuck:
+            rematch = cls.all_nodes_offline.match(reason)
         else:
-            rematch = self.waiting_for_node.match(reason)
+            rematch = cls.waiting_for_node.match(reason)
 
         if rematch is None:
-            if not self.stuck:
-                nodes = self.some_nodes_offline.findall(reason)
+            if not stuck:
+                nodes = cls.some_nodes_offline.findall(reason)
                 if nodes:
                     return dict(nodes=nodes)
             LOGGER.error(f'Could not find needed node via regex match for [{reason}]')
@@ -57,82 +114,315 @@ class QueuedJob:
 
         return dict(label=rematch.groups()[0])
 
+
+class QueueTracker:
+    """ Keeps the queued jobs keyed by id so each poll only does work for new or changed items
+
+    Jobs whose reason and stuck flag did not change are reused as-is, and parsed wait reasons are
+    cached by (stuck, why) since many queued items usually wait for the same thing.
+    """
+
+    def __init__(self, max_cached_reasons: int = 1024):
+        self.jobs: Dict[int, QueuedJob] = dict()
+        self.max_cached_reasons = max_cached_reasons
+        self._reasons: Dict[Tuple[bool, str], Any] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def update(self, items: Iterable[Dict[str, Any]]) -> Delta:
+        """ Reconciles the tracked jobs with the items of a queue/api/json response """
+        delta = Delta()
+        seen = set()
+        for item in items:
+            self._track(item, delta, seen)
+        self._remove_unseen(delta, seen)
+        return delta
+
+    def _track(self, item: Dict[str, Any], delta: Delta, seen: Set[int]):
+        job_id, stuck, reason = item['id'], item['stuck'], item['why']
+        seen.add(job_id)
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = QueuedJob(job_id, stuck, reason,
+                            datetime.datetime.fromtimestamp(item['inQueueSince'] / 1000),
+                            waiting_for=self._parse_reason(stuck, reason))
+            self.jobs[job_id] = job
+            delta.added.append(job)
+        elif job.stuck != stuck or job.reason != reason:
+            job.stuck, job.reason = stuck, reason
+            job.waiting_for = self._parse_reason(stuck, reason)
+            delta.changed.append(job)
+
+    def _remove_unseen(self, delta: Delta, seen: Set[int]):
+        for job_id in [job_id for job_id in self.jobs if job_id not in seen]:
+            delta.removed.append(self.jobs.pop(job_id))
+
+    def _parse_reason(self, stuck: bool, reason: str):
+        key = (stuck, reason)
+        try:
+            self._reasons.move_to_end(key)
+            return self._reasons[key]
+        except KeyError:
+            waiting_for = self._reasons[key] = QueuedJob.parse_reason(stuck, reason)
+            if len(self._reasons) > self.max_cached_reasons:
+                self._reasons.popitem(last=False)
+            return waiting_for
+
+
 class Jenkins:
 
     def __init__(self,
                  url: str,
                  username: str,
-                 token: str):
+                 token: str,
+                 registry: Optional[NodeRegistry] = None,
+                 connection_limit: int = 4,
+                 request_timeout: float = 30,
+                 keepalive_timeout: float = 300,
+                 name: str = "jenkins",
+                 stream_responses: bool = False):
+        # Identifies the controller when a node monitor manages several of them
+        self.name = name
         self.url = url.rstrip('/')
         self.username = username
         self._token = token
         self.nodes = dict()
+        self.registry = registry if registry is not None else NodeRegistry()
+        self.queue = QueueTracker()
+
+        self.connection_limit = connection_limit
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        # Decode the queue and computers item by item as they arrive, instead of all at once
+        self.stream_responses = stream_responses
+        self._session: Optional[aiohttp.ClientSession] = None
+        # (href, tree) -> (ETag, digest of the body) of the last response
+        self._last_responses: Dict[Tuple[str, str], Tuple[Optional[str], bytes]] = dict()
+        # Records every changed queue and computers response, if set
+        self.recorder: Optional["TraceRecorder"] = None
 
     def __repr__(self):
-        return f"<{self.__class__.__name__}; {len(self.nodes)} agents>"
-
-    async def fetch_computers(self):
-        """ Fetches list of nodes from Jenkins using the REST interface """
-        comp_attr = "displayName,offline,numExecutors"
-        req_attr = "busyExecutors,name" if not self.nodes else "busyExecutors"
-        params = dict(depth="1", tree=f"computer[{comp_attr},assignedLabels[{req_attr}]]")
-        response = await self._request_json("get", "computer/api/json", params=params)
-        if response is None:
+        return f"<{self.__class__.__name__} {self.name}; {len(self.nodes)} agents>"
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """ A long-lived session so that every request reuses pooled keep-alive connections """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.username, self._token),
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """ Closes the pooled connections. A later request will transparently open a new pool """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def fetch_computers(self) -> Optional[Delta]:
+        """ Fetches list of nodes from Jenkins using the REST interface
+
+        Returns which agents were added, removed or changed (status or executors) since the last fetch
+        """
+        delta = Delta()
+        seen = set()
+        unlabeled = []
+        computers = []
+
+        def process(computer: Dict[str, Any], labeled: bool):
+            seen.add(computer['displayName'])
+            if self.recorder is not None:
+                computers.append(computer)
+            if self._process_computer(computer, delta, labeled) is None:
+                unlabeled.append(computer['displayName'])
+
+        with STAGE_SECONDS.time(stage="fetch_computers"):
+            labeled = not self.nodes
+            tree = COMPUTER_TREE_WITH_LABELS if labeled else COMPUTER_TREE
+            changed = await self._fetch_items("computers", "computer/api/json", tree, "computer",
+                                              lambda computer: process(computer, labeled), depth="1")
+            if changed and unlabeled:
+                # New agents showed up, so ask again, this time with their labels
+                computers.clear()
+                changed = await self._fetch_items("computers", "computer/api/json", COMPUTER_TREE_WITH_LABELS,
+                                                  "computer", lambda computer: process(computer, True),
+                                                  cached=False, depth="1")
+        if changed is None:
             LOGGER.error("Failed getting computer list from Jenkins")
-        else:
-            for computer in response['computer']:
-                self._process_computer(computer)
+            return None
+        if delta and self.recorder is not None:
+            # Not merely changed: the first poll without labels differs from the one with them
+            self.recorder.record_computers(self.name, computers)
+        if changed:
+            for name in [name for name in self.nodes if name not in seen]:
+                agent = self.nodes.pop(name)
+                self.registry.unregister_agent(agent)
+                delta.removed.append(agent)
+        return delta
+
+    async def update_queue(self) -> Optional[Delta]:
+        """ Fetches the queue and returns which jobs were added, removed or changed since the last fetch """
+        delta = Delta()
+        seen = set()
+        items = []
+
+        def process(item: Dict[str, Any]):
+            if self.recorder is not None:
+                items.append(item)
+            self.queue._track(item, delta, seen)
 
-    async def get_queue(self) -> List[QueuedJob]:
-        """ Fetches all of the builds that are currently running """
-        response = await self._request_json("get", f"queue/api/json")
+        with STAGE_SECONDS.time(stage="get_queue"):
+            changed = await self._fetch_items("queue", "queue/api/json", QUEUE_TREE, "items", process)
         # Gets the list of all builds and the reasons they are not running
-        if response is None:
+        if changed is None:
             LOGGER.error("Failed getting queue")
-        else:
-            return [
-                QueuedJob(item['id'], item['stuck'], item['why'],
-                          datetime.datetime.fromtimestamp(item['inQueueSince'] / 1000))
-                for item in response['items']
-            ]
+            return None
+        if changed and self.recorder is not None:
+            self.recorder.record_queue(self.name, items)
+        if changed:
+            self.queue._remove_unseen(delta, seen)
+        return delta
+
+    async def get_queue(self) -> Optional[List[QueuedJob]]:
+        """ Fetches all of the builds that are currently queued """
+        if await self.update_queue() is None:
+            return None
+        return list(self.queue.jobs.values())
 
     async def build_job(self, job_path: str):
         # The href in a job with path my/path/here is /job/my/job/path/job/here
         href = f'/job/{"/job/".join(job_path.split("/"))}/build'
-        await self._request_json('post', href)
+        await self._request_json('post', "build", href)
+
+    async def agent_state(self, name: str) -> Optional[Dict[str, Any]]:
+        """ Whether the agent is idle and temporarily offline right now (rather than as of the last poll) """
+        state = await self._request_json("get", "agent_state", f"computer/{quote(name, safe='')}/api/json",
+                                         params=dict(tree="idle,temporarilyOffline"))
+        if not isinstance(state, dict) or "idle" not in state:
+            LOGGER.warning(f"Could not fetch the state of {name}")
+            return None
+        return state
 
-    def _process_computer(self, computer: Dict[str, Any]) -> JenkinsAgent:
+    async def set_temporarily_offline(self, name: str, offline: bool, message: str = "") -> Optional[bool]:
+        """ Marks the agent temporarily offline (so Jenkins assigns it no new builds), or back online
+
+        Returns whether the agent had to be toggled, or None if that failed
+        """
+        state = await self.agent_state(name)
+        if state is None:
+            return None
+        if state["temporarilyOffline"] == offline:
+            return False
+        await self._request_json("post", "toggle_offline", f"computer/{quote(name, safe='')}/toggleOffline",
+                                 params=dict(offlineMessage=message))
+        state = await self.agent_state(name)
+        if state is None or state["temporarilyOffline"] != offline:
+            LOGGER.warning(f"Could not mark {name} {'offline' if offline else 'online'}")
+            return None
+        LOGGER.info(f"Marked {name} temporarily {'offline' if offline else 'online'} on {self.name}")
+        return True
+
+    def add_agent(self, agent: JenkinsAgent):
+        """ Tracks an agent that was not fetched from Jenkins (e.g., restored from a checkpoint) """
+        self.nodes[agent.name] = agent
+        self.registry.register_agent(agent)
+
+    def _process_computer(self, computer: Dict[str, Any], delta: Delta,
+                          labeled: bool = True) -> Optional[JenkinsAgent]:
+        """ Creates or updates the agent. New agents are skipped (returning None) if labels were not requested """
         name = computer['displayName']
         status = AgentStatus.Offline if computer['offline'] else AgentStatus.Online
         # To save on data transfer, we only ask for labels the first time
-        labels = [label.get('name', []) for label in computer['assignedLabels']]
+        labels = [label['name'] for label in computer['assignedLabels'] if 'name' in label]
         num_executors = computer['numExecutors']
         try:
             busy_executors = computer['assignedLabels'][0]['busyExecutors']
         except IndexError:
             LOGGER.warning(f"Could not find any assigned labels for {computer}")
             busy_executors = 0
-        if name in self.nodes:
-            self.nodes[name].status = status
-            self.nodes[name].num_executors = num_executors
-            self.nodes[name].busy_executors = busy_executors
-        else:
-            self.nodes[name] = JenkinsAgent(name, labels, status, num_executors, busy_executors)
+        agent = self.nodes.get(name)
+        if agent is None:
+            if not labeled:
+                return None
+            agent = JenkinsAgent(name, labels, status, num_executors, busy_executors)
+            self.add_agent(agent)
+            delta.added.append(agent)
+            return agent
+        if (agent.status, agent.num_executors, agent.busy_executors) != (status, num_executors, busy_executors):
+            delta.changed.append(agent)
+        agent.status = status
+        agent.num_executors = num_executors
+        # Always set busy_executors, since the setter also tracks when the last job finished
+        agent.busy_executors = busy_executors
+        return agent
 
-    @_aio_ignore_exceptions(aiohttp.client_exceptions.ClientError)
+    @_aio_ignore_exceptions(aiohttp.client_exceptions.ClientError, asyncio.TimeoutError, ValueError)
+    async def _fetch_items(self, endpoint: str, href: str, tree: str, key: str, process: Callable[[Any], None],
+                           cached: bool = True, **params) -> Optional[bool]:
+        """ GETs a tree= projection of href and calls process with each element of its key array
+
+        endpoint names the route in the request metrics.
+
+        Returns False, without calling process, if the response is the same as last time; True if
+        it changed; None if the request failed. The last ETag is sent (if Jenkins, or a proxy in
+        front of it, gave one) so an unchanged resource costs an empty 304. Otherwise a digest of
+        the body is compared with the last one, so an unchanged body is never decoded. When
+        streaming, elements are processed as they arrive, so an unchanged body is processed (to
+        the same effect) but still never held in memory all at once.
+        """
+        cache_key = (href, tree)
+        etag, digest = self._last_responses.get(cache_key, (None, None)) if cached else (None, None)
+        headers = {"If-None-Match": etag} if etag else None
+        hasher = hashlib.blake2b(digest_size=16)
+        async with self.session.get(f"{self.url}/{href}", params=dict(params, tree=tree), headers=headers) as resp:
+            REQUESTS.inc(endpoint=endpoint, status=resp.status)
+            if resp.status == 304:
+                UNCHANGED.inc(endpoint=endpoint)
+                return False
+            if resp.status >= 400:
+                text = await resp.text()
+                LOGGER.warning(f"Failed requesting {href} - {resp.status} [{text}]")
+                return None
+            if self.stream_responses:
+                async def chunks():
+                    async for chunk in resp.content.iter_chunked(1 << 16):
+                        hasher.update(chunk)
+                        yield chunk
+
+                async for element in iter_array(chunks(), key):
+                    process(element)
+            else:
+                body = await resp.read()
+                hasher.update(body)
+                if hasher.digest() != digest:
+                    for element in loads(body)[key]:
+                        process(element)
+        self._last_responses[cache_key] = (resp.headers.get("ETag"), hasher.digest())
+        if hasher.digest() == digest:
+            UNCHANGED.inc(endpoint=endpoint)
+            return False
+        return True
+
+    @_aio_ignore_exceptions(aiohttp.client_exceptions.ClientError, asyncio.TimeoutError)
     async def _request_json(self,
                             verb: str,
+                            endpoint: str,
                             href: str,
                             params: Dict[str, str] = None,
                             payload: Dict[str, str] = None,
                             data: bytes = None) -> Dict[str, Any]:
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.username, self._token)) as session:
-            async with session.request(verb, f"{self.url}/{href}", params=params, data=data, json=payload) as resp:
-                async with resp:
-                    if resp.status >= 400:
-                        text = await resp.text()
-                        LOGGER.warning(f"Failed requesting {href} - {resp.status} [{text}]")
-                    try:
-                        return await resp.json()
-                    except aiohttp.ContentTypeError:
-                        return await resp.text()
+        href = href.lstrip('/')
+        async with self.session.request(verb, f"{self.url}/{href}", params=params, data=data, json=payload) as resp:
+            REQUESTS.inc(endpoint=endpoint, status=resp.status)
+            if resp.status >= 400:
+                text = await resp.text()
+                LOGGER.warning(f"Failed requesting {href} - {resp.status} [{text}]")
+            try:
+                return await resp.json(loads=loads)
+            except aiohttp.ContentTypeError:
+                return await resp.text()
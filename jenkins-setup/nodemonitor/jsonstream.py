@@ -0,0 +1,67 @@
+""" Fast and incremental JSON decoding
+
+loads is the fastest decoder that is installed (orjson, then ujson, then the standard library),
+and iter_array yields the elements of a top-level array as a document streams in, so a large
+response never has to be held (or decoded) all at once.
+"""
+import codecs
+import json
+import re
+from typing import Any, AsyncIterable, AsyncIterator
+
+try:
+    import orjson
+    loads = orjson.loads
+    BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        BACKEND = "ujson"
+    except ImportError:
+        loads = json.loads
+        BACKEND = "json"
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+async def iter_array(chunks: AsyncIterable[bytes], key: str) -> AsyncIterator[Any]:
+    """ Yields each element of the array under key (e.g., "items") as soon as it has been received
+
+    The key is expected to appear once, before any other key with that name (as in a Jenkins
+    response restricted with tree=). Only the element being received is kept in memory.
+    Raises ValueError if the document ends before the array does.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buffer, position = "", None
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        if position is None:
+            match = array_start.search(buffer)
+            if match is None:
+                # Keep enough of the end in case the key is split across chunks
+                buffer = buffer[-(len(key) + 64):]
+                continue
+            position = match.end()
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if buffer.startswith(",", position):
+                position = _WHITESPACE.match(buffer, position + 1).end()
+            if position >= len(buffer):
+                break
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = _DECODER.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The element has not been received completely yet
+                break
+            if end == len(buffer) and not isinstance(element, (dict, list, str)):
+                # A number or literal at the very end may continue in the next chunk
+                break
+            yield element
+            position = end
+        buffer, position = buffer[position:], 0
+    raise ValueError(f"The JSON document ended before the {key} array did")
@@ -4,25 +4,47 @@ from __future__ import annotations
 import asyncio
 import concurrent.futures
 import enum
+import functools
 import logging
 import pathlib
-import time
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional
 
 import asyncssh
-from wakeonlan import send_magic_packet
+
+from . import clock
+from .metrics import REGISTRY
+from .power import PowerBackend, PowerState, WakeOnLanPower
+from .probe import PROBER, ReachabilityHistory
+from .ssh import PersistentSSHConnection
+from .telemetry import TELEMETRY_COMMAND, BusyPolicy, NodeTelemetry
+from .wol import WakeOnLan, broadcast_address
 
 LOGGER = logging.getLogger(__name__)
 
+PROBE_SECONDS = REGISTRY.histogram("nodemonitor_probe_seconds", "Time to probe a node's SSH port",
+                                   ["node", "available"])
+WAKE_SECONDS = REGISTRY.histogram("nodemonitor_wake_seconds", "Time from sending the wake-on-lan packet until "
+                                  "the node is available", ["node"])
+WAKE_FAILURES = REGISTRY.counter("nodemonitor_wake_failures_total", "Nodes that did not come up after a wake-on-lan",
+                                 ["node"])
+POWER_RECOVERIES = REGISTRY.counter("nodemonitor_power_recoveries_total", "Nodes that hung while booting (and were "
+                                    "power cycled) or while shutting down (and were forced off)", ["node", "action"])
+
+DEFAULT_BUSY_POLICY = BusyPolicy()
+
 @dataclass
 class SSHConfig:
     username: str
     password: Optional[str]
     private_key: asyncssh.SSHKey = None
+    keepalive_interval: float = 30
+    keepalive_count_max: int = 3
+    connection_idle_timeout: float = 600
 
     def options(self) -> dict:
-        ssh_options = dict(username=self.username, known_hosts=None)
+        ssh_options = dict(username=self.username, known_hosts=None, keepalive_interval=self.keepalive_interval,
+                           keepalive_count_max=self.keepalive_count_max)
         if self.private_key:
             ssh_options['client_keys'] = str(self.private_key)
             if self.password:
@@ -32,10 +54,19 @@ class SSHConfig:
         return ssh_options
 
     @classmethod
-    def create(cls, username: str, password: str, private_key: Optional[str] = None) -> SSHConfig:
+    def create(cls, username: str, password: str, private_key: Optional[str] = None,
+               keepalive_interval: str = "30", keepalive_count_max: str = "3",
+               connection_idle_timeout: str = "600") -> SSHConfig:
         if private_key is not None:
-            private_key = asyncssh.import_private_key(private_key, passphrase=password)
-        return cls(username=username, password=password, private_key=private_key)
+            private_key = _import_private_key(private_key, password)
+        return cls(username=username, password=password, private_key=private_key,
+                   keepalive_interval=float(keepalive_interval), keepalive_count_max=int(keepalive_count_max),
+                   connection_idle_timeout=float(connection_idle_timeout))
+
+@functools.lru_cache(maxsize=8)
+def _import_private_key(data: str, passphrase: Optional[str]) -> asyncssh.SSHKey:
+    """ Parsing (and, for an encrypted key, decrypting) a key is slow, so a reloaded config reuses the last one """
+    return asyncssh.import_private_key(data, passphrase=passphrase)
 
 class NodeStatus(enum.Enum):
     On = "On"
@@ -43,82 +74,214 @@ class NodeStatus(enum.Enum):
 
 class Node:
 
-    def __init__(self, name: str, local_ip_address: str, mac_address: str):
+    __slots__ = ("name", "local_ip_address", "mac_address", "broadcast_address", "aliases", "capacity", "port",
+                 "power", "boot_time", "power_backend", "time_shutdown", "time_woken", "last_boot_seconds",
+                 "reachability", "ssh", "telemetry", "_power_watch")
+
+    def __init__(self, name: str, local_ip_address: str, mac_address: str,
+                 aliases: Iterable[str] = (), capacity: Optional[int] = None, port: int = 22,
+                 broadcast: Optional[str] = None, power: Optional[float] = None,
+                 boot_time: Optional[float] = None, power_backend: Optional[PowerBackend] = None):
         self.name = name
         self.local_ip_address = local_ip_address
         self.mac_address = mac_address
+        # Where the wake-on-lan packets go; the /24 subnet's broadcast address by default
+        self.broadcast_address = broadcast or broadcast_address(local_ip_address)
+        # The SSH port, which is also what is probed to see if the node is up
+        self.port = port
+        # Other Jenkins agents running on this same machine (e.g., "<name>-cuda")
+        self.aliases = tuple(aliases)
+        # Maximum number of jobs the machine can run at once across all of its agents
+        self.capacity = capacity
+        # Watts the machine draws while it is on, and seconds it usually takes to boot (the
+        # predictor's learned boot time takes over once there is history). Used by the wake policies
+        self.power = power
+        self.boot_time = boot_time
+        # What switches the machine on and off (wake-on-lan and SSH by default)
+        self.power_backend = power_backend or WakeOnLanPower()
 
         self.time_shutdown = 0
         self.time_woken = 0
+        # Seconds from power-on until the node was available, for the last wakeup that powered it
+        # on and saw it come up (None otherwise, e.g. when it was already awake)
+        self.last_boot_seconds: Optional[float] = None
+        # Whether the node is up, going by the last few probes; time_woken and time_shutdown only
+        # move when it changes, so a single lost probe does not restart the idle clocks
+        self.reachability = ReachabilityHistory()
+
+        self.ssh = PersistentSSHConnection(local_ip_address, port)
+        # The last snapshot of what runs on the node (see probe_telemetry)
+        self.telemetry: Optional[NodeTelemetry] = None
+        # Makes sure the node powers off after it was told to shut down
+        self._power_watch: Optional[asyncio.Future] = None
 
-    async def is_available(self) -> bool:
-        open_fut = asyncio.open_connection(self.local_ip_address, 22)
-        try:
-            _, writer = await asyncio.wait_for(open_fut, 3)
-        except Exception:
-            self.time_shutdown = self.time_shutdown or time.time()
-            return False
-        else:
-            writer.close()
-            self.time_woken = self.time_woken or time.time()
-            return True
-
-    async def run_ssh_command(self, config: SSHConfig, command: str):
-        async with asyncssh.connect(self.local_ip_address, **config.options()) as conn:
-            return await conn.run(command)
-
-    async def is_in_use(self, config: SSHConfig):
-        async with asyncssh.connect(self.local_ip_address, **config.options()) as conn:
-            result = await conn.run("users")
-
-        LOGGER.debug(f"Saw '{result.stdout.strip()}' when looking for logged-in users")
-        all_users = set(result.stdout.strip().split())
-        return not all_users.issubset({'jenkins', ''})
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}; {self.local_ip_address}; aliases={list(self.aliases)}>"
 
-    async def wakeup(self):
+    @property
+    def agent_names(self) -> List[str]:
+        """ Names of every Jenkins agent that runs on this machine """
+        return [self.name, *self.aliases]
+
+    async def is_available(self, max_age: Optional[float] = None) -> bool:
+        """ Whether the SSH port accepts connections, going by a probe at most max_age seconds old (the TTL) """
+        start = asyncio.get_event_loop().time()
+        probed_at, reachable = await PROBER.probe(self.local_ip_address, self.port, max_age=max_age)
+        if probed_at >= start:
+            PROBE_SECONDS.observe(probed_at - start, node=self.name, available=str(reachable).lower())
+        self.observe_probe(reachable, probed_at)
+        return reachable
+
+    def observe_probe(self, reachable: bool, probed_at: Optional[float] = None):
+        """ Counts a probe towards the node's up/down state, and notes when that state changed """
+        if not self.reachability.observe(reachable, probed_at):
+            return
+        # Unless the change was already noted (by wakeup or shutdown)
+        if self.reachability.up and self.time_woken <= self.time_shutdown:
+            self.time_woken = clock.now()
+        elif not self.reachability.up and self.time_shutdown <= self.time_woken:
+            self.time_shutdown = clock.now()
+
+    async def run_ssh_command(self, config: SSHConfig, command: str, retry: bool = True,
+                              timeout: Optional[float] = None):
+        self.ssh.idle_timeout = config.connection_idle_timeout
+        return await self.ssh.run(command, config.options(), retry=retry, timeout=timeout)
+
+    async def probe_telemetry(self, config: SSHConfig, timeout: float = 10) -> NodeTelemetry:
+        """ Collects what is running on the node in one SSH command, and keeps it as the latest snapshot """
+        result = await asyncio.wait_for(self.run_ssh_command(config, TELEMETRY_COMMAND), timeout)
+        self.telemetry = NodeTelemetry.parse(result.stdout or "", clock.now(), previous=self.telemetry)
+        return self.telemetry
+
+    async def is_in_use(self, config: SSHConfig, policy: BusyPolicy = DEFAULT_BUSY_POLICY,
+                        max_age: float = 0) -> bool:
+        """ Whether anything outside Jenkins runs on the node, going by a snapshot at most max_age seconds old """
+        telemetry = self.telemetry
+        if telemetry is None or clock.now() - telemetry.time > max_age:
+            telemetry = await self.probe_telemetry(config)
+        reasons = policy.reasons(telemetry)
+        if reasons:
+            LOGGER.info(f"{self.name} is in use ({'; '.join(reasons)})")
+        return bool(reasons)
+
+    async def wait_until_available(self, timeout: float, attempt_timeout: float = 3) -> bool:
+        """ Resolves as soon as the SSH port accepts connections. Returns False after timeout seconds
+
+        A machine that is still off usually drops the connection attempt, so each attempt is given
+        attempt_timeout seconds; attempts that are refused (the network is up but sshd is not yet)
+        are retried after a short, growing delay.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        delay = 0.25
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            start = loop.time()
+            _, reachable = await PROBER.probe(self.local_ip_address, self.port,
+                                              timeout=min(attempt_timeout, remaining), max_age=0)
+            if reachable:
+                self.reachability.set(True)
+                return True
+            if loop.time() - start < min(attempt_timeout, remaining):
+                # Refused rather than timed out
+                await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+                delay = min(delay * 2, 2)
+
+    async def power_state(self) -> Optional[PowerState]:
+        """ Whether the machine has power, according to its power backend (None if it cannot tell) """
+        return await self.power_backend.power_state(self)
+
+    async def wakeup(self, sender: WakeOnLan, timeout: float = 120) -> bool:
+        """ Powers the node on and waits until it is available
+
+        A backend that reports the power state confirms within seconds that the node powered on,
+        and a node that was down, has power and does not come up within timeout is power cycled once.
+        """
+        self.last_boot_seconds = None
         if await self.is_available():
             LOGGER.info(f"{self.name} is already awake")
+            self.reachability.set(True)
             return True
-        LOGGER.info(f'WoL {self.name} - Initiating wake-on-lan')
-        self.time_woken = time.time()
-        send_magic_packet(self.mac_address.lower())
-        for _ in range(20):
-            # Wait up to 2 minutes to wake up (is_available will wait 3 seconds if it's off, too)
-            await asyncio.sleep(3)
-            LOGGER.info(f"WoL {self.name} - Checking node availability")
-            available = await self.is_available()
-            if available:
-                LOGGER.info(f"WoL {self.name} - now available!")
-                return True
-        LOGGER.warning(f"WoL {self.name} - Did not respond >2 minutes after WoL sent!")
-        # One last try
-        return await self.is_available()
-
-    async def shutdown(self, admin_config: SSHConfig, force: bool = False):
-        if await self.is_in_use(admin_config) and not force:
+        backend = self.power_backend
+        LOGGER.info(f"Powering on {self.name} ({backend.name})")
+        if self._power_watch is not None:
+            self._power_watch.cancel()
+        self.time_woken = clock.now()
+        await backend.power_on(self, sender)
+        if not await backend.wait_for_state(self, PowerState.On, backend.confirm_timeout):
+            LOGGER.warning(f"{self.name} did not power on within {backend.confirm_timeout} seconds")
+            WAKE_FAILURES.inc(node=self.name)
+            return False
+        available = await self.wait_until_available(timeout)
+        if not available and self.reachability.up is False and await backend.power_state(self) is PowerState.On:
+            if await self.is_available(max_age=0):
+                # Only slow to come up
+                self.reachability.set(True)
+                available = True
+            elif await backend.power_cycle(self):
+                LOGGER.warning(f"{self.name} has power but did not respond >{timeout} seconds after powering on. "
+                               f"Power cycled it")
+                POWER_RECOVERIES.inc(node=self.name, action="power_cycle")
+                available = await self.wait_until_available(timeout)
+        if available:
+            LOGGER.info(f"{self.name} is now available!")
+            self.last_boot_seconds = clock.now() - self.time_woken
+            WAKE_SECONDS.observe(self.last_boot_seconds, node=self.name)
+            return True
+        LOGGER.warning(f"{self.name} did not respond >{timeout} seconds after powering on!")
+        WAKE_FAILURES.inc(node=self.name)
+        return False
+
+    async def shutdown(self, admin_config: SSHConfig, force: bool = False, policy: BusyPolicy = DEFAULT_BUSY_POLICY,
+                       telemetry_max_age: float = 0) -> bool:
+        """ Shuts the node down unless something runs on it. Returns whether it was told to shut down """
+        if not force and await self.is_in_use(admin_config, policy, telemetry_max_age):
             LOGGER.info(f'{self.name} is in use. Not shutting down')
-            return
+            return False
         if await self.is_available():
-            self.time_shutdown = time.time()
+            self.time_shutdown = clock.now()
+            self.reachability.set(False)
+            PROBER.forget(self.local_ip_address, self.port)
             try:
-                await self.run_ssh_command(admin_config, 'sudo shutdown now')
-            except asyncssh.misc.ConnectionLost:
-                LOGGER.info(f"Connection lost while shutting down {self.name}")
-        else:
-            LOGGER.info(f'{self.name} cannot shut down, not even awake')
-
-NODES = {
-#   'Batman': Node('Batman', '192.168.1.3', 'C8:60:00:78:00:0C'),
-#   'Green Lantern': Node('Green Lantern', '192.168.1.140', '04:D9:F5:B9:F7:0B'),
-    'Green Arrow': Node('Green Arrow', '192.168.1.141', '1C:69:7A:31:52:21'),
-    'Wonder Woman': Node('Wonder Woman', '192.168.1.142', '00:D8:61:FF:31:47'),
-    'Supergirl': Node('Supergirl', '192.168.1.143', '2C:F0:5D:27:5E:AA'),
-}
-# Now add the CUDA nodes
-#NODES['Green Lantern-cuda'] = NODES['Green Lantern']
-NODES['Green Arrow-cuda'] = NODES['Green Arrow']
-NODES['Wonder Woman-cuda'] = NODES['Wonder Woman']
-NODES['Supergirl-cuda'] = NODES['Supergirl']
+                await self.power_backend.shutdown(self, admin_config)
+            finally:
+                # The host is going away, so do not wait for keepalives to notice
+                self.ssh.close()
+            if self.power_backend.reports_state:
+                self._power_watch = asyncio.ensure_future(self._force_off_if_hung())
+            return True
+        LOGGER.info(f'{self.name} cannot shut down, not even awake')
+        return False
+
+    async def _force_off_if_hung(self):
+        """ Cuts the power if the node still has it shutdown_timeout seconds after it was told to shut down """
+        backend = self.power_backend
+        try:
+            if await backend.wait_for_state(self, PowerState.Off, backend.shutdown_timeout):
+                return
+            if backend.cuts_power_after_shutdown:
+                LOGGER.info(f"Switching {self.name} off")
+                await backend.power_off(self)
+                return
+            LOGGER.warning(f"{self.name} still has power {backend.shutdown_timeout} seconds after shutting down. "
+                           f"Forcing it off")
+            if await backend.power_off(self):
+                POWER_RECOVERIES.inc(node=self.name, action="power_off")
+        except OSError as err:
+            LOGGER.error(f"Could not force {self.name} off: {err}")
+
+
+async def probe_nodes(nodes: Iterable[Node]) -> Dict[Node, bool]:
+    """ Probes each unique node, all at once
+
+    Returns a snapshot mapping each node to whether it is up, going by its last few probes rather
+    than only this one, so a single lost probe does not get a running node booted again
+    """
+    unique_nodes = list(dict.fromkeys(nodes))
+    await asyncio.gather(*[node.is_available() for node in unique_nodes])
+    return {node: bool(node.reachability.up) for node in unique_nodes}
 
 
 class AgentStatus(enum.Enum):
@@ -127,16 +290,21 @@ class AgentStatus(enum.Enum):
 
 class JenkinsAgent:
 
+    __slots__ = ("name", "labels", "status", "node", "num_executors", "_busy_executors",
+                 "_time_last_job_finished")
+
     def __init__(self, name: str, labels: List[str], status: AgentStatus,
-                 num_executors: int, busy_executors: int):
+                 num_executors: int, busy_executors: int, node: Optional[Node] = None,
+                 time_last_job_finished: Optional[float] = None):
         self.name = name
         self.labels = labels
         self.status = status
-        self.node = NODES.get(self.name, None)
+        # Attached by the NodeRegistry when the agent is registered
+        self.node = node
         self.num_executors = num_executors
         self._busy_executors = busy_executors
 
-        self._time_last_job_finished = time.time()
+        self._time_last_job_finished = clock.now() if time_last_job_finished is None else time_last_job_finished
 
     def __repr__(self):
         return (f"<{self.__class__.__name__} {self.name}; labels={self.labels}; "
@@ -152,11 +320,11 @@ class JenkinsAgent:
     async def is_available(self):
         return self.node is not None and await self.node.is_available()
 
-    async def wakeup(self) -> bool:
+    async def wakeup(self, sender: WakeOnLan, timeout: float = 120) -> bool:
         if self.node is None:
             LOGGER.info(f'Cannot wake up {self.name} - I have no known node')
             return False
-        return await self.node.wakeup()
+        return await self.node.wakeup(sender, timeout)
 
     @property
     def time_last_job_finished(self):
@@ -164,11 +332,11 @@ class JenkinsAgent:
             return 0
         return self._time_last_job_finished
 
-    async def shutdown(self, admin_config: SSHConfig, force: bool = False):
+    async def shutdown(self, admin_config: SSHConfig, force: bool = False) -> bool:
         if self.node is None:
             LOGGER.info(f'Cannot shut down {self.name} - I have no known node')
-            return
-        await self.node.shutdown(admin_config, force)
+            return False
+        return await self.node.shutdown(admin_config, force)
 
     @property
     def busy_executors(self):
@@ -178,7 +346,7 @@ class JenkinsAgent:
     def busy_executors(self, value):
         if self._busy_executors > 0 or value > 0:
             LOGGER.info(f"{self.name} is, or very recently was, busy.")
-            self._time_last_job_finished = time.time()
+            self._time_last_job_finished = clock.now()
         self._busy_executors = value
 
     @property
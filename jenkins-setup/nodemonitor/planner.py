@@ -0,0 +1,260 @@
+""" Decides which nodes need to be woken up to run the queued jobs
+
+Every queued job needs one executor on an agent that matches what it is waiting for (a label
+expression, or one of a list of agents). Jobs are first assigned to free executors on nodes
+that are already up. The jobs that are left over are assigned to the agents of powered-off
+nodes. Which ones depends on the wake policy:
+
+- priority (the default) tries nodes in node_priority order, so the nodes that get woken are
+  the fewest (highest priority) ones that cover the demand.
+- power wakes the nodes that cover the demand with the fewest watts. This is a weighted set
+  cover, solved greedily: each step wakes the node that starts the most jobs per watt, unless a
+  single node that can start all of the remaining jobs costs less than the rest of the greedy cover.
+- drain gets every job started as soon as possible. The queue drains once the slowest woken node
+  is up, so this finds the shortest boot time within which nodes can still cover as much of the
+  queue as any nodes could, then wakes the fewest nodes (quickest to boot first) within it.
+
+Ties are broken by node_priority.
+"""
+import logging
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .jenkins import QueuedJob
+from .nodes import JenkinsAgent, Node
+from .registry import NodeRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+WAKE_POLICIES = ("priority", "power", "drain")
+# Assumed for nodes without a power rating or boot time
+DEFAULT_POWER = 200
+DEFAULT_BOOT_TIME = 60
+
+_label_tokens = re.compile(r'\s*(&&|\|\||!|\(|\)|[^&|!()]+)')
+_label_operators = re.compile(r'[&|!()]')
+
+
+def label_matches(expression: str, labels: Iterable[str]) -> bool:
+    """ Evaluates a Jenkins label expression (supporting &&, ||, ! and parentheses) against labels """
+    labels = set(labels)
+    tokens = [token.strip() for token in _label_tokens.findall(expression) if token.strip()]
+    position = 0
+
+    def peek() -> Optional[str]:
+        return tokens[position] if position < len(tokens) else None
+
+    def take() -> str:
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or() -> bool:
+        value = parse_and()
+        while peek() == '||':
+            take()
+            value = parse_and() or value
+        return value
+
+    def parse_and() -> bool:
+        value = parse_not()
+        while peek() == '&&':
+            take()
+            value = parse_not() and value
+        return value
+
+    def parse_not() -> bool:
+        if peek() == '!':
+            take()
+            return not parse_not()
+        if peek() == '(':
+            take()
+            value = parse_or()
+            if peek() == ')':
+                take()
+            return value
+        token = take() if peek() is not None else ''
+        return token.strip('"') in labels
+
+    return parse_or()
+
+
+def job_matches(job: QueuedJob, agent: JenkinsAgent) -> bool:
+    """ Whether agent can run job. Jobs with an unknown wait reason can run anywhere """
+    if job.waiting_for is None:
+        return True
+    if 'nodes' in job.waiting_for:
+        return agent.name in job.waiting_for['nodes']
+    return label_matches(job.waiting_for['label'], list(agent.labels) + [agent.name])
+
+
+def candidate_agents(job: QueuedJob, registry: NodeRegistry) -> List[JenkinsAgent]:
+    """ The agents on known nodes that can run job, looked up in the registry's label index when possible """
+    if job.waiting_for is None:
+        return registry.agents
+    if 'nodes' in job.waiting_for:
+        agents = [agent for name in job.waiting_for['nodes'] for agent in registry.agents_with_label(name)
+                  if agent.name == name]
+    elif _label_operators.search(job.waiting_for['label']) is None:
+        agents = registry.agents_with_label(job.waiting_for['label'].strip())
+    else:
+        agents = [agent for agent in registry.agents if job_matches(job, agent)]
+    return [agent for agent in agents if agent.node is not None]
+
+
+def priority_order(nodes: Iterable[Node], registry: NodeRegistry, node_priority: List[str]) -> List[Node]:
+    """ Sorts nodes by the best node_priority rank of any of their agents; unranked nodes go last """
+    rank = {name: index for index, name in enumerate(node_priority)}
+
+    def node_rank(node: Node):
+        ranks = [rank[name] for name in node.agent_names if name in rank]
+        return (min(ranks) if ranks else len(rank), node.name)
+
+    return sorted(nodes, key=node_rank)
+
+
+def node_power(node: Node) -> float:
+    """ Watts the node draws while it is on """
+    return DEFAULT_POWER if node.power is None else node.power
+
+
+def node_boot_time(node: Node) -> float:
+    """ Seconds the node is configured to take to boot """
+    return DEFAULT_BOOT_TIME if node.boot_time is None else node.boot_time
+
+
+def plan_wakeups(queue: Sequence[QueuedJob],
+                 registry: NodeRegistry,
+                 availability: Dict[Node, bool],
+                 node_priority: List[str],
+                 policy: str = "priority",
+                 boot_time: Optional[Callable[[Node], float]] = None) -> List[Node]:
+    """ Returns the nodes to wake up to give every queued job an executor
+
+    The nodes are in priority order for the priority policy and in the order they were picked
+    otherwise. boot_time estimates how long a node takes to boot (the node's configured boot_time
+    by default), which is what the drain policy minimizes
+    """
+    if policy not in WAKE_POLICIES:
+        raise ValueError(f"Unknown wake policy {policy!r}. Pick one of {', '.join(WAKE_POLICIES)}")
+    agents = registry.agents
+    # Free executors on every agent, whether its node is up or would have to be woken up
+    free = {agent: max(agent.num_executors - agent.busy_executors, 0) for agent in agents}
+    # Nodes with a capacity can run at most that many jobs at once across all of their agents
+    node_free = {node: node.capacity - sum(agent.busy_executors for agent in registry.agents_on(node))
+                 for node in registry if node.capacity is not None}
+    # Many jobs wait for the same thing, so only look up the candidates once per wait reason
+    candidates_by_reason = dict()
+    candidates_by_node = dict()
+
+    def candidates(job: QueuedJob) -> List[JenkinsAgent]:
+        key = repr(job.waiting_for)
+        if key not in candidates_by_reason:
+            candidates_by_reason[key] = candidate_agents(job, registry)
+        return candidates_by_reason[key]
+
+    def candidates_on(job: QueuedJob, node: Node) -> List[JenkinsAgent]:
+        key = repr(job.waiting_for)
+        if key not in candidates_by_node:
+            by_node = candidates_by_node[key] = dict()
+            for agent in candidates(job):
+                by_node.setdefault(agent.node, []).append(agent)
+        return candidates_by_node[key].get(node, [])
+
+    def assign(job: QueuedJob, usable) -> bool:
+        for agent in candidates(job):
+            if usable(agent.node) and free[agent] > 0 and node_free.get(agent.node, 1) > 0:
+                free[agent] -= 1
+                if agent.node in node_free:
+                    node_free[agent.node] -= 1
+                return True
+        return False
+
+    def starts(node: Node, jobs: List[QueuedJob]) -> int:
+        """ How many of jobs waking node would start, without assigning them """
+        spare = {agent: free[agent] for agent in registry.agents_on(node)}
+        room = node_free.get(node)
+        started = 0
+        for job in jobs:
+            if room is not None and started >= room:
+                break
+            for agent in candidates_on(job, node):
+                if spare.get(agent, 0) > 0:
+                    spare[agent] -= 1
+                    started += 1
+                    break
+        return started
+
+    def cover(nodes: List[Node], cost: Callable[[Node], float], tie_break: Callable[[Node], tuple],
+              jobs: List[QueuedJob], lookahead: bool = True) -> Tuple[List[Node], List[QueuedJob]]:
+        """ Greedy weighted set cover: keeps waking the node that starts the most jobs per unit of cost
+
+        Cheap, small nodes look best per job, so whenever a single node could start every remaining
+        job, the rest of the greedy cover is worked out first and the single node wins if it is cheaper
+        """
+        chosen = []
+        remaining = list(nodes)
+        while jobs and remaining:
+            gains = {node: starts(node, jobs) for node in remaining}
+            remaining = [node for node in remaining if gains[node] > 0]
+            if not remaining:
+                break
+            best = min(remaining, key=lambda node: (-gains[node] / cost(node), tie_break(node)))
+            finishers = [node for node in remaining if gains[node] == len(jobs)]
+            if lookahead and finishers:
+                finisher = min(finishers, key=lambda node: (cost(node), tie_break(node)))
+                if finisher is not best:
+                    executors = dict(free), dict(node_free)
+                    rest, left = cover(remaining, cost, tie_break, jobs, lookahead=False)
+                    free.update(executors[0])
+                    node_free.update(executors[1])
+                    if left or cost(finisher) <= sum(cost(node) for node in rest):
+                        best = finisher
+            jobs = [job for job in jobs if not assign(job, lambda candidate: candidate is best)]
+            chosen.append(best)
+            remaining.remove(best)
+        return chosen, jobs
+
+    # Oldest jobs get first pick of executors that are already available
+    pending = sorted(queue, key=lambda job: job.queued_since)
+    unmet = [job for job in pending if not assign(job, lambda node: availability.get(node, False))]
+    if not unmet:
+        return []
+
+    powered_off = {agent.node: None for job in unmet for agent in candidates(job)
+                   if not availability.get(agent.node, False)}
+    ordered = priority_order(powered_off, registry, node_priority)
+    to_wake = []
+    if policy == "priority":
+        for node in ordered:
+            still_unmet = [job for job in unmet if not assign(job, lambda candidate: candidate is node)]
+            if len(still_unmet) < len(unmet):
+                to_wake.append(node)
+            unmet = still_unmet
+            if not unmet:
+                break
+    elif policy == "power":
+        rank = {node: (index,) for index, node in enumerate(ordered)}
+        to_wake, unmet = cover(ordered, lambda node: max(node_power(node), 1), rank.get, unmet)
+    else:
+        seconds = {node: node_boot_time(node) if boot_time is None else boot_time(node) for node in ordered}
+        rank = {node: (seconds[node], index) for index, node in enumerate(ordered)}
+        executors = dict(free), dict(node_free)
+
+        def trial(nodes: List[Node]) -> Tuple[List[Node], List[QueuedJob]]:
+            free.update(executors[0])
+            node_free.update(executors[1])
+            return cover(nodes, lambda node: 1, rank.get, unmet)
+
+        # Picking from every node that could help covers as much of the queue as can be covered
+        best = trial(ordered)
+        for limit in sorted(set(seconds.values()))[:-1]:
+            chosen, left = trial([node for node in ordered if seconds[node] <= limit])
+            if len(left) <= len(best[1]):
+                best = chosen, left
+                break
+        to_wake, unmet = best
+
+    for job in unmet:
+        LOGGER.warning(f"No known node can run {job}")
+    return to_wake
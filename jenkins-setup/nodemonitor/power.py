@@ -0,0 +1,303 @@
+""" Backends that switch nodes on and off, chosen per node in the config
+
+- wol (the default): wake-on-lan packets to switch on, `sudo shutdown now` over SSH to switch off.
+  It cannot tell whether a node has power, so the node monitor goes by its SSH port.
+- ipmi: the BMC's chassis power commands, through ipmitool (or anything that takes its arguments).
+- redfish: the BMC's Redfish API (ComputerSystem.Reset and PowerState) over HTTPS.
+- pdu: the node's outlet on a switched PDU, over SNMP with net-snmp's snmpget and snmpset. The
+  node's BIOS must power it on when the outlet does. It is shut down over SSH first, and the outlet
+  is switched off once the shutdown_timeout has passed.
+
+Backends that report the power state let the node monitor confirm a wakeup within seconds, power
+cycle a node that is on but never answers, and force off one that hangs while shutting down.
+"""
+import abc
+import asyncio
+import enum
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+import aiohttp
+import asyncssh
+
+from .wol import WakeOnLan
+
+if TYPE_CHECKING:
+    from .nodes import Node, SSHConfig
+
+LOGGER = logging.getLogger(__name__)
+
+POWER_BACKENDS = ("wol", "ipmi", "redfish", "pdu")
+
+# The APC PowerNet MIB's sPDUOutletCtl: 1 is on, 2 is off and 3 reboots the outlet
+APC_OUTLET_CONTROL = ".1.3.6.1.4.1.318.1.1.4.4.2.1.3"
+
+
+class PowerState(enum.Enum):
+    On = "On"
+    Off = "Off"
+
+
+class PowerError(OSError):
+    """ A power command failed """
+
+
+class PowerBackend(abc.ABC):
+    """ Switches a node on and off. Unless a backend knows better, nodes are shut down over SSH
+
+    Backends are dataclasses, so two with the same settings compare equal (and a reloaded config
+    only swaps a node's backend when its settings changed).
+    """
+
+    name = ""
+    # Whether power_state tells anything, and how long to wait for it to change before giving up
+    reports_state = False
+    confirm_timeout: float = 15
+    shutdown_timeout: float = 120
+    poll_interval: float = 1
+    # Whether the power stays on after the operating system shut down, so it is always cut
+    cuts_power_after_shutdown = False
+
+    @abc.abstractmethod
+    async def power_on(self, node: "Node", sender: WakeOnLan):
+        """ Switches the node on """
+
+    async def shutdown(self, node: "Node", admin_config: "SSHConfig"):
+        """ Asks the operating system to shut down """
+        try:
+            await node.run_ssh_command(admin_config, "sudo shutdown now", retry=False)
+        except asyncssh.misc.ConnectionLost:
+            LOGGER.info(f"Connection lost while shutting down {node.name}")
+
+    async def power_off(self, node: "Node") -> bool:
+        """ Cuts the power. Returns False if the backend cannot """
+        return False
+
+    async def power_cycle(self, node: "Node") -> bool:
+        """ Resets a node that hangs. Returns False if the backend cannot """
+        return False
+
+    async def power_state(self, node: "Node") -> Optional[PowerState]:
+        """ Whether the node has power; None if the backend cannot tell (or could not reach the BMC) """
+        return None
+
+    async def wait_for_state(self, node: "Node", state: PowerState, timeout: float) -> bool:
+        """ Waits until the node's power state is state. Always True if the backend cannot tell """
+        if not self.reports_state:
+            return True
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while await self.power_state(node) is not state:
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(min(self.poll_interval, max(deadline - loop.time(), 0)))
+        return True
+
+
+@dataclass(eq=True)
+class WakeOnLanPower(PowerBackend):
+    """ Magic packets to the node's MAC address """
+
+    name = "wol"
+
+    async def power_on(self, node: "Node", sender: WakeOnLan):
+        await sender.send(node.mac_address, node.broadcast_address)
+
+
+class _CommandBackend(PowerBackend):
+    """ Runs a command line tool for each power command """
+
+    timeout: float = 10
+
+    async def _run(self, *args: str, env: Optional[dict] = None) -> str:
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE, env=env)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise PowerError(f"{args[0]} did not finish within {self.timeout} seconds")
+        if process.returncode:
+            raise PowerError(f"{args[0]} failed ({process.returncode}): {stderr.decode(errors='replace').strip()}")
+        return stdout.decode(errors="replace")
+
+    async def power_state(self, node: "Node") -> Optional[PowerState]:
+        try:
+            return await self._power_state()
+        except OSError as err:
+            LOGGER.warning(f"Could not get the power state of {node.name}: {err}")
+            return None
+
+    @abc.abstractmethod
+    async def _power_state(self) -> Optional[PowerState]:
+        """ Runs the command that reports the power state """
+
+
+@dataclass(eq=True)
+class IPMIPower(_CommandBackend):
+    """ Chassis power commands to the node's BMC with ipmitool """
+
+    host: str
+    username: str
+    password: str = field(repr=False)
+    interface: str = "lanplus"
+    command: str = "ipmitool"
+
+    name = "ipmi"
+    reports_state = True
+
+    async def _chassis_power(self, action: str) -> str:
+        # The password goes through the environment (-E), so it does not show up in ps
+        return await self._run(self.command, "-I", self.interface, "-H", self.host, "-U", self.username, "-E",
+                               "chassis", "power", action, env=dict(os.environ, IPMI_PASSWORD=self.password))
+
+    async def power_on(self, node: "Node", sender: WakeOnLan):
+        await self._chassis_power("on")
+
+    async def shutdown(self, node: "Node", admin_config: "SSHConfig"):
+        # An ACPI power button press
+        await self._chassis_power("soft")
+
+    async def power_off(self, node: "Node") -> bool:
+        await self._chassis_power("off")
+        return True
+
+    async def power_cycle(self, node: "Node") -> bool:
+        await self._chassis_power("reset")
+        return True
+
+    async def _power_state(self) -> Optional[PowerState]:
+        # "Chassis Power is on"
+        output = (await self._chassis_power("status")).strip().lower()
+        if output.endswith(" on"):
+            return PowerState.On
+        if output.endswith(" off"):
+            return PowerState.Off
+        return None
+
+
+@dataclass(eq=True)
+class RedfishPower(PowerBackend):
+    """ The ComputerSystem.Reset action and PowerState property of the node's Redfish service """
+
+    url: str
+    username: str
+    password: str = field(repr=False)
+    system: str = "/redfish/v1/Systems/1"
+    verify_ssl: bool = True
+    timeout: float = 10
+
+    name = "redfish"
+    reports_state = True
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        # Power commands are rare, so there is no session to keep open between them
+        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.username, self.password),
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            try:
+                async with session.request(method, f"{self.url.rstrip('/')}{path}",
+                                           ssl=None if self.verify_ssl else False, **kwargs) as resp:
+                    if resp.status >= 400:
+                        raise PowerError(f"{method} {path} failed - {resp.status} [{await resp.text()}]")
+                    if resp.content_type == "application/json":
+                        return await resp.json()
+                    return dict()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                raise PowerError(f"{method} {path} failed: {err!r}") from err
+
+    async def _reset(self, reset_type: str):
+        await self._request("POST", f"{self.system}/Actions/ComputerSystem.Reset", json=dict(ResetType=reset_type))
+
+    async def power_on(self, node: "Node", sender: WakeOnLan):
+        await self._reset("On")
+
+    async def shutdown(self, node: "Node", admin_config: "SSHConfig"):
+        await self._reset("GracefulShutdown")
+
+    async def power_off(self, node: "Node") -> bool:
+        await self._reset("ForceOff")
+        return True
+
+    async def power_cycle(self, node: "Node") -> bool:
+        await self._reset("ForceRestart")
+        return True
+
+    async def power_state(self, node: "Node") -> Optional[PowerState]:
+        try:
+            system = await self._request("GET", self.system)
+        except PowerError as err:
+            LOGGER.warning(f"Could not get the power state of {node.name}: {err}")
+            return None
+        # PoweringOn and PoweringOff are neither yet
+        return {"On": PowerState.On, "Off": PowerState.Off}.get(system.get("PowerState"))
+
+
+@dataclass(eq=True)
+class PDUPower(_CommandBackend):
+    """ The node's outlet on a switched PDU, over SNMP v2c """
+
+    host: str
+    outlet: int
+    community: str = field(repr=False)
+    oid: str = APC_OUTLET_CONTROL
+    snmpget: str = "snmpget"
+    snmpset: str = "snmpset"
+
+    name = "pdu"
+    reports_state = True
+    cuts_power_after_shutdown = True
+
+    @property
+    def _outlet_oid(self) -> str:
+        return f"{self.oid}.{self.outlet}"
+
+    async def _set(self, value: int):
+        await self._run(self.snmpset, "-v2c", "-c", self.community, self.host, self._outlet_oid, "i", str(value))
+
+    async def power_on(self, node: "Node", sender: WakeOnLan):
+        # An outlet that is still on while the node is known to be down (it shut itself down, or
+        # hangs) has to be cycled to boot it. One that is on while the node is up, or may still be
+        # booting, is left alone
+        if node.reachability.up is False and await self.power_state(node) is PowerState.On:
+            await self._set(3)
+        else:
+            await self._set(1)
+
+    async def power_off(self, node: "Node") -> bool:
+        await self._set(2)
+        return True
+
+    async def power_cycle(self, node: "Node") -> bool:
+        await self._set(3)
+        return True
+
+    async def _power_state(self) -> Optional[PowerState]:
+        # "1", or "outletOn(1)" with the MIB loaded
+        output = await self._run(self.snmpget, "-v2c", "-c", self.community, "-Oqv", self.host, self._outlet_oid)
+        values = re.findall(r"\d+", output)
+        return {"1": PowerState.On, "2": PowerState.Off}.get(values[-1] if values else "")
+
+
+def create_power_backend(kind: str = "wol", bmc: Optional[str] = None, bmc_username: Optional[str] = None,
+                         bmc_password: Optional[str] = None, bmc_verify_ssl: bool = True, pdu: Optional[str] = None,
+                         pdu_outlet: Optional[int] = None, pdu_community: Optional[str] = None,
+                         pdu_oid: str = APC_OUTLET_CONTROL) -> PowerBackend:
+    """ The backend a node's config asks for """
+    if kind == "wol":
+        return WakeOnLanPower()
+    if kind in ("ipmi", "redfish"):
+        if not (bmc and bmc_username and bmc_password is not None):
+            raise ValueError(f"The {kind} power backend needs bmc, bmc_username and bmc_password")
+        if kind == "ipmi":
+            return IPMIPower(bmc, bmc_username, bmc_password)
+        return RedfishPower(bmc if "://" in bmc else f"https://{bmc}", bmc_username, bmc_password,
+                            verify_ssl=bmc_verify_ssl)
+    if kind == "pdu":
+        if not (pdu and pdu_outlet is not None and pdu_community is not None):
+            raise ValueError("The pdu power backend needs pdu, pdu_outlet and pdu_community")
+        return PDUPower(pdu, pdu_outlet, pdu_community, oid=pdu_oid)
+    raise ValueError(f"Unknown power backend {kind}; choose from {', '.join(POWER_BACKENDS)}")
@@ -0,0 +1,165 @@
+""" Predicts load and boot times from the HistoryStore
+
+Job arrivals are bucketed by hour of the week (Monday 00:00-01:00 local time is bucket 0), and
+the rate for each bucket is an exponentially weighted average over the past weeks, so recent
+weeks count the most. From those rates the predictor
+
+- picks powered-off nodes to pre-warm when jobs are expected within the lead time (the start
+  of working hours, say), and
+- picks a per-node shutdown threshold: long enough to cover the usual gap between jobs on that
+  node and never shorter than a couple of boots. When load is expected in the next hour it is
+  never shorter than the configured default, and otherwise never longer.
+
+Outside of busy hours the expected arrival rate is ~0, so nothing is pre-warmed and idle nodes
+shut down after their usual gap, or the default, whichever is sooner.
+"""
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+from . import clock
+from .analytics import quantile
+from .history import HistoryStore
+from .nodes import Node
+from .planner import priority_order
+from .registry import NodeRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+HOURS_PER_WEEK = 7 * 24
+SECONDS_PER_WEEK = HOURS_PER_WEEK * 3600
+
+
+def hour_of_week(when: float) -> int:
+    local = time.localtime(when)
+    return local.tm_wday * 24 + local.tm_hour
+
+
+class LoadPredictor:
+
+    def __init__(self, history: HistoryStore, half_life_weeks: float = 2, lead_time: float = 1800,
+                 prewarm_threshold: float = 1, max_prewarm_nodes: int = 2, shutdown_quantile: float = 0.75,
+                 min_idle_gaps: int = 5, default_boot_time: float = 60):
+        self.history = history
+        self.half_life_weeks = half_life_weeks
+        # How far ahead (seconds) to look for expected jobs when pre-warming
+        self.lead_time = lead_time
+        # Expected jobs within lead_time (or per hour, for shutdowns) that count as "load"
+        self.prewarm_threshold = prewarm_threshold
+        self.max_prewarm_nodes = max_prewarm_nodes
+        self.shutdown_quantile = shutdown_quantile
+        self.min_idle_gaps = min_idle_gaps
+        self.default_boot_time = default_boot_time
+        self._rates: List[float] = [0.0] * HOURS_PER_WEEK
+        self._rates_computed_for = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; lead time {self.lead_time} s; {self.history!r}>"
+
+    def hourly_rates(self, now: Optional[float] = None) -> List[float]:
+        """ Expected jobs per hour for each hour of the week. Cached until the hour or the history changes """
+        now = clock.now() if now is None else now
+        key = (int(now // 3600), len(self.history.arrivals))
+        if key == self._rates_computed_for:
+            return self._rates
+        decay = math.log(2) / (self.half_life_weeks * SECONDS_PER_WEEK)
+        # Only complete hours count; the current one is still filling up
+        hour_start = now - now % 3600
+        counts = [0.0] * HOURS_PER_WEEK
+        oldest = hour_start
+        for arrival in self.history.arrivals:
+            if arrival < hour_start:
+                oldest = min(oldest, arrival)
+                counts[hour_of_week(arrival)] += math.exp(-decay * (now - arrival))
+        # Divide by the weights of the occurrences of each hour that the history covers
+        current = hour_of_week(now)
+        rates = []
+        for bucket, count in enumerate(counts):
+            age = ((current - bucket) % HOURS_PER_WEEK or HOURS_PER_WEEK) * 3600
+            observed = 0.0
+            while hour_start - age + 3600 > oldest:
+                observed += math.exp(-decay * (now - hour_start + age - 1800))
+                age += SECONDS_PER_WEEK
+            rates.append(count / observed if observed else 0.0)
+        self._rates = rates
+        self._rates_computed_for = key
+        return self._rates
+
+    def expected_arrivals(self, start: float, duration: float) -> float:
+        """ Expected number of jobs queued between start and start + duration """
+        rates = self.hourly_rates(start)
+        expected = 0.0
+        position, end = start, start + duration
+        while position < end:
+            step = min(end, (position // 3600 + 1) * 3600) - position
+            expected += rates[hour_of_week(position)] * step / 3600
+            position += step
+        return expected
+
+    def boot_time(self, node: Node) -> float:
+        """ Exponentially smoothed boot duration of the node """
+        estimate = None
+        for seconds in self.history.boots.get(node.name, ()):
+            estimate = seconds if estimate is None else 0.3 * seconds + 0.7 * estimate
+        if estimate is not None:
+            return estimate
+        return self.default_boot_time if node.boot_time is None else node.boot_time
+
+    def nodes_to_prewarm(self, registry: NodeRegistry, availability: Dict[Node, bool], node_priority: List[str],
+                         now: Optional[float] = None) -> List[Node]:
+        """ Powered-off nodes (in priority order) to boot now for the jobs expected within lead_time """
+        now = clock.now() if now is None else now
+        expected = self.expected_arrivals(now, self.lead_time)
+        if expected < self.prewarm_threshold:
+            return []
+        warm_executors = sum(self._executors(registry, node) for node, available in availability.items() if available)
+        to_wake = []
+        for node in priority_order([node for node, available in availability.items() if not available],
+                                   registry, node_priority):
+            if warm_executors >= expected or len(to_wake) >= self.max_prewarm_nodes:
+                break
+            to_wake.append(node)
+            warm_executors += self._executors(registry, node)
+        if to_wake:
+            LOGGER.info(f"Expecting {expected:.1f} jobs in the next {self.lead_time} seconds. Pre-warming "
+                        f"{', '.join(node.name for node in to_wake)}")
+        return to_wake
+
+    def nodes_to_keep_warm(self, registry: NodeRegistry, availability: Dict[Node, bool], node_priority: List[str],
+                           now: Optional[float] = None) -> List[Node]:
+        """ Available nodes (in priority order) whose executors the jobs expected within lead_time need
+
+        These are the nodes nodes_to_prewarm counts as warm, so shutting them down would only have them
+        pre-warmed again
+        """
+        now = clock.now() if now is None else now
+        expected = self.expected_arrivals(now, self.lead_time)
+        if expected < self.prewarm_threshold:
+            return []
+        to_keep = []
+        warm_executors = 0
+        for node in priority_order([node for node, available in availability.items() if available],
+                                   registry, node_priority):
+            if warm_executors >= expected:
+                break
+            to_keep.append(node)
+            warm_executors += self._executors(registry, node)
+        return to_keep
+
+    def shutdown_threshold(self, node: Node, default: float, now: Optional[float] = None) -> float:
+        """ Seconds the node must be idle before it is shut down """
+        now = clock.now() if now is None else now
+        gaps = self.history.idle_gaps.get(node.name, ())
+        if len(gaps) < self.min_idle_gaps:
+            return default
+        # Rebooting costs a boot's worth of waiting, so it is not worth it for shorter gaps than that
+        threshold = max(quantile(gaps, self.shutdown_quantile), 2 * self.boot_time(node))
+        if self.expected_arrivals(now, 3600) >= self.prewarm_threshold:
+            return max(threshold, default)
+        return min(threshold, default)
+
+    @staticmethod
+    def _executors(registry: NodeRegistry, node: Node) -> int:
+        executors = sum(agent.num_executors for agent in registry.agents_on(node))
+        return executors if node.capacity is None else min(executors, node.capacity)
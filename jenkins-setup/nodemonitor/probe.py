@@ -0,0 +1,237 @@
+""" Checks whether nodes are reachable, hundreds at a time, with raw non-blocking sockets
+
+A probe is a bare TCP connect to the node's SSH port: a non-blocking socket is registered with
+the event loop until it becomes writable (connected, or refused) and closed right away, with no
+streams or transports involved. Probes asked for in the same event loop iteration go out
+together and share one deadline, so a fleet that is mostly switched off costs a single timeout
+rather than one per node. Results are cached for ttl seconds, so the several checks a
+scheduling cycle makes of the same node only connect once.
+
+A single probe can be lost (a dropped SYN, a busy sshd), so ReachabilityHistory only believes a
+node changed state after a few probes in a row agree.
+"""
+import asyncio
+import errno
+import logging
+import socket
+from typing import Dict, List, Optional, Set, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+Address = Tuple[str, int]
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class _Probe:
+
+    __slots__ = ("address", "future", "sock")
+
+    def __init__(self, address: Address, future: asyncio.Future):
+        self.address = address
+        self.future = future
+        self.sock: Optional[socket.socket] = None
+
+
+class Prober:
+
+    def __init__(self, timeout: float = 3, ttl: float = 2, max_sockets: int = 1024):
+        # Seconds a probe waits for the connection before the node counts as unreachable
+        self.timeout = timeout
+        # Seconds a result is reused for
+        self.ttl = ttl
+        # Probes open at once; the rest wait for the next batch
+        self.max_sockets = max_sockets
+        # address -> (loop time, reachable) of the last probe
+        self._cache: Dict[Address, Tuple[float, bool]] = dict()
+        self._in_flight: Dict[Address, asyncio.Future] = dict()
+        # Probes waiting to go out, by timeout
+        self._waiting: Dict[float, List[_Probe]] = dict()
+        # Probes with an open socket
+        self._connecting: Set[_Probe] = set()
+        self._scheduled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}; timeout={self.timeout}; ttl={self.ttl}; "
+                f"{len(self._connecting)} connecting; {len(self._cache)} cached>")
+
+    def clear(self):
+        """ Forgets every cached result """
+        self._cache.clear()
+
+    def forget(self, host: str, port: int):
+        """ Forgets the cached result for host and port (e.g., once it was told to shut down) """
+        self._cache.pop((host, port), None)
+
+    def _use_loop(self, loop: asyncio.AbstractEventLoop):
+        """ Drops whatever was left over from another event loop (each asyncio.run has its own) """
+        if loop is self._loop:
+            return
+        for probe in self._connecting:
+            probe.sock.close()
+        self._connecting.clear()
+        self._in_flight.clear()
+        self._waiting.clear()
+        self._cache.clear()
+        self._scheduled = False
+        self._loop = loop
+
+    def cached(self, address: Address, max_age: Optional[float] = None) -> Optional[Tuple[float, bool]]:
+        """ The (loop time, reachable) of the last probe of address, if it is at most max_age (or ttl) seconds old """
+        result = self._cache.get(address)
+        max_age = self.ttl if max_age is None else max_age
+        if result is None or asyncio.get_event_loop().time() - result[0] > max_age:
+            return None
+        return result
+
+    async def probe(self, host: str, port: int, timeout: Optional[float] = None,
+                    max_age: Optional[float] = None) -> Tuple[float, bool]:
+        """ Whether host accepts connections on port. Returns (loop time of the probe, reachable) """
+        address = (host, port)
+        self._use_loop(asyncio.get_event_loop())
+        result = self.cached(address, max_age)
+        if result is not None:
+            return result
+        future = self._in_flight.get(address)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self._in_flight[address] = loop.create_future()
+            self._waiting.setdefault(self.timeout if timeout is None else timeout, []).append(_Probe(address, future))
+            if not self._scheduled:
+                # Everything asked for before the loop gets back to this goes out in one batch
+                self._scheduled = True
+                loop.call_soon(self._start)
+        # Shielded, so one caller giving up does not cancel the probe for everyone else
+        return await asyncio.shield(future)
+
+    def _start(self):
+        self._scheduled = False
+        loop = asyncio.get_event_loop()
+        for timeout in list(self._waiting):
+            probes = self._waiting[timeout]
+            batch = probes[:max(self.max_sockets - len(self._connecting), 0)]
+            if not batch:
+                continue
+            del probes[:len(batch)]
+            if not probes:
+                del self._waiting[timeout]
+            pending = set()
+            for probe in batch:
+                if self._connect(loop, probe):
+                    pending.add(probe)
+            if pending:
+                deadline = loop.call_later(timeout, self._expire, pending)
+                for probe in pending:
+                    loop.add_writer(probe.sock.fileno(), self._connected, probe, pending, deadline)
+
+    def _connect(self, loop: asyncio.AbstractEventLoop, probe: _Probe) -> bool:
+        """ Starts connecting. Returns whether the probe is pending, or False if it finished right away """
+        host, port = probe.address
+        try:
+            family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                                           flags=socket.AI_NUMERICHOST)[0]
+        except socket.gaierror:
+            # Host names are resolved off the event loop, then probed in a batch of their own
+            asyncio.ensure_future(self._resolve(probe))
+            return False
+        try:
+            probe.sock = socket.socket(family, socket.SOCK_STREAM)
+        except OSError as err:
+            LOGGER.warning(f"Could not open a socket to probe {host}:{port}: {err}")
+            self._finish(probe, False)
+            return False
+        self._connecting.add(probe)
+        probe.sock.setblocking(False)
+        status = probe.sock.connect_ex(sockaddr)
+        if status in _IN_PROGRESS:
+            return True
+        self._finish(probe, status == 0)
+        return False
+
+    async def _resolve(self, probe: _Probe):
+        host, port = probe.address
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as err:
+            LOGGER.info(f"Could not resolve {host}: {err}")
+            self._finish(probe, False)
+            return
+        # Probed under the numeric address, and reported under the name it was asked for
+        _, reachable = await self.probe(infos[0][4][0], port, max_age=0)
+        self._finish(probe, reachable)
+
+    def _connected(self, probe: _Probe, pending: set, deadline: asyncio.Handle):
+        error = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        pending.discard(probe)
+        if not pending:
+            deadline.cancel()
+        self._finish(probe, error == 0)
+
+    def _expire(self, pending: set):
+        for probe in pending:
+            self._finish(probe, False)
+        pending.clear()
+
+    def _finish(self, probe: _Probe, reachable: bool):
+        loop = asyncio.get_event_loop()
+        if probe.sock is not None:
+            loop.remove_writer(probe.sock.fileno())
+            probe.sock.close()
+            probe.sock = None
+            self._connecting.discard(probe)
+        result = self._cache[probe.address] = (loop.time(), reachable)
+        self._in_flight.pop(probe.address, None)
+        if not probe.future.done():
+            probe.future.set_result(result)
+        if self._waiting and not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._start)
+
+
+PROBER = Prober()
+
+
+class ReachabilityHistory:
+    """ Whether a node is up, going by the last few probes
+
+    The state only changes after up_after probes in a row say it is up, or down_after in a row say
+    it is down. Until the first probe the state is unknown (None), and the first probe decides it.
+    """
+
+    __slots__ = ("up", "up_after", "down_after", "_streak", "_last_probe")
+
+    def __init__(self, up_after: int = 2, down_after: int = 2):
+        self.up: Optional[bool] = None
+        self.up_after = up_after
+        self.down_after = down_after
+        # Probes in a row that disagree with the current state
+        self._streak = 0
+        self._last_probe: Optional[float] = None
+
+    def __repr__(self):
+        state = "unknown" if self.up is None else ("up" if self.up else "down")
+        return f"<{self.__class__.__name__} {state}; {self._streak} probes disagree>"
+
+    def observe(self, reachable: bool, probed_at: Optional[float] = None) -> bool:
+        """ Counts a probe (once, however many callers share its result). Returns whether the state changed """
+        if probed_at is not None:
+            if probed_at == self._last_probe:
+                return False
+            self._last_probe = probed_at
+        if self.up is None:
+            self.up = reachable
+            return True
+        if reachable == self.up:
+            self._streak = 0
+            return False
+        self._streak += 1
+        if self._streak < (self.up_after if reachable else self.down_after):
+            return False
+        self.set(reachable)
+        return True
+
+    def set(self, up: bool):
+        """ Sets the state outright, when it is known for sure (the node just booted or was shut down) """
+        self.up = up
+        self._streak = 0
@@ -0,0 +1,89 @@
+""" Registry of the physical nodes and of the Jenkins agents that run on them
+
+A physical node can back several Jenkins agents (e.g., "Supergirl" and "Supergirl-cuda" are
+the same machine). The registry is built from the [NODE ...] sections of the configuration
+and indexes agents by name, by physical node and by label, so the scheduler never has to
+scan every agent to answer "which node is this agent on?" or "who can run label X?".
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from .nodes import JenkinsAgent, Node
+
+if TYPE_CHECKING:
+    from .config import NodeConfig
+
+
+class NodeRegistry:
+
+    __slots__ = ("_nodes", "_node_by_agent_name", "_agents_by_node", "_agents_by_label")
+
+    def __init__(self, nodes: Iterable[Node] = ()):
+        self._nodes: Dict[str, Node] = dict()
+        self._node_by_agent_name: Dict[str, Node] = dict()
+        # Dicts with None values are used as insertion-ordered sets
+        self._agents_by_node: Dict[Node, Dict[JenkinsAgent, None]] = dict()
+        self._agents_by_label: Dict[str, Dict[JenkinsAgent, None]] = dict()
+        for node in nodes:
+            self.add_node(node)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {len(self._nodes)} nodes; {len(self.agents)} agents>"
+
+    @classmethod
+    def from_config(cls, node_configs: Iterable[NodeConfig]) -> NodeRegistry:
+        return cls(node_config.create_node() for node_config in node_configs)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes.values())
+
+    def add_node(self, node: Node):
+        if node.name in self._nodes:
+            raise ValueError(f"Node {node.name} is already registered")
+        for agent_name in node.agent_names:
+            if agent_name in self._node_by_agent_name:
+                raise ValueError(f"Agent {agent_name} is already assigned to "
+                                 f"{self._node_by_agent_name[agent_name].name}")
+        self._nodes[node.name] = node
+        self._agents_by_node[node] = dict()
+        for agent_name in node.agent_names:
+            self._node_by_agent_name[agent_name] = node
+
+    def node(self, name: str) -> Optional[Node]:
+        """ Looks up a physical node by its name """
+        return self._nodes.get(name)
+
+    def node_for_agent(self, agent_name: str) -> Optional[Node]:
+        """ Looks up the physical node behind an agent (by the agent's name or alias) """
+        return self._node_by_agent_name.get(agent_name)
+
+    def register_agent(self, agent: JenkinsAgent):
+        """ Attaches an agent to its physical node (if known) and indexes it by its labels """
+        agent.node = self.node_for_agent(agent.name)
+        if agent.node is not None:
+            self._agents_by_node[agent.node][agent] = None
+        for label in set(agent.labels) | {agent.name}:
+            self._agents_by_label.setdefault(label, dict())[agent] = None
+
+    def unregister_agent(self, agent: JenkinsAgent):
+        if agent.node is not None:
+            self._agents_by_node[agent.node].pop(agent, None)
+        for label in set(agent.labels) | {agent.name}:
+            self._agents_by_label.get(label, dict()).pop(agent, None)
+
+    @property
+    def agents(self) -> List[JenkinsAgent]:
+        """ Every registered agent that runs on a known node """
+        return [agent for agents in self._agents_by_node.values() for agent in agents]
+
+    def agents_on(self, node: Node) -> List[JenkinsAgent]:
+        """ The agents that run on the given physical node """
+        return list(self._agents_by_node.get(node, ()))
+
+    def agents_with_label(self, label: str) -> List[JenkinsAgent]:
+        """ The agents (on known nodes or not) that carry a label; an agent's name is also its label """
+        return list(self._agents_by_label.get(label, ()))
@@ -0,0 +1,132 @@
+""" Reloads the config file while the node monitor runs
+
+The file is checked for changes every few seconds (and right away on SIGHUP). Decrypted secrets
+and parsed SSH keys are cached, so a reload only does real work for what changed. Scheduler
+settings, polling frequencies, the SSH credentials and the nodes (new ones, and the addresses and
+power backends of existing ones) take effect immediately. Changing the controllers, influx,
+metrics, the state and history files, or a node's aliases still requires a restart, which is logged.
+"""
+import logging
+import os
+import pathlib
+import time
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+from .config import NodemonitorConfiguration
+from .nodes import Node
+from .ssh import PersistentSSHConnection
+
+if TYPE_CHECKING:
+    from .globalstate import GlobalState
+
+LOGGER = logging.getLogger(__name__)
+
+# Settings that are only read when the process starts
+_RESTART_REQUIRED = ("controllers", "influx", "metrics_host", "metrics_port", "state_file", "history_file",
+                     "trace_file", "prewarm_lead_time", "prewarm_threshold", "max_prewarm_nodes")
+
+
+def apply_config(state: "GlobalState", config: NodemonitorConfiguration,
+                 previous: Optional[NodemonitorConfiguration] = None):
+    """ Applies a (re)loaded config to the running state """
+    state.task_config = config.scheduler_config()
+    state.boot_scheduler.reconfigure(config.max_concurrent_boots, config.boot_stagger, config.boot_timeout)
+    state.poll_frequency = config.poll_frequency
+    state.min_poll_frequency = config.min_poll_frequency
+    state.max_poll_frequency = config.max_poll_frequency or 4 * config.poll_frequency
+    state.privileged_ssh_config = config.agent_ssh_config
+
+    for node_config in config.nodes:
+        node = state.registry.node(node_config.name)
+        if node is None:
+            _add_node(state, node_config.create_node())
+        elif list(node.aliases) != node_config.aliases:
+            LOGGER.warning(f"The aliases of {node.name} changed. Restart the node monitor to apply them")
+        else:
+            _update_node(node, node_config.create_node())
+    removed = {node.name for node in state.registry} - {node_config.name for node_config in config.nodes}
+    if removed:
+        LOGGER.warning(f"{', '.join(sorted(removed))} were removed from the config. Restart the node monitor "
+                       f"to stop managing them")
+
+    if previous is not None:
+        for name in _RESTART_REQUIRED:
+            if getattr(config, name) != getattr(previous, name):
+                LOGGER.warning(f"{name} changed. Restart the node monitor to apply it")
+
+
+def _add_node(state: "GlobalState", node: Node):
+    LOGGER.info(f"Adding {node.name} from the reloaded config")
+    for jenkins in state.jenkins_instances:
+        jenkins.registry.add_node(node)
+        # Agents already fetched from Jenkins were not attached to any node so far
+        for agent_name in node.agent_names:
+            agent = jenkins.nodes.get(agent_name)
+            if agent is not None:
+                jenkins.registry.unregister_agent(agent)
+                jenkins.registry.register_agent(agent)
+
+
+def _update_node(node: Node, updated: Node):
+    if (node.local_ip_address, node.port) != (updated.local_ip_address, updated.port):
+        LOGGER.info(f"{node.name} moved to {updated.local_ip_address}:{updated.port}")
+        node.ssh.close()
+        node.ssh = PersistentSSHConnection(updated.local_ip_address, updated.port)
+    node.local_ip_address, node.port = updated.local_ip_address, updated.port
+    node.mac_address, node.broadcast_address = updated.mac_address, updated.broadcast_address
+    node.capacity, node.power, node.boot_time = updated.capacity, updated.power, updated.boot_time
+    if node.power_backend != updated.power_backend:
+        LOGGER.info(f"{node.name} is now powered on and off with {updated.power_backend.name}")
+        node.power_backend = updated.power_backend
+
+
+class ConfigReloader:
+    """ Watches the config file and applies it to the state whenever it changes """
+
+    def __init__(self, path: Union[str, pathlib.Path], config: NodemonitorConfiguration, interval: float = 10):
+        self.path = pathlib.Path(path)
+        # The config that is currently applied
+        self.config = config
+        self.interval = interval
+        self._signature = self._stat()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {self.path}; every {self.interval} seconds>"
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def request(self, state: "GlobalState"):
+        """ Reloads as soon as possible (e.g., on SIGHUP), whether or not the file looks changed """
+        self._signature = None
+        state.request_reload()
+
+    def reload_if_changed(self, state: "GlobalState") -> bool:
+        """ Applies the config file if it changed since it was last applied. Returns whether it did """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        start = time.perf_counter()
+        self._signature = signature
+        try:
+            config = NodemonitorConfiguration.parse_configfile(self.path)
+            apply_config(state, config, self.config)
+        except Exception as err:
+            # E.g., a half-written file or a wrong secret. Keep running, and try again once it changes
+            LOGGER.error(f"Could not reload {self.path}: {err!r}. Keeping the current config")
+            return False
+        self.config = config
+        LOGGER.info(f"Reloaded {self.path} in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return True
+
+    async def watch(self, state: "GlobalState"):
+        """ Checks for changes every interval seconds until the state shuts down """
+        while not state.shutdown:
+            # Woken early by request() and by a shutdown, so it never holds up relaunching the tasks
+            await state.wait_for_reload_request(self.interval)
+            if not state.shutdown:
+                self.reload_if_changed(state)
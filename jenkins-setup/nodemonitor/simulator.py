@@ -0,0 +1,474 @@
+""" Replays a recorded trace through the real scheduling code, faster than real time
+
+The simulator runs tasks.poll_running_jobs and tasks.node_manager unchanged, on a
+VirtualTimeLoop (see clock), against an in-process Jenkins and nodes:
+
+- jobs are queued when the trace says they were, and Jenkins hands each one to the first online
+  agent with a free executor that matches what it waits for; it then runs as long as it did in
+  the recording,
+- a woken node comes up after its boot time, and its agents come online when the node monitor
+  runs the agents-online job,
+- a node that is shut down while running jobs puts them back in the queue (they count as
+  interrupted).
+
+Weeks of a trace replay in seconds, so the idle time before shutdown and the wake policy can be
+tuned offline:
+
+    python -m nodemonitor.simulator trace.jsonl.gz --idle-time-before-shutdown 300 900 1800 \\
+        --wake-policy priority power
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from . import clock, tasks
+from .analytics import quantile
+from .globalstate import GlobalState, SchedulerConfig
+from .history import HistoryStore
+from .influx import InfluxWriter
+from .jenkins import Delta, Jenkins
+from .nodes import DEFAULT_BUSY_POLICY, AgentStatus, JenkinsAgent, Node, SSHConfig
+from .planner import DEFAULT_POWER, WAKE_POLICIES, job_matches, node_boot_time, node_power
+from .predictor import LoadPredictor
+from .registry import NodeRegistry
+from .telemetry import BusyPolicy, NodeTelemetry
+from .trace import TraceJob, Workload, read_trace
+from .wol import WakeOnLan
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class SimulationReport:
+    hours: float
+    jobs: int
+    finished: int
+    # Jobs that were running on a node when it was shut down
+    interrupted: int
+    boots: int
+    node_hours: float
+    energy_kwh: float
+    # Seconds each finished job waited in the queue before it (last) started
+    waits: List[float] = field(default_factory=list, repr=False)
+    recorded_node_hours: Optional[float] = None
+    recorded_energy_kwh: Optional[float] = None
+
+    def wait(self, q: float) -> float:
+        return quantile(self.waits, q) if self.waits else 0.0
+
+    def __str__(self):
+        lines = [
+            f"{self.hours:.1f} hours; {self.finished} of {self.jobs} jobs finished; {self.interrupted} interrupted",
+            f"{self.boots} boots; {self.node_hours:.1f} node-hours; {self.energy_kwh:.1f} kWh",
+            f"queue wait p50 {self.wait(0.5):.0f} s; p95 {self.wait(0.95):.0f} s; p99 {self.wait(0.99):.0f} s",
+        ]
+        if self.recorded_node_hours is not None:
+            lines.append(f"recorded: {self.recorded_node_hours:.1f} node-hours; {self.recorded_energy_kwh:.1f} kWh")
+        return "\n".join(lines)
+
+
+class _DiscardingInfluxWriter(InfluxWriter):
+
+    def __init__(self):
+        super().__init__("http://simulated", "simulated", "", "")
+
+    def start(self):
+        pass
+
+    def add_point(self, measurement: str, tags: Dict[str, str], fields: Dict[str, Any],
+                  timestamp_ns: Optional[int] = None):
+        pass
+
+    async def close(self):
+        pass
+
+
+class _SimJob:
+
+    __slots__ = ("trace", "agent", "started", "end")
+
+    def __init__(self, trace: TraceJob):
+        self.trace = trace
+        self.agent: Optional["_SimAgent"] = None
+        self.started: Optional[float] = None
+        self.end: Optional[float] = None
+
+
+class _SimAgent:
+
+    __slots__ = ("controller", "name", "labels", "num_executors", "node", "online", "temporarily_offline", "running")
+
+    def __init__(self, controller: str, name: str, labels: List[str], num_executors: int, node: Optional["SimNode"]):
+        self.controller = controller
+        self.name = name
+        self.labels = labels
+        self.num_executors = num_executors
+        # Agents without a node (the built-in one, say) are always on
+        self.node = node
+        self.online = node is None
+        self.temporarily_offline = False
+        self.running: List[_SimJob] = []
+
+    @property
+    def accepts_jobs(self) -> bool:
+        return self.online and not self.temporarily_offline and len(self.running) < self.num_executors
+
+
+class SimNode(Node):
+    """ A node that boots, runs and shuts down in the simulated cluster instead of over the network """
+
+    __slots__ = ("cluster", "powered", "up", "boot_done", "on_since", "on_seconds", "boots")
+
+    def __init__(self, cluster: "_Cluster", name: str, aliases: Sequence[str] = (), capacity: Optional[int] = None,
+                 power: Optional[float] = None, boot_time: Optional[float] = None):
+        super().__init__(name, "127.0.0.1", "00:00:00:00:00:00", aliases=aliases, capacity=capacity, power=power,
+                         boot_time=boot_time)
+        self.cluster = cluster
+        self.powered = self.up = False
+        self.boot_done = 0.0
+        self.on_since = 0.0
+        self.on_seconds = 0.0
+        self.boots = 0
+
+    async def is_available(self, max_age: Optional[float] = None) -> bool:
+        self.observe_probe(self.up, clock.now())
+        return self.up
+
+    async def wakeup(self, sender: WakeOnLan, timeout: float = 120) -> bool:
+        self.last_boot_seconds = None
+        if self.up:
+            return True
+        self.time_woken = clock.now()
+        if not self.powered:
+            self.cluster.power_on(self)
+        remaining = self.boot_done - clock.now()
+        if remaining > timeout:
+            await asyncio.sleep(timeout)
+            asyncio.get_event_loop().call_later(remaining - timeout, self.cluster.node_up, self)
+            return False
+        await asyncio.sleep(max(remaining, 0))
+        self.cluster.node_up(self)
+        self.last_boot_seconds = clock.now() - self.time_woken
+        return True
+
+    async def probe_telemetry(self, config: SSHConfig, timeout: float = 10) -> NodeTelemetry:
+        # Nothing but Jenkins ever runs on a simulated node
+        self.telemetry = NodeTelemetry(time=clock.now())
+        return self.telemetry
+
+    async def is_in_use(self, config: SSHConfig, policy: BusyPolicy = DEFAULT_BUSY_POLICY,
+                        max_age: float = 0) -> bool:
+        return False
+
+    async def shutdown(self, admin_config: SSHConfig, force: bool = False, policy: BusyPolicy = DEFAULT_BUSY_POLICY,
+                       telemetry_max_age: float = 0) -> bool:
+        if not self.up:
+            return False
+        self.time_shutdown = clock.now()
+        self.cluster.power_off(self)
+        return True
+
+
+class _SimJenkins(Jenkins):
+    """ A controller whose queue and computers come from the simulated cluster """
+
+    def __init__(self, cluster: "_Cluster", name: str, registry: NodeRegistry):
+        super().__init__("http://simulated", "", "", registry=registry, name=name)
+        self.cluster = cluster
+
+    async def update_queue(self) -> Optional[Delta]:
+        return self.queue.update(self.cluster.queue_items(self.name))
+
+    async def fetch_computers(self) -> Optional[Delta]:
+        delta = Delta()
+        for computer in self.cluster.computers(self.name):
+            self._process_computer(computer, delta)
+        return delta
+
+    async def build_job(self, job_path: str):
+        if job_path.endswith("agents-online"):
+            self.cluster.agents_online(self.name)
+
+    async def agent_state(self, name: str) -> Optional[Dict[str, Any]]:
+        agent = self.cluster.agents[(self.name, name)]
+        return dict(idle=not agent.running, temporarilyOffline=agent.temporarily_offline)
+
+    async def set_temporarily_offline(self, name: str, offline: bool, message: str = "") -> Optional[bool]:
+        agent = self.cluster.agents[(self.name, name)]
+        if agent.temporarily_offline == offline:
+            return False
+        agent.temporarily_offline = offline
+        self.cluster.kick()
+        return True
+
+
+class _Cluster:
+    """ What Jenkins and the machines do: queue jobs as the trace says, run them, and power nodes """
+
+    def __init__(self, workload: Workload):
+        self.workload = workload
+        self.nodes = {node["name"]: SimNode(self, node["name"], node["aliases"], node["capacity"], node["power"],
+                                            node["boot_time"]) for node in workload.nodes}
+        node_of = {name: node for node in self.nodes.values() for name in node.agent_names}
+        self.agents = {(agent.controller, agent.name): _SimAgent(agent.controller, agent.name, agent.labels,
+                                                                 agent.num_executors, node_of.get(agent.name))
+                       for agent in workload.agents}
+        self.controllers = list(dict.fromkeys(agent.controller for agent in workload.agents))
+        self.arrivals: Deque[TraceJob] = collections.deque(workload.jobs)
+        # The queued jobs of each controller by id, in the order they were queued
+        self.queues: Dict[str, Dict[int, _SimJob]] = {controller: dict() for controller in self.controllers}
+        # (end, sequence, job) of every running job; entries of interrupted jobs are skipped
+        self.completions: List[Tuple[float, int, _SimJob]] = []
+        self._sequence = itertools.count()
+        self._candidates: Dict[Tuple[str, str], List[_SimAgent]] = dict()
+        self._waiting_for: Dict[str, Optional[Dict[str, Any]]] = dict()
+        self._kicked: Optional[asyncio.Event] = None
+        self.waits: List[float] = []
+        self.interrupted = 0
+
+        for name in workload.initially_on():
+            node = self.nodes[name]
+            node.powered = node.up = True
+            node.on_since = node.time_woken = workload.start
+        for agent in self.agents.values():
+            agent.online = agent.node is None or agent.node.up
+
+    def kick(self):
+        """ Has Jenkins look for free executors right away (an agent came online, say) """
+        if self._kicked is not None:
+            self._kicked.set()
+
+    def candidates(self, job: TraceJob) -> List[_SimAgent]:
+        key = (job.controller, job.why)
+        if key not in self._candidates:
+            queued_job = job.queued_job()
+            self._candidates[key] = [agent for agent in self.agents.values() if agent.controller == job.controller
+                                     and job_matches(queued_job, JenkinsAgent(agent.name, agent.labels,
+                                                                              AgentStatus.Online, 0, 0))]
+        return self._candidates[key]
+
+    def queue_items(self, controller: str) -> List[Dict[str, Any]]:
+        items = []
+        for job in (queued.trace for queued in self.queues[controller].values()):
+            item = dict(id=job.id, stuck=job.stuck, why=job.why, inQueueSince=int(job.queued_since * 1000))
+            if job.why not in self._waiting_for:
+                self._waiting_for[job.why] = job.queued_job().waiting_for
+            label = self._waiting_for[job.why]
+            if label is not None and "label" in label:
+                # Jenkins reports a job stuck when no agent that could run it is online
+                item["stuck"] = not any(agent.online for agent in self.candidates(job))
+                if item["stuck"]:
+                    item["why"] = f"All nodes of label ‘{label['label']}’ are offline"
+                else:
+                    item["why"] = f"Waiting for next available executor on ‘{label['label']}’"
+            items.append(item)
+        return items
+
+    def computers(self, controller: str) -> List[Dict[str, Any]]:
+        return [dict(displayName=agent.name, offline=not agent.online or agent.temporarily_offline,
+                     numExecutors=agent.num_executors,
+                     assignedLabels=[dict(name=label, busyExecutors=len(agent.running)) for label in agent.labels]
+                     or [dict(busyExecutors=len(agent.running))])
+                for agent in self.agents.values() if agent.controller == controller]
+
+    def agents_online(self, controller: str):
+        for agent in self.agents.values():
+            if agent.controller == controller and (agent.node is None or agent.node.up):
+                agent.online, agent.temporarily_offline = True, False
+        self.kick()
+
+    def power_on(self, node: SimNode):
+        now = clock.now()
+        node.powered = True
+        node.on_since = now
+        node.boot_done = now + node_boot_time(node)
+        node.boots += 1
+
+    def node_up(self, node: SimNode):
+        node.up = node.powered
+
+    def power_off(self, node: SimNode):
+        now = clock.now()
+        node.on_seconds += now - node.on_since
+        node.powered = node.up = False
+        for agent in self.agents.values():
+            if agent.node is node:
+                agent.online = False
+                for job in agent.running:
+                    # Back in the queue, to run from the start again
+                    job.agent = job.end = None
+                    self.queues[agent.controller][job.trace.id] = job
+                    self.interrupted += 1
+                agent.running = []
+
+    def _step(self, now: float):
+        while self.completions and self.completions[0][0] <= now:
+            end, _, job = heapq.heappop(self.completions)
+            if job.end != end:
+                continue
+            job.agent.running.remove(job)
+            self.waits.append(job.started - job.trace.queued_since)
+        while self.arrivals and self.arrivals[0].queued_since <= now:
+            job = self.arrivals.popleft()
+            self.queues[job.controller][job.id] = _SimJob(job)
+        for controller, queue in self.queues.items():
+            for job_id, job in list(queue.items()):
+                agent = next((agent for agent in self.candidates(job.trace) if agent.accepts_jobs), None)
+                if agent is None:
+                    continue
+                del queue[job_id]
+                job.agent, job.started, job.end = agent, now, now + job.trace.duration
+                agent.running.append(job)
+                heapq.heappush(self.completions, (job.end, next(self._sequence), job))
+
+    async def run(self, until: float, drain_limit: float):
+        """ Runs the jobs until the trace ends and every job finished (or drain_limit seconds after the trace ends) """
+        self._kicked = asyncio.Event()
+        while True:
+            now = clock.now()
+            self._step(now)
+            queued = any(self.queues.values())
+            upcoming = [self.arrivals[0].queued_since] if self.arrivals else []
+            upcoming += [self.completions[0][0]] if self.completions else []
+            if now >= until and not (upcoming or queued) or now >= until + drain_limit:
+                return
+            next_time = min(upcoming + [until if now < until else until + drain_limit])
+            try:
+                await asyncio.wait_for(self._kicked.wait(), max(next_time - now, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._kicked.clear()
+
+    def finish(self, now: float):
+        for node in self.nodes.values():
+            if node.powered:
+                node.on_seconds += now - node.on_since
+                node.on_since = now
+
+
+class Simulation:
+
+    def __init__(self, workload: Workload, task_config: SchedulerConfig, poll_frequency: float = 30,
+                 min_poll_frequency: float = 5, max_poll_frequency: Optional[float] = None, learn: bool = False,
+                 drain_limit: float = 86400, history: Optional[HistoryStore] = None):
+        self.workload = workload
+        self.task_config = task_config
+        self.poll_frequency = poll_frequency
+        self.min_poll_frequency = min_poll_frequency
+        self.max_poll_frequency = max_poll_frequency
+        # Learn boot times and idle gaps (in memory) as the simulation goes, like with a history_file
+        self.learn = learn
+        # Or start from (and add to) what was learned before, e.g. loaded from a history_file
+        self.history = history
+        # Seconds after the end of the trace to let the queued jobs finish
+        self.drain_limit = drain_limit
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; {self.workload!r}; {self.task_config.wake_policy} policy>"
+
+    def run(self) -> SimulationReport:
+        loop = clock.VirtualTimeLoop(self.workload.start)
+        asyncio.set_event_loop(loop)
+        try:
+            with clock.using(loop.now):
+                try:
+                    return loop.run_until_complete(self._run())
+                finally:
+                    # Like asyncio.run, cancel whatever the scheduler left running (wakeups, say)
+                    remaining = asyncio.all_tasks(loop)
+                    for task in remaining:
+                        task.cancel()
+                    loop.run_until_complete(asyncio.gather(*remaining, return_exceptions=True))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    async def _run(self) -> SimulationReport:
+        cluster = _Cluster(self.workload)
+        jenkins_instances = [_SimJenkins(cluster, controller, NodeRegistry(list(cluster.nodes.values())))
+                             for controller in cluster.controllers]
+        history = self.history
+        if history is None and self.learn:
+            history = HistoryStore()
+        state = GlobalState(
+            jenkins_instance=jenkins_instances[0],
+            other_jenkins_instances=jenkins_instances[1:],
+            influx_writer=_DiscardingInfluxWriter(),
+            privileged_ssh_config=SSHConfig("simulated", None),
+            task_config=self.task_config,
+            poll_frequency=self.poll_frequency,
+            min_poll_frequency=self.min_poll_frequency,
+            max_poll_frequency=self.max_poll_frequency,
+            history=history,
+            predictor=LoadPredictor(history) if history is not None else None,
+        )
+        await state.initialize()
+
+        async def replay():
+            await cluster.run(self.workload.end, self.drain_limit)
+            state.request_shutdown()
+
+        await asyncio.gather(tasks.poll_running_jobs(state), tasks.node_manager(state), replay())
+        end = clock.now()
+        cluster.finish(end)
+        await state.close()
+        return self._report(cluster, end)
+
+    def _report(self, cluster: _Cluster, end: float) -> SimulationReport:
+        nodes = list(cluster.nodes.values())
+        recorded = self.workload.recorded_node_hours()
+        power = {node.name: node_power(node) for node in nodes}
+        return SimulationReport(
+            hours=(end - self.workload.start) / 3600,
+            jobs=len(self.workload.jobs),
+            finished=len(cluster.waits),
+            interrupted=cluster.interrupted,
+            boots=sum(node.boots for node in nodes),
+            node_hours=sum(node.on_seconds for node in nodes) / 3600,
+            energy_kwh=sum(node.on_seconds * power[node.name] for node in nodes) / 3600 / 1000,
+            waits=cluster.waits,
+            recorded_node_hours=sum(recorded.values()),
+            recorded_energy_kwh=sum(hours * power.get(name, DEFAULT_POWER) for name, hours in recorded.items()) / 1000,
+        )
+
+
+def _main(args) -> int:
+    workload = Workload.from_trace(read_trace(args.trace))
+    print(f"{workload!r}; {workload.skipped} jobs left the queue without running")
+    for policy in args.wake_policy:
+        for idle_time in args.idle_time_before_shutdown:
+            task_config = SchedulerConfig(0, idle_time, args.node_priority.split(",") if args.node_priority else [],
+                                          max_concurrent_boots=args.max_concurrent_boots,
+                                          boot_stagger=args.boot_stagger,
+                                          drain_before_shutdown=not args.no_drain, wake_policy=policy)
+            report = Simulation(workload, task_config, poll_frequency=args.poll_frequency,
+                                learn=args.learn).run()
+            print(f"\n{policy} policy; shut down after {idle_time:.0f} idle seconds\n{report}")
+    return 0
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Replays a recorded trace through the scheduler on a virtual clock")
+    parser.add_argument("trace", help="Trace recorded with the trace_file option")
+    parser.add_argument("--idle-time-before-shutdown", type=float, nargs="+", default=[300],
+                        help="Seconds a node must be idle before it is shut down (one simulation per value)")
+    parser.add_argument("--wake-policy", nargs="+", default=["priority"], choices=WAKE_POLICIES,
+                        help="Wake policies to simulate (one simulation per policy)")
+    parser.add_argument("--node-priority", default="", help="Comma-separated agent names, highest priority first")
+    parser.add_argument("--poll-frequency", type=float, default=30, help="Seconds between polls of Jenkins")
+    parser.add_argument("--max-concurrent-boots", type=int, default=2)
+    parser.add_argument("--boot-stagger", type=float, default=10)
+    parser.add_argument("--no-drain", action="store_true", help="Shut nodes down without draining their agents")
+    parser.add_argument("--learn", action="store_true",
+                        help="Learn boot times and shutdown thresholds as the simulation goes")
+    parser.add_argument("-l", "--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    sys.exit(_main(args))
@@ -0,0 +1,119 @@
+""" Persistent SSH connections to the agents
+
+Opening an SSH connection costs a key exchange and an authentication round trip, which is
+far more expensive than the commands we actually run. A PersistentSSHConnection keeps one
+authenticated connection per host alive (with SSH keepalives) and runs every command on a
+new channel of that connection. It reconnects transparently after the host reboots, and
+closes the connection once it has been idle for a while.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import asyncssh
+
+from .metrics import REGISTRY
+
+LOGGER = logging.getLogger(__name__)
+
+COMMAND_SECONDS = REGISTRY.histogram("nodemonitor_ssh_command_seconds", "Time to run a command over SSH "
+                                     "(including connecting, if needed)", ["host"])
+CONNECTIONS = REGISTRY.counter("nodemonitor_ssh_connections_total", "SSH connections opened", ["host"])
+
+# Errors that mean the cached connection is no longer usable
+RECONNECT_ERRORS = (asyncssh.DisconnectError, asyncssh.ChannelOpenError, ConnectionError)
+
+
+class PersistentSSHConnection:
+
+    def __init__(self, host: str, port: int = 22, idle_timeout: float = 600):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+
+        self._conn: Optional[asyncssh.SSHClientConnection] = None
+        self._options: Optional[dict] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._in_flight = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.host}; {'connected' if self.is_connected else 'disconnected'}>"
+
+    @property
+    def is_connected(self) -> bool:
+        return self._conn is not None
+
+    async def run(self, command: str, options: dict, retry: bool = True,
+                  timeout: Optional[float] = None) -> asyncssh.SSHCompletedProcess:
+        """ Runs a command on a new channel, connecting (or reconnecting) first if needed
+
+        If the cached connection turns out to be dead (e.g., the host rebooted), it is discarded and
+        the command is retried once on a fresh connection unless retry is False.
+        """
+        self._in_flight += 1
+        self._cancel_idle_timer()
+        start = time.perf_counter()
+        try:
+            conn = await self._connection(options)
+            try:
+                return await conn.run(command, timeout=timeout)
+            except RECONNECT_ERRORS as err:
+                self._discard(conn)
+                if not retry:
+                    raise
+                LOGGER.info(f"SSH connection to {self.host} went away ({err}). Reconnecting")
+                conn = await self._connection(options)
+                return await conn.run(command, timeout=timeout)
+        finally:
+            COMMAND_SECONDS.observe(time.perf_counter() - start, host=self.host)
+            self._in_flight -= 1
+            self._start_idle_timer()
+
+    def close(self):
+        """ Closes the cached connection, if any. The next command will reconnect """
+        self._cancel_idle_timer()
+        if self._conn is not None:
+            self._discard(self._conn)
+
+    async def _connection(self, options: dict) -> asyncssh.SSHClientConnection:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._conn is not None and options != self._options:
+                LOGGER.info(f"SSH options for {self.host} changed. Reconnecting")
+                self._discard(self._conn)
+            if self._conn is None:
+                CONNECTIONS.inc(host=self.host)
+                self._conn = await asyncssh.connect(self.host, port=self.port, **options)
+                self._options = options
+                asyncio.ensure_future(self._watch(self._conn))
+            return self._conn
+
+    async def _watch(self, conn: asyncssh.SSHClientConnection):
+        """ Forgets the connection as soon as it closes (e.g., keepalives failed or the host shut down) """
+        await conn.wait_closed()
+        if self._conn is conn:
+            LOGGER.debug(f"SSH connection to {self.host} closed")
+            self._conn = None
+
+    def _discard(self, conn: asyncssh.SSHClientConnection):
+        if self._conn is conn:
+            self._conn = None
+        conn.close()
+
+    def _start_idle_timer(self):
+        if self._in_flight == 0 and self._conn is not None:
+            self._idle_handle = asyncio.get_event_loop().call_later(self.idle_timeout, self._evict)
+
+    def _cancel_idle_timer(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _evict(self):
+        self._idle_handle = None
+        if self._in_flight == 0 and self._conn is not None:
+            LOGGER.debug(f"Closing SSH connection to {self.host} after {self.idle_timeout} idle seconds")
+            self._discard(self._conn)
@@ -1,16 +1,25 @@
 """ Various tasks that should be performed """
 import asyncio
 import logging
-import time
 from functools import wraps
+from typing import Dict, List
 
 import asyncssh
 
+from . import clock
+from .analytics import queue_label
 from .globalstate import GlobalState, NodeStatus
-from .nodes import JenkinsAgent
+from .jenkins import QueuedJob
+from .metrics import REGISTRY, STAGE_SECONDS
+from .nodes import Node, probe_nodes
+from .planner import job_matches, plan_wakeups, priority_order
 
 LOGGER = logging.getLogger(__name__)
 
+DRAIN_ROLLBACKS = REGISTRY.counter("nodemonitor_drain_rollbacks_total", "Shutdowns called off after draining a "
+                                   "node's agents", ["node", "reason"])
+DRAIN_MESSAGE = "Idle; the node monitor is shutting this node down"
+
 
 def async_safe_shutdown(func):
     @wraps(func)
@@ -19,103 +28,263 @@ def async_safe_shutdown(func):
             return await func(state)
         except Exception:
             LOGGER.exception("Unexpected failure caught")
-            state.shutdown = True
+            state.request_shutdown()
 
     return wrapper
 
 
+def _next_poll_interval(state: GlobalState, interval: float) -> float:
+    """ Polls quickly while jobs wait for an executor and backs off gradually while the queue is empty """
+    if state.job_queue:
+        return state.min_poll_frequency
+    if state.empty_snapshots <= 1:
+        return state.poll_frequency
+    return min(max(interval, state.poll_frequency) * 1.5, state.max_poll_frequency)
+
+
 @async_safe_shutdown
 async def poll_running_jobs(state: GlobalState):
-    """ Runs until state indicates a shutdown, polling with the given frequency """
+    """ Runs until state indicates a shutdown, publishing a new queue snapshot every poll
+
+    The polling interval adapts to the queue (see _next_poll_interval), and other tasks can ask
+    for an immediate poll with state.request_poll()
+    """
     LOGGER.info("Launching the job polling task...")
+    interval = state.poll_frequency
     while not state.shutdown:
         LOGGER.info("Fetching build queue and executor status")
-        queued_jobs = await state.jenkins_instance.get_queue()
-        LOGGER.info(f"Found {len(queued_jobs)} queued jobs")
-        state.job_queue.clear()
-        state.job_queue.extend(queued_jobs)
-        await state.jenkins_instance.fetch_computers()
-        await asyncio.sleep(state.poll_frequency)
+        queue_delta, computer_delta = await state.poll_controllers()
+        if queue_delta is None:
+            LOGGER.warning(f"Could not fetch the queue. Keeping the last one ({len(state.job_queue)} jobs)")
+        else:
+            queued_jobs = state.queued_jobs()
+            LOGGER.info(f"Found {len(queued_jobs)} queued jobs ({queue_delta}); agents changed: {computer_delta}")
+            if state.publish_queue(queued_jobs, queue_delta, computer_delta):
+                LOGGER.info("Jobs were just queued. Notifying the node manager")
+            state.save_checkpoint()
+        interval = _next_poll_interval(state, interval)
+        LOGGER.debug(f"Polling again in {interval} seconds")
+        await state.wait_for_poll_request(interval)
 
 
 @async_safe_shutdown
 async def node_manager(state: GlobalState):
-    """ Handles shutting down and waking Jenkins instances """
+    """ Handles shutting down and waking Jenkins instances
+
+    Runs every time the poller publishes a new snapshot, so newly queued jobs are handled right away
+    """
     LOGGER.info("Launching the node manager task...")
+    version = state.snapshot_version
     while not state.shutdown:
-        await asyncio.sleep(state.poll_frequency * 2)
-        # Maybe we can improve this at some point, but for now simply power on everyone and don't
-        # shutdown unless we have an empty queue
+        if not await state.wait_for_snapshot(version, timeout=2 * state.max_poll_frequency):
+            LOGGER.warning("No new queue snapshot was published. Asking for a poll")
+            state.request_poll()
+            continue
+        if state.shutdown:
+            break
+        version = state.snapshot_version
+        # Only wake the nodes the queued jobs need, and don't shutdown unless we have an empty queue
         if state.job_queue:
-            LOGGER.info("Job queue is not empty. Booting all agents if required")
-            await _boot_all_agents(state)
+            LOGGER.info("Job queue is not empty. Booting the agents it needs")
+            await _boot_needed_agents(state)
+        elif state.empty_snapshots < 2:
+            # A single empty snapshot may just be a gap between builds, so wait for the next one
+            LOGGER.info("Job queue is empty. Checking it one more time before shutting down agents")
         else:
-            LOGGER.info("Checking job queue one more time")
-            queue = await state.jenkins_instance.get_queue()
-            if len(queue) > 0:
-                LOGGER.info("Seems a job has been queued!")
-            else:
-                LOGGER.info("No job queued -- shutting down agents")
-                await _shutdown_idle_agents(state)
+            LOGGER.info("No job queued -- shutting down agents")
+            availability = await _probe_fleet(state)
+            _prewarm_nodes(state, availability)
+            await _collect_telemetry(state, availability)
+            await _shutdown_idle_agents(state, availability)
 
 
-async def _boot_all_agents(state: GlobalState) -> bool:
-    nodes_to_boot = []
-    for name, agent in state.jenkins_instance.nodes.items():
-        if agent.node is None:
-            continue
-        if await agent.node.is_available():
-            LOGGER.info(f"{name} is already available. Relaunching if needed")
-            continue
-        if agent.node in nodes_to_boot:
-            LOGGER.info(f"{name} underlying node already scheduled for boot")
-        else:
-            nodes_to_boot.append(agent.node)
+async def _probe_fleet(state: GlobalState) -> Dict[Node, bool]:
+    """ Probes every physical node that backs a known agent once, concurrently """
+    nodes = [node for node in state.registry if state.agents_on(node)]
+    start = clock.now()
+    with STAGE_SECONDS.time(stage="probe_fleet"):
+        availability = await probe_nodes(nodes)
+    LOGGER.info(f"Probed {len(availability)} nodes in {clock.now() - start:.2f} seconds; "
+                f"{sum(availability.values())} available")
+    return availability
+
+
+async def _collect_telemetry(state: GlobalState, availability: Dict[Node, bool]):
+    """ Takes a snapshot of what runs on every available node (one SSH command each) and writes it to influx
+
+    The shutdown decisions later in the same cycle use these snapshots rather than asking the nodes again
+    """
+    semaphore = asyncio.Semaphore(state.task_config.probe_concurrency)
+
+    async def collect(node: Node):
+        async with semaphore:
+            try:
+                telemetry = await node.probe_telemetry(state.privileged_ssh_config)
+            except (asyncio.TimeoutError, asyncssh.Error, OSError) as err:
+                LOGGER.info(f"Could not collect telemetry from {node.name}: {err!r}")
+                return
+        state.influx_writer.add_point("node_telemetry", dict(node_name=node.name), telemetry.fields())
+
+    with STAGE_SECONDS.time(stage="telemetry"):
+        await asyncio.gather(*[collect(node) for node, available in availability.items() if available])
+
+
+async def _boot_needed_agents(state: GlobalState) -> bool:
+    availability = await _probe_fleet(state)
+    with STAGE_SECONDS.time(stage="plan_wakeups"):
+        nodes_to_boot = _plan_wakeups(state, availability)
     if not nodes_to_boot:
+        LOGGER.info("Available executors can cover every queued job. Not booting anything")
         return False
-    tasks = [node.wakeup() for node in nodes_to_boot]
-    for node in nodes_to_boot:
-        await state.influx_writer.write_point(node.name, 1)
-    await asyncio.gather(*tasks)
-    # Build the job to bring all of the agents back online
-    await state.jenkins_instance.build_job("manage-jenkins/agents-online")
+    LOGGER.info(f"Booting {', '.join(node.name for node in nodes_to_boot)} for {len(state.job_queue)} queued jobs")
+    woken_agents = [agent for node in nodes_to_boot for agent in state.agents_on(node)]
+    state.analytics.record_wake(job for job in state.job_queue
+                                if any(job_matches(job, agent) for agent in woken_agents))
+    await _boot_nodes(state, nodes_to_boot)
     return True
 
 
-async def _shutdown_idle_agents(state: GlobalState):
-    await state.jenkins_instance.fetch_computers()
-    do_not_shutdown = []
-    shutdown_list = []
-    for name, agent in state.jenkins_instance.nodes.items():
-        if agent.node is None:
+def _plan_wakeups(state: GlobalState, availability: Dict[Node, bool]) -> List[Node]:
+    """ Plans the wakeups for each controller's queue in turn
+
+    The nodes planned for one controller count as available for the next one, since their
+    agents on every controller come up together
+    """
+    availability = dict(availability)
+    nodes_to_boot = dict()
+    for jenkins in state.jenkins_instances:
+        jobs = list(jenkins.queue.jobs.values())
+        for node in plan_wakeups(jobs, jenkins.registry, availability, state.task_config.node_priority,
+                                 policy=_wake_policy(state, jobs), boot_time=state.boot_time):
+            nodes_to_boot[node] = None
+            availability[node] = True
+    return priority_order(nodes_to_boot, state.registry, state.task_config.node_priority)
+
+
+def _wake_policy(state: GlobalState, jobs: List[QueuedJob]) -> str:
+    """ The configured wake policy, or the fastest drain while a queued label is at risk of missing its SLO """
+    for label in dict.fromkeys(queue_label(job) for job in jobs):
+        slo = state.task_config.slo(label)
+        if slo is not None and state.analytics.at_risk(label, slo):
+            LOGGER.info(f"Jobs waiting for {label} are at risk of waiting more than {slo} seconds. "
+                        f"Planning the fastest drain")
+            return "drain"
+    return state.task_config.wake_policy
+
+
+def _prewarm_nodes(state: GlobalState, availability: Dict[Node, bool]):
+    """ Starts booting nodes ahead of the jobs the predictor expects soon
+
+    The boots run in the background: a guess about the next hour must not hold up the jobs
+    queued now. Nodes still booting from an earlier cycle count as warm.
+    """
+    if state.predictor is None:
+        return
+    warm = {node: available or state.boot_scheduler.is_booting(node) for node, available in availability.items()}
+    nodes_to_boot = state.predictor.nodes_to_prewarm(state.registry, warm, state.task_config.node_priority)
+    if nodes_to_boot:
+        state.run_in_background(_boot_nodes(state, nodes_to_boot))
+
+
+async def _boot_nodes(state: GlobalState, nodes: List[Node]):
+    for node in nodes:
+        state.record_power(node, True)
+    for boot in asyncio.as_completed(state.boot_scheduler.boot_all(nodes)):
+        if await boot:
+            # Build the job to bring the agents back online as each node comes up, rather than
+            # leaving the first node's executors idle until the slowest node has booted
+            await asyncio.gather(*[jenkins.build_job("manage-jenkins/agents-online")
+                                   for jenkins in state.jenkins_instances])
+
+
+def _is_idle(state: GlobalState, node: Node) -> bool:
+    """ Whether every agent on node has been idle long enough, and the node has been up long enough, to shut down """
+    idle_time = state.shutdown_threshold(node)
+    for agent in state.agents_on(node):
+        if agent.busy_executors:
+            LOGGER.info(f"Shutdown - {agent.name} is currently in use. Not shutting down {node.name}.")
+            return False
+        if clock.now() - agent.time_last_job_finished <= idle_time:
+            LOGGER.info(f"Shutdown - {agent.name} finished its last job less than {idle_time} seconds ago.")
+            return False
+    time_since_last_boot = clock.now() - node.time_woken
+    if time_since_last_boot < idle_time:
+        LOGGER.info(f"Shutdown - {node.name} only booted {time_since_last_boot} seconds ago. Not shutting down yet")
+        return False
+    LOGGER.info(f"Shutdown - every agent on {node.name} has been idle for more than {idle_time} seconds")
+    return True
+
+
+async def _shutdown_idle_agents(state: GlobalState, availability: Dict[Node, bool]):
+    # The computers were fetched along with the queue snapshot that triggered this check
+    keep_warm = set()
+    if state.predictor is not None:
+        keep_warm.update(state.predictor.nodes_to_keep_warm(state.registry, availability,
+                                                            state.task_config.node_priority))
+    for node, available in availability.items():
+        if not available:
+            LOGGER.info(f"Shutdown - ignoring {node.name} as it is not available")
             continue
-        if not await agent.node.is_available():
-            LOGGER.info(f"Shutdown - ignoring {name} as it is not available")
+        if node in keep_warm:
+            LOGGER.info(f"Shutdown - keeping {node.name} on for the jobs expected soon")
             continue
-        if agent.busy_executors:
-            LOGGER.info(f"Shutdown - {name} is currently in use. Not shutting down node.")
-            do_not_shutdown.append(agent.node)
+        if not _is_idle(state, node):
             continue
-        if time.time() - agent.time_last_job_finished > state.task_config.idle_time_before_shutdown:
-            LOGGER.info(f"Shutdown - {name} finished last job more than {state.task_config.idle_time_before_shutdown} "
-                        f"seconds ago. Candidate for shutdown.")
-            time_since_last_boot = time.time() - agent.time_woken
-            if time_since_last_boot < state.task_config.idle_time_before_shutdown:
-                LOGGER.info(f"Shutdown - {name} only booted {time_since_last_boot} seconds ago. Not shutting down yet")
+        LOGGER.info(f"Shutting down {node.name} since it is idle")
+        try:
+            if state.task_config.drain_before_shutdown:
+                shut_down = await _drain_and_shutdown(state, node)
             else:
-                LOGGER.info(f"Shutdown - {name} has been idle for {time_since_last_boot} seconds. Marking shutdown")
-                if agent.node in shutdown_list:
-                    LOGGER.info(f"Shutdown - {name} is already in the list!")
-                else:
-                    shutdown_list.append(agent.node)
-
-    for node in shutdown_list:
-        if node in do_not_shutdown:
-            LOGGER.info(f"Not shutting down node {node.name} since it is still in use in another agent")
-        else:
-            LOGGER.info(f"Shutting down {node.name} since it is idle")
-            await state.influx_writer.write_point(node.name, 0)
-            try:
-                await node.shutdown(state.privileged_ssh_config, force=False)
-            except (asyncssh.misc.ConnectionLost, ConnectionRefusedError, OSError) as err:
-                LOGGER.info(f"Lost/refused connection to {node.name}... ignoring {err}")
+                shut_down = await _shutdown(state, node)
+        except (asyncssh.misc.ConnectionLost, ConnectionRefusedError, OSError) as err:
+            LOGGER.info(f"Lost/refused connection to {node.name}... ignoring {err}")
+            continue
+        if shut_down:
+            state.record_power(node, False)
+
+
+async def _shutdown(state: GlobalState, node: Node) -> bool:
+    # The telemetry was collected earlier in this same cycle
+    return await node.shutdown(state.privileged_ssh_config, force=False, policy=state.task_config.busy_policy,
+                               telemetry_max_age=state.poll_frequency)
+
+
+async def _drain_and_shutdown(state: GlobalState, node: Node) -> bool:
+    """ Shuts the node down without racing Jenkins for its executors
+
+    Every online agent of the node, on every controller, is marked temporarily offline so Jenkins
+    assigns it no new build. Only if every agent is then still idle is the node shut down;
+    otherwise (or if the node turns out to be in use) the agents are put back online. Agents of a
+    node that did shut down stay offline until the agents-online job runs when it boots again.
+    """
+    if await node.is_in_use(state.privileged_ssh_config, state.task_config.busy_policy, state.poll_frequency):
+        LOGGER.info(f'{node.name} is in use. Not shutting down')
+        return False
+    agents = [(jenkins, agent) for jenkins in state.jenkins_instances
+              for agent in jenkins.registry.agents_on(node) if agent.is_online()]
+    toggled = await asyncio.gather(*[jenkins.set_temporarily_offline(agent.name, True, DRAIN_MESSAGE)
+                                     for jenkins, agent in agents])
+    drained = [(jenkins, agent) for (jenkins, agent), changed in zip(agents, toggled) if changed]
+    shut_down = False
+    try:
+        if None in toggled:
+            LOGGER.warning(f"Could not take every agent on {node.name} offline. Not shutting it down")
+            DRAIN_ROLLBACKS.inc(node=node.name, reason="drain failed")
+            return False
+        # Jenkins may have assigned a build since the last poll, before the agents went offline
+        agent_states = await asyncio.gather(*[jenkins.agent_state(agent.name) for jenkins, agent in agents])
+        busy = [agent.name for (_, agent), agent_state in zip(agents, agent_states)
+                if agent_state is None or not agent_state["idle"]]
+        if busy:
+            LOGGER.info(f"Shutdown - {', '.join(busy)} took a build (or could not be checked). "
+                        f"Not shutting down {node.name}")
+            DRAIN_ROLLBACKS.inc(node=node.name, reason="busy")
+            return False
+        shut_down = await _shutdown(state, node)
+        if not shut_down:
+            DRAIN_ROLLBACKS.inc(node=node.name, reason="not shut down")
+        return shut_down
+    finally:
+        if not shut_down and drained:
+            LOGGER.info(f"Putting the agents on {node.name} back online")
+            await asyncio.gather(*[jenkins.set_temporarily_offline(agent.name, False) for jenkins, agent in drained])
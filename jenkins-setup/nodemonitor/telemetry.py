@@ -0,0 +1,131 @@
+""" What is running on a node, collected with a single SSH command
+
+One command prints the logged-in users, the load average, the CPU times, the running docker
+containers, the processes using the GPUs and the fleet runner's maintenance marker, each in its
+own section. The node monitor runs it once per node per cycle, writes the numbers to influx and
+decides from the same snapshot whether anything outside Jenkins would be killed by a shutdown.
+
+CPU utilization is the share of non-idle time between two consecutive snapshots, so the first
+snapshot of a node has none.
+"""
+import fnmatch
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# Written by the fleet runner while it works on a node, so the monitor does not shut the node down under it.
+# It lives in /var/tmp so that it survives the reboots that are part of maintenance, and holds the time it
+# expires so that a runner that dies half-way does not keep the node up forever.
+MAINTENANCE_MARKER = "/var/tmp/nodemonitor-maintenance"
+MAINTENANCE_TOKEN = "nodemonitor-maintenance"
+
+# Sections whose command is missing (e.g., no docker or no GPU) just come back empty
+_SECTIONS = [
+    ("users", "users"),
+    ("loadavg", "cat /proc/loadavg"),
+    ("cpu", "head -n 1 /proc/stat"),
+    ("containers", "docker ps --format '{{.Names}}' 2>/dev/null"),
+    ("gpu", "nvidia-smi --query-compute-apps=pid,process_name --format=csv,noheader 2>/dev/null"),
+    ("maintenance", f"cat {MAINTENANCE_MARKER} 2>/dev/null"),
+]
+TELEMETRY_COMMAND = "; ".join(f"echo @{name}; {command}" for name, command in _SECTIONS)
+
+
+@dataclass
+class NodeTelemetry:
+    """ A snapshot of what is running on a node """
+    time: float
+    users: List[str] = field(default_factory=list)
+    # Over 1, 5 and 15 minutes
+    load_average: Optional[Tuple[float, float, float]] = None
+    # (busy, total) clock ticks since boot
+    cpu_times: Optional[Tuple[int, int]] = None
+    # Between 0 and 1, since the previous snapshot
+    cpu_utilization: Optional[float] = None
+    containers: List[str] = field(default_factory=list)
+    gpu_processes: List[str] = field(default_factory=list)
+    maintenance_until: Optional[float] = None
+
+    @classmethod
+    def parse(cls, output: str, when: float, previous: Optional["NodeTelemetry"] = None) -> "NodeTelemetry":
+        """ Parses the output of TELEMETRY_COMMAND taken at when """
+        sections: Dict[str, List[str]] = dict()
+        lines: List[str] = []
+        for line in output.splitlines():
+            if line.startswith("@") and line[1:] in dict(_SECTIONS):
+                lines = sections.setdefault(line[1:], [])
+            elif line.strip():
+                lines.append(line.strip())
+
+        telemetry = cls(time=when)
+        telemetry.users = [user for line in sections.get("users", []) for user in line.split()]
+        telemetry.containers = sections.get("containers", [])
+        telemetry.gpu_processes = sections.get("gpu", [])
+        try:
+            if sections.get("loadavg"):
+                one, five, fifteen = sections["loadavg"][0].split()[:3]
+                telemetry.load_average = (float(one), float(five), float(fifteen))
+            if sections.get("cpu"):
+                ticks = [int(value) for value in sections["cpu"][0].split()[1:9]]
+                # idle and iowait
+                idle = ticks[3] + (ticks[4] if len(ticks) > 4 else 0)
+                telemetry.cpu_times = (sum(ticks) - idle, sum(ticks))
+        except (ValueError, IndexError) as err:
+            LOGGER.warning(f"Could not parse the load or CPU times ({err}): {output!r}")
+        for line in sections.get("maintenance", []):
+            try:
+                token, expires = line.split()[:2]
+                if token == MAINTENANCE_TOKEN:
+                    telemetry.maintenance_until = float(expires)
+            except ValueError:
+                LOGGER.warning(f"Ignoring the malformed maintenance marker: {line}")
+
+        if previous is not None and previous.cpu_times is not None and telemetry.cpu_times is not None:
+            busy = telemetry.cpu_times[0] - previous.cpu_times[0]
+            total = telemetry.cpu_times[1] - previous.cpu_times[1]
+            # A reboot in between resets the counters
+            if total > 0 and busy >= 0:
+                telemetry.cpu_utilization = busy / total
+        return telemetry
+
+    def fields(self) -> Dict[str, Any]:
+        """ The influx fields for this snapshot """
+        fields = dict(users=len(self.users), containers=len(self.containers), gpu_processes=len(self.gpu_processes),
+                      maintenance=self.maintenance_until is not None and self.maintenance_until > self.time)
+        if self.load_average is not None:
+            fields.update(load1=self.load_average[0], load5=self.load_average[1], load15=self.load_average[2])
+        if self.cpu_utilization is not None:
+            fields["cpu_utilization"] = self.cpu_utilization
+        return fields
+
+
+@dataclass
+class BusyPolicy:
+    """ What, besides its Jenkins agents, keeps a node from being shut down """
+    ignored_users: FrozenSet[str] = frozenset({"jenkins"})
+    # Shell-style patterns of containers that always run (e.g., monitoring agents)
+    ignored_containers: Tuple[str, ...] = ()
+    max_load_average: float = 1.0
+    max_cpu_utilization: float = 0.25
+
+    def reasons(self, telemetry: NodeTelemetry) -> List[str]:
+        """ Why the node is busy; empty if it is not """
+        reasons = []
+        if telemetry.maintenance_until is not None and telemetry.maintenance_until > telemetry.time:
+            reasons.append(f"under maintenance for another {telemetry.maintenance_until - telemetry.time:.0f} seconds")
+        users = sorted(set(telemetry.users) - self.ignored_users)
+        if users:
+            reasons.append(f"logged in: {', '.join(users)}")
+        containers = [container for container in telemetry.containers
+                      if not any(fnmatch.fnmatch(container, pattern) for pattern in self.ignored_containers)]
+        if containers:
+            reasons.append(f"containers running: {', '.join(containers)}")
+        if telemetry.gpu_processes:
+            reasons.append(f"GPU processes running: {', '.join(telemetry.gpu_processes)}")
+        if telemetry.load_average is not None and telemetry.load_average[0] > self.max_load_average:
+            reasons.append(f"load average {telemetry.load_average[0]:.2f}")
+        if telemetry.cpu_utilization is not None and telemetry.cpu_utilization > self.max_cpu_utilization:
+            reasons.append(f"CPU {telemetry.cpu_utilization:.0%} busy")
+        return reasons
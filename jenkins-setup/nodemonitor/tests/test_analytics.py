@@ -0,0 +1,72 @@
+""" Tests the queue wait analytics """
+import datetime
+
+from ..analytics import QUEUE_QUANTILES, QueueAnalytics, queue_label
+from ..globalstate import SchedulerConfig
+from ..jenkins import Delta, QueuedJob
+import pytest
+
+START = datetime.datetime(2021, 1, 4, 9).timestamp()
+
+
+def queued(job_id, label="cuda", since=START, stuck=False):
+    if stuck:
+        reason = f"All nodes of label ‘{label}’ are offline"
+    else:
+        reason = f"Waiting for next available executor on ‘{label}’"
+    return QueuedJob(job_id, stuck, reason, datetime.datetime.fromtimestamp(since))
+
+
+def test_queue_label():
+    assert queue_label(queued(1, "linux && cuda")) == "linux && cuda"
+    assert queue_label(QueuedJob(1, False, "‘Wonder Woman’ is offline; ‘Supergirl’ is offline",
+                                 datetime.datetime.now())) == "Supergirl,Wonder Woman"
+    assert queue_label(QueuedJob(1, False, "In the quiet period", datetime.datetime.now())) == "any"
+
+
+def test_wait_stuck_and_wake_to_start():
+    analytics = QueueAnalytics(window=3600)
+    jobs = [queued(job_id, since=START + job_id) for job_id in range(100)]
+    assert analytics.update(jobs, Delta(added=jobs), now=START + 100) == []
+    analytics.record_wake(jobs[:10], when=START + 200)
+    # A job is still waiting when it gets stuck, and when it comes unstuck
+    jobs[0].stuck = True
+    analytics.update(jobs, Delta(changed=[jobs[0]]), now=START + 250)
+    jobs[0].stuck = False
+    assert analytics.update(jobs, Delta(changed=[jobs[0]]), now=START + 300) == [("stuck", "cuda")]
+
+    # Every job leaves the queue 1000 seconds after it was queued
+    for job in jobs:
+        changed = analytics.update([], Delta(removed=[job]), now=job.queued_since.timestamp() + 1000)
+    assert changed == [("wait", "cuda")]
+    assert analytics.quantiles("wait", "cuda", now=START + 1100) == dict(p50=1000, p95=1000, p99=1000)
+    assert analytics.quantiles("stuck", "cuda", now=START + 1100) == dict(p50=50, p95=50, p99=50)
+    assert analytics.quantiles("wake_to_start", "cuda", now=START + 1100)["p99"] == 809
+    analytics.publish([("wait", "cuda")], now=START + 1100)
+    assert QUEUE_QUANTILES.value(kind="wait", label="cuda", quantile="p95") == 1000
+    # The windows only look back an hour
+    assert analytics.quantiles("wait", "cuda", now=START + 10000) == dict()
+
+
+def test_slo_at_risk():
+    config = SchedulerConfig(0, 0, [], queue_wait_slo=900, queue_wait_slos={"cuda": 300})
+    assert config.slo("cuda") == 300 and config.slo("linux") == 900
+    analytics = QueueAnalytics(risk_fraction=0.8)
+    jobs = [queued(1, "cuda"), queued(2, "linux")]
+    analytics.update(jobs, Delta(added=jobs), now=START + 60)
+    assert not analytics.at_risk("cuda", config.slo("cuda"), now=START + 60)
+    # The oldest cuda job has waited 80% of its SLO
+    assert analytics.at_risk("cuda", config.slo("cuda"), now=START + 241)
+    assert not analytics.at_risk("linux", config.slo("linux"), now=START + 241)
+
+    # Recent waits were long, even though nothing is queued now
+    analytics.update([], Delta(removed=[jobs[1]]), now=START + 800)
+    assert analytics.at_risk("linux", config.slo("linux"), now=START + 800)
+
+
+@pytest.mark.parametrize("risk_fraction", [0.5, 1])
+def test_risk_fraction(risk_fraction):
+    analytics = QueueAnalytics(risk_fraction=risk_fraction)
+    jobs = [queued(1)]
+    analytics.update(jobs, Delta(added=jobs), now=START)
+    assert analytics.at_risk("cuda", 100, now=START + 75) == (risk_fraction == 0.5)
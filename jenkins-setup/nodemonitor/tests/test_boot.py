@@ -0,0 +1,149 @@
+""" Tests wake-on-lan and the staggered boot scheduler against local stand-ins """
+import asyncio
+import socket
+
+import pytest
+
+from ..boot import BootScheduler
+from ..history import HistoryStore
+from ..nodes import Node
+from ..wol import WakeOnLan, broadcast_address, magic_packet
+
+
+def test_magic_packet():
+    packet = magic_packet("2C:F0:5D:27:5E:AA")
+    assert len(packet) == 102
+    assert packet[:6] == b"\xff" * 6
+    assert packet[6:] == bytes([0x2C, 0xF0, 0x5D, 0x27, 0x5E, 0xAA]) * 16
+    assert magic_packet("2c-f0-5d-27-5e-aa") == packet
+    with pytest.raises(ValueError):
+        magic_packet("2C:F0:5D")
+
+
+def test_broadcast_address():
+    assert broadcast_address("192.168.1.143") == "192.168.1.255"
+    assert broadcast_address("10.1.2.3", 16) == "10.1.255.255"
+    assert Node("Supergirl", "192.168.1.143", "2C:F0:5D:27:5E:AA").broadcast_address == "192.168.1.255"
+    assert Node("Supergirl", "192.168.1.143", "2C:F0:5D:27:5E:AA", broadcast="10.0.0.255").broadcast_address \
+        == "10.0.0.255"
+
+
+def _free_port(kind: int = socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeLAN(asyncio.DatagramProtocol):
+    """ Receives magic packets and, boot_time seconds later, starts a TCP listener for the woken node """
+
+    def __init__(self, boot_time: float, broken_macs=()):
+        self.boot_time = boot_time
+        self.broken_packets = {magic_packet(mac) for mac in broken_macs}
+        self.ports = dict()
+        self.packets = []
+        self.power_on_times = dict()
+        self.servers = []
+        self.booting = 0
+        self.max_booting = 0
+
+    def add_node(self, name: str, mac: str) -> Node:
+        port = _free_port()
+        self.ports[magic_packet(mac)] = (name, port)
+        return Node(name, "127.0.0.1", mac, port=port, broadcast="127.0.0.1")
+
+    def datagram_received(self, data: bytes, addr):
+        self.packets.append(data)
+        name, port = self.ports[data]
+        if name in self.power_on_times or data in self.broken_packets:
+            return
+        self.power_on_times[name] = asyncio.get_event_loop().time()
+        self.booting += 1
+        self.max_booting = max(self.max_booting, self.booting)
+        asyncio.ensure_future(self._boot(port))
+
+    async def _boot(self, port: int):
+        await asyncio.sleep(self.boot_time)
+        self.servers.append(await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", port))
+        self.booting -= 1
+
+
+async def _boot_fleet(lan: FakeLAN, *rounds, **kwargs):
+    """ Boots each round of nodes after the previous one is done. Returns the results of the last """
+    wol_port = _free_port(socket.SOCK_DGRAM)
+    transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+        lambda: lan, local_addr=("127.0.0.1", wol_port))
+    scheduler = BootScheduler(WakeOnLan(port=wol_port, repeats=2, interval=0.01), **kwargs)
+    try:
+        for nodes in rounds:
+            results = await asyncio.gather(*scheduler.boot_all(nodes))
+        return results
+    finally:
+        scheduler.close()
+        transport.close()
+        for server in lan.servers:
+            server.close()
+
+
+def test_boots_are_staggered_and_limited():
+    lan = FakeLAN(boot_time=0.2)
+    nodes = [lan.add_node(f"node{i}", f"00:00:00:00:00:0{i}") for i in range(5)]
+
+    results = asyncio.run(_boot_fleet(lan, nodes, max_concurrent_boots=2, stagger=0.05, boot_timeout=5))
+
+    assert results == [True] * 5
+    assert len(lan.packets) == 10
+    assert lan.max_booting == 2
+    # Nodes power on in the given (priority) order, at least the stagger apart
+    times = [lan.power_on_times[node.name] for node in nodes]
+    assert times == sorted(times)
+    assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
+
+
+def test_boot_timeout_frees_the_slot():
+    lan = FakeLAN(boot_time=0.05, broken_macs=["00:00:00:00:00:01"])
+    nodes = [lan.add_node(f"node{i}", f"00:00:00:00:00:0{i}") for i in range(1, 3)]
+
+    results = asyncio.run(_boot_fleet(lan, nodes, max_concurrent_boots=1, stagger=0, boot_timeout=0.5))
+
+    assert results == [False, True]
+
+
+def test_only_real_boots_are_recorded():
+    lan = FakeLAN(boot_time=0.1)
+    node = lan.add_node("node1", "00:00:00:00:00:01")
+    history = HistoryStore()
+
+    # Asked to boot a second time once it is up, which is no boot
+    results = asyncio.run(_boot_fleet(lan, [node], [node], max_concurrent_boots=1, stagger=0, boot_timeout=5,
+                                      history=history))
+
+    assert results == [True]
+    assert len(history.boots["node1"]) == 1
+
+
+def test_a_node_booting_is_not_booted_again():
+    lan = FakeLAN(boot_time=0.1)
+    node = lan.add_node("node1", "00:00:00:00:00:01")
+
+    async def run():
+        wol_port = _free_port(socket.SOCK_DGRAM)
+        transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+            lambda: lan, local_addr=("127.0.0.1", wol_port))
+        scheduler = BootScheduler(WakeOnLan(port=wol_port, repeats=1, interval=0.01), stagger=0, boot_timeout=5)
+        try:
+            # Pre-warming, then planned for a queued job before it is up
+            [prewarm] = scheduler.boot_all([node])
+            assert scheduler.is_booting(node)
+            [planned] = scheduler.boot_all([node])
+            assert planned is prewarm
+            assert await planned
+            assert not scheduler.is_booting(node)
+        finally:
+            scheduler.close()
+            transport.close()
+            for server in lan.servers:
+                server.close()
+
+    asyncio.run(run())
+    assert len(lan.packets) == 1
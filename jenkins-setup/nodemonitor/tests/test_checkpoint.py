@@ -0,0 +1,100 @@
+""" Tests checkpointing and restoring the scheduler state """
+import asyncio
+import json
+
+from ..benchmark import FakeInflux, FakeJenkins
+from ..checkpoint import Checkpointer
+from ..globalstate import GlobalState, SchedulerConfig
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import AgentStatus, JenkinsAgent, Node, SSHConfig
+from ..registry import NodeRegistry
+
+
+def make_state(url: str, checkpoint_path) -> GlobalState:
+    registry = NodeRegistry([Node("Supergirl", "127.0.0.1", "00:00:00:00:00:01", aliases=["Supergirl-cuda"])])
+    return GlobalState(
+        jenkins_instance=Jenkins(url, "user", "token", registry=registry),
+        influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+        privileged_ssh_config=SSHConfig("user", "password"),
+        task_config=SchedulerConfig(300, 300, []),
+        poll_frequency=30,
+        checkpointer=Checkpointer(checkpoint_path),
+    )
+
+
+def test_warm_restart(tmp_path):
+    checkpoint_path = tmp_path / "state.json"
+
+    async def run():
+        jenkins = FakeJenkins()
+        await jenkins.start()
+        jenkins.add_computer("Supergirl", ["linux"])
+        jenkins.add_computer("Supergirl-cuda", ["cuda"], num_executors=1)
+        jenkins.enqueue("linux")
+        try:
+            state = make_state(jenkins.url, checkpoint_path)
+            await state.initialize()
+            agent = state.jenkins_instance.nodes["Supergirl"]
+            agent._time_last_job_finished = 1000.0
+            state.jenkins_instance.registry.node("Supergirl").time_woken = 500.0
+            assert state.checkpointer.save(state)
+            # Nothing changed, so nothing is written
+            assert not state.checkpointer.save(state)
+            await state.close()
+
+            restarted = make_state(jenkins.url, checkpoint_path)
+            await restarted.initialize()
+            agent = restarted.jenkins_instance.nodes["Supergirl"]
+            assert agent.labels == ["Supergirl", "linux"]
+            assert agent.node is restarted.jenkins_instance.registry.node("Supergirl")
+            assert agent.time_last_job_finished == 1000.0
+            assert agent.node.time_woken == 500.0
+            # The restored queue and agents match Jenkins, so nothing is reported as new
+            assert not restarted.queue_delta
+            assert not restarted.computer_delta
+            assert len(restarted.job_queue) == 1
+            await restarted.close()
+        finally:
+            await jenkins.stop()
+
+    asyncio.run(run())
+
+
+def test_unusable_checkpoint_is_ignored(tmp_path):
+    checkpoint_path = tmp_path / "state.json"
+    state = make_state("http://127.0.0.1:1", checkpoint_path)
+
+    checkpoint_path.write_text("{not json")
+    assert not state.checkpointer.load(state)
+
+    # A well-formed checkpoint of another version is not guessed at either
+    agent = dict(labels=["linux"], status="Online", num_executors=2, busy_executors=0, time_last_job_finished=0)
+    checkpoint_path.write_text(json.dumps(dict(version=1, agents=dict(Supergirl=agent), nodes={}, queue=[])))
+    assert not state.checkpointer.load(state)
+    assert not state.jenkins_instance.nodes
+
+
+def test_busy_timers_are_saved_at_most_every_min_interval(tmp_path):
+    checkpoint_path = tmp_path / "state.json"
+    state = make_state("http://127.0.0.1:1", checkpoint_path)
+    state.jenkins_instance.add_agent(JenkinsAgent("Supergirl", ["linux"], AgentStatus.Online, 2, 0))
+    assert state.checkpointer.save(state)
+
+    # Builds running and finishing only change timers, which wait for the interval to pass
+    agent = state.jenkins_instance.nodes["Supergirl"]
+    agent.busy_executors = 1
+    assert not state.checkpointer.save(state)
+    state.checkpointer.min_interval = 0
+    assert state.checkpointer.save(state)
+
+    state.checkpointer.min_interval = 300
+    agent.busy_executors = 0
+    assert not state.checkpointer.save(state)
+    # Anything else is written right away, and so is everything when the state closes
+    state.registry.node("Supergirl").time_woken = 500.0
+    assert state.checkpointer.save(state)
+    agent.busy_executors = 1
+    assert state.checkpointer.save(state, force=True)
+    assert json.loads(checkpoint_path.read_text())["controllers"][state.jenkins_instance.name]["agents"][
+        "Supergirl"]["busy_executors"] == 1
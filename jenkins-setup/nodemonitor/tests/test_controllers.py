@@ -0,0 +1,63 @@
+""" Tests a node monitor that manages several Jenkins controllers sharing the same nodes """
+import asyncio
+
+from .. import tasks
+from ..benchmark import FakeJenkins
+from ..globalstate import GlobalState, SchedulerConfig
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import SSHConfig, Node
+from ..registry import NodeRegistry
+
+
+def test_controllers_share_nodes():
+
+    async def run():
+        production, staging = FakeJenkins(), FakeJenkins()
+        await production.start()
+        await staging.start()
+        for jenkins in (production, staging):
+            jenkins.add_computer("Supergirl", ["linux"], num_executors=1)
+            jenkins.add_computer("Wonder Woman", ["linux"], num_executors=1)
+        production.enqueue("linux")
+        staging.enqueue("linux")
+        staging.enqueue("linux")
+        staging.computers["Supergirl"]["busyExecutors"] = 1
+
+        supergirl = Node("Supergirl", "127.0.0.1", "00:00:00:00:00:01")
+        wonder_woman = Node("Wonder Woman", "127.0.0.1", "00:00:00:00:00:02")
+        nodes = [supergirl, wonder_woman]
+        state = GlobalState(
+            jenkins_instance=Jenkins(production.url, "user", "token", registry=NodeRegistry(nodes),
+                                     name="production"),
+            other_jenkins_instances=[Jenkins(staging.url, "user", "token", registry=NodeRegistry(nodes),
+                                             name="staging")],
+            influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+            privileged_ssh_config=SSHConfig("user", "password"),
+            task_config=SchedulerConfig(0, 0, ["Wonder Woman", "Supergirl"]),
+            poll_frequency=30,
+        )
+        try:
+            await state.initialize()
+            # Both controllers were polled and their queues merged
+            assert production.total_requests == staging.total_requests == 2
+            assert len(state.job_queue) == 3
+            assert len(state.queue_delta.added) == 3
+            assert [agent.name for agent in state.agents_on(supergirl)] == ["Supergirl", "Supergirl"]
+
+            # Supergirl is idle on production, but busy on staging
+            supergirl.time_woken = wonder_woman.time_woken = 1
+            assert not tasks._is_idle(state, supergirl)
+            assert tasks._is_idle(state, wonder_woman)
+
+            # The production job fits on Wonder Woman; so does one of the staging jobs, but the other
+            # staging job can't go on the busy staging Supergirl agent
+            availability = {supergirl: False, wonder_woman: False}
+            assert tasks._plan_wakeups(state, availability) == [wonder_woman]
+            assert availability == {supergirl: False, wonder_woman: False}
+        finally:
+            await state.close()
+            await production.stop()
+            await staging.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+""" Tests draining a node's agents in Jenkins before shutting the node down """
+import asyncio
+
+from .. import tasks
+from ..benchmark import FakeFleet, FakeJenkins
+from ..globalstate import GlobalState, SchedulerConfig
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import SSHConfig
+
+
+def run_drain(prepare):
+    """ Polls a fake fleet of one node, lets prepare change Jenkins behind the monitor's back, then drains the node
+
+    Returns whether the node was told to shut down, whether it is still up, and the fake Jenkins and node
+    """
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fleet = FakeFleet(2, fake_jenkins, up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        registry = fleet.registry()
+        state = GlobalState(
+            jenkins_instance=Jenkins(fake_jenkins.url, "user", "token", registry=registry),
+            influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+            privileged_ssh_config=SSHConfig("user", "password"),
+            task_config=SchedulerConfig(0, 0, []),
+            poll_frequency=30,
+        )
+        try:
+            await state.initialize()
+            node = registry.node("node0000")
+            prepare(fake_jenkins)
+            shut_down = await tasks._drain_and_shutdown(state, node)
+            node.ssh.close()
+            await asyncio.sleep(0.1)
+            return shut_down, fleet.nodes[0].is_up, fake_jenkins, fleet.nodes[0]
+        finally:
+            await state.close()
+            await fleet.stop()
+            await fake_jenkins.stop()
+
+    return asyncio.run(run())
+
+
+def test_drain_then_shutdown():
+    shut_down, is_up, jenkins, node = run_drain(lambda jenkins: None)
+    assert shut_down
+    assert node.commands[-1] == "sudo shutdown now" and not is_up
+    # The agents stay offline until the node boots again
+    assert jenkins.computers["node0000"]["temporarilyOffline"]
+    assert jenkins.computers["node0000-cuda"]["temporarilyOffline"]
+
+
+def test_rollback_when_a_build_started():
+    def start_build(jenkins: FakeJenkins):
+        # Assigned after the last poll, so the monitor still thinks the agent is idle
+        jenkins.computers["node0000-cuda"]["busyExecutors"] = 1
+
+    shut_down, is_up, jenkins, node = run_drain(start_build)
+    assert not shut_down
+    assert is_up and "sudo shutdown now" not in node.commands
+    assert not jenkins.computers["node0000"]["temporarilyOffline"]
+    assert not jenkins.computers["node0000-cuda"]["temporarilyOffline"]
+
+
+def test_rollback_keeps_agents_taken_offline_by_hand():
+    def take_offline(jenkins: FakeJenkins):
+        jenkins.computers["node0000-cuda"]["temporarilyOffline"] = True
+        jenkins.computers["node0000"]["busyExecutors"] = 1
+
+    shut_down, _, jenkins, _ = run_drain(take_offline)
+    assert not shut_down
+    assert not jenkins.computers["node0000"]["temporarilyOffline"]
+    assert jenkins.computers["node0000-cuda"]["temporarilyOffline"]
@@ -1,5 +1,7 @@
 """ Tests the encryption module """
-from ..encryption import encrypt, decrypt
+from Crypto.Cipher import AES
+
+from ..encryption import SecretStore, decrypt, decrypt_all, derive_key, encode, encrypt, pad_string, password_to_key
 import pytest
 
 @pytest.mark.parametrize(
@@ -17,3 +19,31 @@ import pytest
 def test_round_tripping(test_payload, password):
     encrypted = encrypt(test_payload, password)
     assert decrypt(encrypted, password) == test_payload
+
+
+def test_original_format_still_decrypts():
+    # Encrypted with the original scheme (and quoted, as in config.ini)
+    legacy = '"' + encode(b"0" * 16 + AES.new(password_to_key(b"password"), AES.MODE_CBC, b"0" * 16).encrypt(
+        pad_string(b"my secret token"))) + '"'
+    assert decrypt(legacy, "password") == "my secret token"
+    assert decrypt(f'"{encrypt("my secret token", "password", iterations=1000)}"', "password") == "my secret token"
+
+
+def test_wrong_password_is_detected():
+    encrypted = encrypt("my secret token", "password", iterations=1000)
+    assert encrypted.startswith("v2:")
+    with pytest.raises(ValueError):
+        decrypt(encrypted, "not the password")
+
+
+def test_keys_are_derived_once():
+    salt = b"s" * 16
+    secrets = [encrypt(f"secret {i}", "password", iterations=5000, salt=salt) for i in range(10)]
+    derive_key.cache_clear()
+    store = SecretStore("password")
+    assert store.decrypt_all(secrets) == [f"secret {i}" for i in range(10)]
+    assert derive_key.cache_info().misses == 1
+    # Ciphertexts seen before are not even decrypted again
+    assert store.decrypt_all(secrets) == [f"secret {i}" for i in range(10)]
+    assert derive_key.cache_info().hits == 9
+    assert decrypt_all(secrets[:2], "password") == ["secret 0", "secret 1"]
@@ -0,0 +1,169 @@
+""" Tests running commands across the fleet """
+import asyncio
+import time
+
+from ..benchmark import FakeFleet, FakeJenkins
+from ..fleet import FleetRunner, select_nodes
+from ..jenkins import Jenkins
+from ..nodes import SSHConfig
+from ..telemetry import MAINTENANCE_MARKER, MAINTENANCE_TOKEN
+
+SSH_CONFIG = SSHConfig("user", "password")
+
+
+def test_run_on_fleet():
+
+    async def run():
+        jenkins = FakeJenkins()
+        fleet = FakeFleet(4, jenkins, up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        await fleet.nodes[1].power_off()
+        nodes = list(fleet.registry())
+        runner = FleetRunner(SSH_CONFIG, concurrency=2, timeout=0.5)
+        try:
+            summary = await runner.run_all(nodes, "echo hello && false || echo fallback")
+            results = {result.node: result for result in summary.results}
+            assert results["node0000"].ok
+            assert results["node0000"].stdout == "hello\nfallback\n"
+            assert results["node0001"].error == "not available"
+            assert str(summary) == "1 of 2 nodes succeeded; failed: node0001"
+
+            summary = await runner.run_all([nodes[0]], "exit 3")
+            assert summary.results[0].exit_status == 3 and not summary.results[0].ok
+
+            start = time.perf_counter()
+            summary = await runner.run_all([nodes[0]], "sleep 5")
+            assert summary.results[0].error == "timed out after 0.5 seconds"
+            assert time.perf_counter() - start < 2
+        finally:
+            for node in nodes:
+                node.ssh.close()
+            await fleet.stop()
+
+    asyncio.run(run())
+
+
+def test_select_nodes():
+
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fleet = FakeFleet(6, fake_jenkins)
+        fake_jenkins.computers["node0002-cuda"]["labels"] = ["cuda", "gpu-big"]
+        registry = fleet.registry()
+        nodes = list(registry)
+        jenkins = Jenkins(fake_jenkins.url, "user", "token", registry=registry)
+        try:
+            await jenkins.fetch_computers()
+            assert select_nodes(nodes) == nodes
+            assert select_nodes(nodes, names=["node0001-cuda"]) == [nodes[1]]
+            assert select_nodes(nodes, names=["node0000"], labels=["gpu-big"], controllers=[jenkins]) == \
+                [nodes[0], nodes[2]]
+        finally:
+            await jenkins.close()
+            await fake_jenkins.stop()
+
+    asyncio.run(run())
+
+
+def test_maintenance_waits_for_idle_and_reboots():
+
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fleet = FakeFleet(2, fake_jenkins, up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        fake_node = fleet.nodes[0]
+        fake_node.reboot_time = 0.2
+        fake_node.files["/var/run/reboot-required"] = ""
+        fake_jenkins.computers["node0000-cuda"]["busyExecutors"] = 1
+        registry = fleet.registry()
+        node = registry.node("node0000")
+        jenkins = Jenkins(fake_jenkins.url, "user", "token", registry=registry)
+        runner = FleetRunner(SSH_CONFIG, controllers=[jenkins], when_idle=True, idle_poll=0.05, timeout=5,
+                             reboot_if_needed=True)
+        try:
+            update = asyncio.ensure_future(runner.run_all([node], "echo updated > /etc/motd"))
+            await asyncio.sleep(0.3)
+            # Still waiting for the job to finish, and the monitor would not shut the node down
+            assert "/etc/motd" not in fake_node.files
+            assert fake_node.files[MAINTENANCE_MARKER].startswith(MAINTENANCE_TOKEN)
+            assert await node.is_in_use(SSH_CONFIG)
+
+            fake_jenkins.computers["node0000-cuda"]["busyExecutors"] = 0
+            summary = await asyncio.wait_for(update, 10)
+            result = summary.results[0]
+            assert result.ok and result.rebooted
+            assert fake_node.files == {"/etc/motd": "updated\n"}
+            assert not await node.is_in_use(SSH_CONFIG)
+            assert not any(computer["temporarilyOffline"] for computer in fake_jenkins.computers.values())
+        finally:
+            node.ssh.close()
+            await jenkins.close()
+            await fleet.stop()
+            await fake_jenkins.stop()
+
+    asyncio.run(run())
+
+
+def test_maintenance_waits_for_build_assigned_after_poll():
+
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fleet = FakeFleet(2, fake_jenkins, up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        fake_node = fleet.nodes[0]
+        registry = fleet.registry()
+        node = registry.node("node0000")
+        jenkins = Jenkins(fake_jenkins.url, "user", "token", registry=registry)
+        fetch_computers = jenkins.fetch_computers
+
+        async def fetch_then_assign_build():
+            # Jenkins assigns a build right after the poll that found the node idle
+            await fetch_computers()
+            fake_jenkins.computers["node0000-cuda"]["busyExecutors"] = 1
+
+        jenkins.fetch_computers = fetch_then_assign_build
+        runner = FleetRunner(SSH_CONFIG, controllers=[jenkins], when_idle=True, idle_poll=0.05, timeout=5)
+        try:
+            update = asyncio.ensure_future(runner.run_all([node], "echo updated > /etc/motd"))
+            await asyncio.sleep(0.3)
+            # The agents are offline, so that build is the last one, and it is waited for
+            assert "/etc/motd" not in fake_node.files
+            assert fake_jenkins.computers["node0000-cuda"]["temporarilyOffline"]
+            assert fake_jenkins.computers["node0000"]["temporarilyOffline"]
+            # Booting another node meanwhile runs the agents-online job, which leaves them offline
+            await jenkins.build_job("manage-jenkins/agents-online")
+            assert fake_jenkins.computers["node0000-cuda"]["temporarilyOffline"]
+
+            fake_jenkins.computers["node0000-cuda"]["busyExecutors"] = 0
+            summary = await asyncio.wait_for(update, 10)
+            assert summary.results[0].ok and fake_node.files["/etc/motd"] == "updated\n"
+            # And put back online afterwards
+            assert not any(computer["temporarilyOffline"] for computer in fake_jenkins.computers.values())
+        finally:
+            node.ssh.close()
+            await jenkins.close()
+            await fleet.stop()
+            await fake_jenkins.stop()
+
+    asyncio.run(run())
+
+
+def test_expired_maintenance_marker_is_ignored():
+
+    async def run():
+        fleet = FakeFleet(2, FakeJenkins(), up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        node = list(fleet.registry())[0]
+        try:
+            fleet.nodes[0].files[MAINTENANCE_MARKER] = f"{MAINTENANCE_TOKEN} {time.time() - 1:.0f}\n"
+            assert not await node.is_in_use(SSH_CONFIG)
+            fleet.nodes[0].users = "jenkins jason"
+            assert await node.is_in_use(SSH_CONFIG)
+        finally:
+            node.ssh.close()
+            await fleet.stop()
+
+    asyncio.run(run())
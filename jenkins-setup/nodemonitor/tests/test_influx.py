@@ -0,0 +1,56 @@
+""" Tests the buffered influx writer """
+import asyncio
+
+from ..influx import InfluxWriter, format_line
+import pytest
+
+
+@pytest.mark.parametrize(
+    "tags, fields, expected",
+    [
+        (dict(node_name="Green Arrow"), dict(value=1), r"node_power,node_name=Green\ Arrow value=1 100"),
+        (dict(b="x,y", a="k=v"), dict(value=0.5), r"node_power,a=k\=v,b=x\,y value=0.5 100"),
+        (dict(), dict(up=True, msg='say "hi"'), r'node_power up=true,msg="say \"hi\"" 100'),
+    ],
+)
+def test_format_line(tags, fields, expected):
+    assert format_line("node_power", tags, fields, 100) == expected
+
+
+class FlakyWriter(InfluxWriter):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("http://influx", "db", "user", "pass", *args, **kwargs)
+        self.fail = True
+        self.posted = []
+
+    async def _post(self, data: str) -> bool:
+        if self.fail:
+            return False
+        self.posted.append(data.split("\n"))
+        return True
+
+
+def test_failed_flush_keeps_points_in_order():
+    writer = FlakyWriter(batch_size=2)
+    for i in range(3):
+        writer.add_point("m", dict(), dict(value=i), timestamp_ns=i)
+
+    assert not asyncio.run(writer.flush())
+    assert writer.buffered_points == 3
+
+    writer.fail = False
+    assert asyncio.run(writer.flush())
+    assert writer.buffered_points == 0
+    assert writer.posted == [["m value=0 0", "m value=1 1"], ["m value=2 2"]]
+
+
+def test_full_buffer_drops_oldest_points():
+    writer = FlakyWriter(max_buffered_points=2)
+    for i in range(3):
+        writer.add_point("m", dict(), dict(value=i), timestamp_ns=i)
+
+    assert writer.dropped_points == 1
+    writer.fail = False
+    asyncio.run(writer.flush())
+    assert writer.posted == [["m value=1 1", "m value=2 2"]]
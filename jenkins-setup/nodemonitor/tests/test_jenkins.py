@@ -0,0 +1,78 @@
+""" Tests the Jenkins queue tracking """
+import asyncio
+
+import pytest
+
+from ..benchmark import FakeJenkins
+from ..jenkins import REQUESTS, UNCHANGED, Jenkins, QueueTracker
+
+
+def item(job_id, why="Waiting for next available executor on ‘cuda’", stuck=False):
+    return dict(id=job_id, stuck=stuck, why=why, inQueueSince=1600000000000)
+
+
+def test_queue_tracker_deltas():
+    tracker = QueueTracker()
+    delta = tracker.update([item(1), item(2)])
+    assert [job.id for job in delta.added] == [1, 2]
+    assert not delta.removed and not delta.changed
+    first_job = tracker.jobs[1]
+
+    assert not tracker.update([item(1), item(2)])
+
+    delta = tracker.update([item(1, "All nodes of label ‘cuda’ are offline", stuck=True), item(3)])
+    assert [job.id for job in delta.added] == [3]
+    assert [job.id for job in delta.removed] == [2]
+    assert delta.changed == [first_job]
+    assert tracker.jobs[1] is first_job
+    assert first_job.stuck and first_job.waiting_for == dict(label="cuda")
+
+
+def test_queue_tracker_caches_reasons():
+    tracker = QueueTracker(max_cached_reasons=1)
+    tracker.update([item(1), item(2)])
+    assert tracker.jobs[1].waiting_for is tracker.jobs[2].waiting_for
+
+    tracker.update([item(1), item(2), item(3, "‘Supergirl’ is offline")])
+    assert tracker.jobs[3].waiting_for == dict(nodes=["Supergirl"])
+    assert len(tracker._reasons) == 1
+
+
+@pytest.mark.parametrize("etags, stream", [(False, False), (True, False), (False, True)])
+def test_unchanged_responses_are_not_decoded(etags, stream):
+
+    async def run():
+        fake = FakeJenkins(etags=etags)
+        await fake.start()
+        fake.add_computer("Supergirl", ["linux"])
+        fake.enqueue("linux")
+        jenkins = Jenkins(fake.url, "user", "token", stream_responses=stream)
+        try:
+            assert [agent.name for agent in (await jenkins.fetch_computers()).added] == ["Supergirl"]
+            assert len((await jenkins.update_queue()).added) == 1
+            # The first fetch without labels is a new projection, but nothing changed
+            assert not await jenkins.fetch_computers()
+            bytes_sent = fake.bytes_sent
+            unchanged = UNCHANGED.value(endpoint="queue")
+
+            assert not await jenkins.fetch_computers()
+            assert not await jenkins.update_queue()
+            assert UNCHANGED.value(endpoint="queue") == unchanged + 1
+            # Labeled by route, so the label values do not grow with the agents and jobs
+            assert REQUESTS.value(endpoint="computers", status=200 if not etags else 304) > 0
+            # With ETags, Jenkins did not even send the bodies; without, they are not (all) decoded
+            assert (fake.bytes_sent == bytes_sent) is etags
+
+            # Labels are only requested again when a new agent shows up
+            fake.add_computer("Wonder Woman", ["cuda"])
+            delta = await jenkins.fetch_computers()
+            assert [agent.name for agent in delta.added] == ["Wonder Woman"]
+            assert jenkins.nodes["Wonder Woman"].labels == ["Wonder Woman", "cuda"]
+            fake.computers["Supergirl"]["busyExecutors"] = 1
+            assert [agent.name for agent in (await jenkins.fetch_computers()).changed] == ["Supergirl"]
+            assert fake.requests["/computer/api/json"] == 6
+        finally:
+            await jenkins.close()
+            await fake.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,32 @@
+""" Tests the incremental JSON decoding """
+import asyncio
+import json
+
+from ..jsonstream import iter_array, loads
+import pytest
+
+DOCUMENT = json.dumps(dict(
+    _class="hudson.model.Queue",
+    items=[dict(id=1, why="Waiting for next available executor on ‘linux’", stuck=False),
+           dict(id=22, why='Quotes " and brackets ] [ in a string', stuck=True), 333, "text", [1, 2]],
+    after=dict(items=["ignored"]),
+), ensure_ascii=False, indent=1).encode("utf-8")
+
+
+async def collect(chunks, key="items"):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    return [element async for element in iter_array(stream(), key)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, len(DOCUMENT)])
+def test_iter_array(chunk_size):
+    chunks = [DOCUMENT[start:start + chunk_size] for start in range(0, len(DOCUMENT), chunk_size)]
+    assert asyncio.run(collect(chunks)) == loads(DOCUMENT)["items"]
+
+
+def test_iter_array_truncated():
+    with pytest.raises(ValueError):
+        asyncio.run(collect([DOCUMENT[:60]]))
@@ -0,0 +1,32 @@
+""" Tests the metrics registry """
+from ..metrics import MetricsRegistry
+import pytest
+
+
+def test_histogram_rendering():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("stage_seconds", "Stage timing", ["stage"], buckets=[0.1, 1])
+    histogram.observe(0.05, stage="probe")
+    histogram.observe(0.5, stage="probe")
+    histogram.observe(5, stage="probe")
+
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP stage_seconds Stage timing", "# TYPE stage_seconds histogram"]
+    assert 'stage_seconds_bucket{stage="probe",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="probe",le="1.0"} 2' in lines
+    assert 'stage_seconds_bucket{stage="probe",le="+Inf"} 3' in lines
+    assert 'stage_seconds_sum{stage="probe"} 5.55' in lines
+    assert 'stage_seconds_count{stage="probe"} 3' in lines
+
+
+def test_counter_labels_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests", ["endpoint"]).inc(endpoint='a"b')
+    assert 'requests_total{endpoint="a\\"b"} 1.0' in registry.render().splitlines()
+
+
+def test_reregistering_returns_existing_metric():
+    registry = MetricsRegistry()
+    assert registry.counter("c", "doc") is registry.counter("c", "doc")
+    with pytest.raises(ValueError):
+        registry.histogram("c", "doc")
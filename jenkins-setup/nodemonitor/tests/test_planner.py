@@ -0,0 +1,138 @@
+""" Tests the wake planner """
+import datetime
+
+from ..jenkins import QueuedJob
+from ..nodes import AgentStatus, JenkinsAgent, Node
+from ..planner import label_matches, plan_wakeups
+from ..registry import NodeRegistry
+import pytest
+
+SINCE = datetime.datetime(2021, 1, 1)
+
+
+def make_agent(registry, name, labels, num_executors=2, busy_executors=0):
+    agent = JenkinsAgent(name, labels + [name], AgentStatus.Online, num_executors, busy_executors)
+    registry.register_agent(agent)
+    return agent
+
+
+def waiting_for(label, job_id=1):
+    return QueuedJob(job_id, False, f"Waiting for next available executor on ‘{label}’", SINCE)
+
+
+@pytest.fixture
+def fleet():
+    supergirl = Node("Supergirl", "10.0.0.1", "00:00:00:00:00:01", aliases=["Supergirl-cuda"])
+    wonder_woman = Node("Wonder Woman", "10.0.0.2", "00:00:00:00:00:02", aliases=["Wonder Woman-cuda"])
+    registry = NodeRegistry([supergirl, wonder_woman])
+    make_agent(registry, "Supergirl", ["linux"])
+    make_agent(registry, "Supergirl-cuda", ["cuda"], num_executors=1)
+    make_agent(registry, "Wonder Woman", ["linux"])
+    make_agent(registry, "Wonder Woman-cuda", ["cuda"], num_executors=1)
+    make_agent(registry, "Batman", ["linux"])
+    return supergirl, wonder_woman, registry
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("linux", True),
+        ("cuda", False),
+        ("linux&&docker", True),
+        ("linux && cuda", False),
+        ("cuda||docker", True),
+        ("linux&&!cuda", True),
+        ("!(linux||cuda)", False),
+    ],
+)
+def test_label_matches(expression, expected):
+    assert label_matches(expression, ["linux", "docker"]) is expected
+
+
+def test_regex_handles_dashed_agent_names():
+    assert waiting_for("Wonder Woman-cuda").waiting_for == dict(label="Wonder Woman-cuda")
+
+
+def test_nothing_to_wake_when_running_nodes_have_capacity(fleet):
+    supergirl, wonder_woman, registry = fleet
+    availability = {supergirl: True, wonder_woman: False}
+    queue = [waiting_for("linux", 1), waiting_for("linux", 2)]
+    assert plan_wakeups(queue, registry, availability, []) == []
+
+
+def test_wakes_minimal_set_in_priority_order(fleet):
+    supergirl, wonder_woman, registry = fleet
+    availability = {supergirl: False, wonder_woman: False}
+    queue = [waiting_for("cuda")]
+    assert plan_wakeups(queue, registry, availability, ["Wonder Woman", "Supergirl"]) == [wonder_woman]
+    assert plan_wakeups(queue, registry, availability, ["Supergirl-cuda"]) == [supergirl]
+
+
+def test_counts_executors_when_covering_demand(fleet):
+    supergirl, wonder_woman, registry = fleet
+    availability = {supergirl: False, wonder_woman: False}
+    queue = [waiting_for("cuda", job_id) for job_id in range(2)]
+    assert plan_wakeups(queue, registry, availability, ["Supergirl"]) == [supergirl, wonder_woman]
+
+
+def test_specific_agent_wakes_its_node(fleet):
+    supergirl, wonder_woman, registry = fleet
+    availability = {supergirl: True, wonder_woman: False}
+    queue = [waiting_for("Wonder Woman")]
+    assert plan_wakeups(queue, registry, availability, ["Supergirl"]) == [wonder_woman]
+
+
+def test_node_capacity_limits_aliased_agents(fleet):
+    supergirl, wonder_woman, registry = fleet
+    supergirl.capacity = 2
+    availability = {supergirl: False, wonder_woman: False}
+    queue = [waiting_for("linux||cuda", job_id) for job_id in range(3)]
+    assert plan_wakeups(queue, registry, availability, ["Supergirl"]) == [supergirl, wonder_woman]
+
+
+@pytest.fixture
+def mixed_fleet():
+    """ Two small CPU boxes, a big CPU box and a big CUDA box with a CPU agent on the side """
+    nodes = [
+        Node("small1", "10.0.0.1", "00:00:00:00:00:01", power=60, boot_time=30),
+        Node("small2", "10.0.0.2", "00:00:00:00:00:02", power=60, boot_time=30),
+        Node("big", "10.0.0.3", "00:00:00:00:00:03", power=300, boot_time=120),
+        Node("gpu", "10.0.0.4", "00:00:00:00:00:04", aliases=["gpu-cuda"], power=500, boot_time=45),
+    ]
+    registry = NodeRegistry(nodes)
+    make_agent(registry, "small1", ["linux"], num_executors=1)
+    make_agent(registry, "small2", ["linux"], num_executors=1)
+    make_agent(registry, "big", ["linux"], num_executors=4)
+    make_agent(registry, "gpu", ["linux"], num_executors=3)
+    make_agent(registry, "gpu-cuda", ["cuda"], num_executors=1)
+    return nodes, registry
+
+
+def test_wake_policies(mixed_fleet):
+    nodes, registry = mixed_fleet
+    small1, small2, big, gpu = nodes
+    availability = {node: False for node in nodes}
+    priority = ["gpu", "big", "small1", "small2"]
+    queue = [waiting_for("linux", job_id) for job_id in range(2)]
+    # One node by priority, the two cheapest ones by watts, and the quickest boots to drain
+    assert plan_wakeups(queue, registry, availability, priority) == [gpu]
+    assert plan_wakeups(queue, registry, availability, priority, policy="power") == [small1, small2]
+    assert plan_wakeups(queue, registry, availability, priority, policy="drain") == [small1, small2]
+
+    # Four jobs fit on the big box for the least power. Draining is fastest without waiting for it
+    queue = [waiting_for("linux", job_id) for job_id in range(4)]
+    assert plan_wakeups(queue, registry, availability, priority, policy="power") == [big]
+    assert plan_wakeups(queue, registry, availability, priority, policy="drain") == [gpu, small1]
+    # Learned boot times replace the configured ones
+    boot_times = {small1: 30, small2: 30, big: 20, gpu: 200}
+    assert plan_wakeups(queue, registry, availability, priority, policy="drain", boot_time=boot_times.get) == [big]
+
+    # The CUDA job can only go to the GPU box, whose CPU agent then takes the others too
+    queue = [waiting_for("cuda")] + [waiting_for("linux", job_id) for job_id in range(2, 5)]
+    assert plan_wakeups(queue, registry, availability, priority, policy="power") == [gpu]
+    # Nothing can run more than the fleet has
+    queue = [waiting_for("cuda", job_id) for job_id in range(2)]
+    assert plan_wakeups(queue, registry, availability, priority, policy="drain") == [gpu]
+
+    with pytest.raises(ValueError):
+        plan_wakeups(queue, registry, availability, priority, policy="cheapest")
@@ -0,0 +1,147 @@
+""" Tests the power backends against a local stand-in BMC """
+import asyncio
+import time
+
+import asyncssh
+import pytest
+
+from ..benchmark import FakeBMC, FakeNode
+from ..benchmark.fakes import _free_port
+from ..nodes import Node, SSHConfig
+from ..power import (IPMIPower, PDUPower, PowerBackend, PowerError, PowerState, RedfishPower, WakeOnLanPower,
+                     create_power_backend)
+from ..probe import PROBER
+from ..wol import WakeOnLan
+
+SSH_CONFIG = SSHConfig("user", "password")
+
+
+async def start_bmc():
+    fake_node = FakeNode("Supergirl", _free_port(), asyncssh.generate_private_key("ssh-ed25519"), down_mode="refuse")
+    await fake_node.power_off()
+    bmc = FakeBMC(fake_node, password="secret", boot_time=0.2)
+    await bmc.start()
+    return fake_node, bmc
+
+
+def make_node(fake_node: FakeNode, backend) -> Node:
+    backend.poll_interval = 0.05
+    backend.confirm_timeout = 2
+    backend.shutdown_timeout = 0.5
+    return Node(fake_node.name, "127.0.0.1", "2C:F0:5D:27:5E:AA", port=fake_node.port, power_backend=backend)
+
+
+def test_redfish():
+
+    async def run():
+        fake_node, bmc = await start_bmc()
+        node = make_node(fake_node, RedfishPower(bmc.url, "admin", "secret"))
+        try:
+            assert await node.power_state() is PowerState.Off
+            start = time.perf_counter()
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+            assert time.perf_counter() - start < 2
+            assert fake_node.is_up and await node.power_state() is PowerState.On
+
+            assert await node.shutdown(SSH_CONFIG, force=True)
+            assert await node.power_state() is PowerState.Off
+            assert bmc.resets == ["On", "GracefulShutdown"]
+
+            # A node that has power but never comes up is power cycled
+            bmc.hang_on_boot = True
+            assert await node.wakeup(WakeOnLan(), timeout=0.5)
+            assert bmc.resets[2:] == ["On", "ForceRestart"] and fake_node.is_up
+
+            with pytest.raises(PowerError):
+                await RedfishPower(bmc.url, "admin", "wrong").power_on(node, WakeOnLan())
+            assert await RedfishPower(bmc.url, "admin", "wrong").power_state(node) is None
+        finally:
+            node.ssh.close()
+            await fake_node.close()
+            await bmc.stop()
+
+    asyncio.run(run())
+
+
+def test_ipmi(tmp_path):
+
+    async def run():
+        fake_node, bmc = await start_bmc()
+        backend = IPMIPower("127.0.0.1", "admin", "secret", command=str(bmc.write_ipmitool(tmp_path)))
+        node = make_node(fake_node, backend)
+        try:
+            assert await node.power_state() is PowerState.Off
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+
+            # A node that hangs while shutting down is forced off
+            bmc.hang_on_shutdown = True
+            assert await node.shutdown(SSH_CONFIG, force=True)
+            assert await node.power_state() is PowerState.On
+            await asyncio.sleep(1)
+            assert await node.power_state() is PowerState.Off
+            assert bmc.resets == ["On", "GracefulShutdown", "ForceOff"]
+
+            with pytest.raises(PowerError):
+                await IPMIPower("127.0.0.1", "admin", "wrong", command=backend.command).power_on(node, WakeOnLan())
+        finally:
+            node.ssh.close()
+            await fake_node.close()
+            await bmc.stop()
+
+    asyncio.run(run())
+
+
+def test_pdu(tmp_path):
+
+    async def run():
+        fake_node, bmc = await start_bmc()
+        snmpget, snmpset = bmc.write_snmp(tmp_path)
+        node = make_node(fake_node, PDUPower("127.0.0.1", 4, "secret", snmpget=str(snmpget), snmpset=str(snmpset)))
+        try:
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+            assert await node.power_state() is PowerState.On
+            # Shut down over SSH, then the outlet is switched off
+            assert await node.shutdown(SSH_CONFIG, force=True)
+            await asyncio.sleep(0.3)
+            assert not fake_node.is_up
+            assert bmc.resets == ["On"]
+
+            # An outlet that is on while the node is known to be down is cycled to boot it
+            bmc.hang_on_boot = True
+            await RedfishPower(bmc.url, "admin", "secret").power_on(node, WakeOnLan())
+            await asyncio.sleep(0.3)
+            assert await node.power_state() is PowerState.On and not fake_node.is_up
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+            assert bmc.resets[1:] == ["On", "ForceRestart"]
+
+            # But not while the node is up, or was up a moment ago (it is rebooting, and only slow)
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+            assert len(bmc.resets) == 3
+            await fake_node.power_off()
+            PROBER.clear()
+            await RedfishPower(bmc.url, "admin", "secret").power_on(node, WakeOnLan())
+            assert await node.wakeup(WakeOnLan(), timeout=2)
+            assert bmc.resets[3:] == ["On", "On"]
+        finally:
+            node.ssh.close()
+            await fake_node.close()
+            await bmc.stop()
+
+    asyncio.run(run())
+
+
+def test_create_power_backend():
+    assert create_power_backend() == WakeOnLanPower() != create_power_backend("ipmi", bmc="10.0.0.9",
+                                                                            bmc_username="admin", bmc_password="x")
+    with pytest.raises(TypeError):
+        PowerBackend()
+    assert create_power_backend("redfish", bmc="10.0.0.9", bmc_username="admin", bmc_password="secret") \
+        == RedfishPower("https://10.0.0.9", "admin", "secret")
+    backend = create_power_backend("ipmi", bmc="10.0.0.9", bmc_username="admin", bmc_password="secret")
+    assert backend == IPMIPower("10.0.0.9", "admin", "secret") != IPMIPower("10.0.0.9", "admin", "other")
+    assert "secret" not in repr(backend)
+    assert create_power_backend("pdu", pdu="10.0.0.10", pdu_outlet=4, pdu_community="private").outlet == 4
+    with pytest.raises(ValueError):
+        create_power_backend("ipmi", bmc="10.0.0.9")
+    with pytest.raises(ValueError):
+        create_power_backend("smoke-signals")
@@ -0,0 +1,141 @@
+""" Tests the history store and the load predictor """
+import datetime
+import time
+
+from ..history import HistoryStore
+from ..nodes import AgentStatus, JenkinsAgent, Node
+from ..predictor import LoadPredictor, hour_of_week
+from ..registry import NodeRegistry
+import pytest
+
+# A Monday, 09:00 local time
+MONDAY_9AM = time.mktime(datetime.datetime(2021, 1, 4, 9).timetuple())
+WEEK = 7 * 24 * 3600
+
+
+@pytest.fixture
+def fleet():
+    supergirl = Node("Supergirl", "10.0.0.1", "00:00:00:00:00:01", aliases=["Supergirl-cuda"])
+    wonder_woman = Node("Wonder Woman", "10.0.0.2", "00:00:00:00:00:02")
+    green_arrow = Node("Green Arrow", "10.0.0.3", "00:00:00:00:00:03")
+    registry = NodeRegistry([supergirl, wonder_woman, green_arrow])
+    for name in ("Supergirl", "Supergirl-cuda", "Wonder Woman", "Green Arrow"):
+        registry.register_agent(JenkinsAgent(name, [name], AgentStatus.Online, 2, 0))
+    return supergirl, wonder_woman, green_arrow, registry
+
+
+def busy_mondays(history: HistoryStore, weeks: int, jobs_per_hour: int):
+    """ Jobs every Monday from 9 to 10, for the given number of weeks before MONDAY_9AM """
+    for week in range(1, weeks + 1):
+        for job in range(jobs_per_hour):
+            history.record_arrival(MONDAY_9AM - week * WEEK + job * 3600 / jobs_per_hour)
+
+
+def test_hourly_rates():
+    history = HistoryStore()
+    busy_mondays(history, weeks=4, jobs_per_hour=6)
+    predictor = LoadPredictor(history)
+
+    rates = predictor.hourly_rates(MONDAY_9AM)
+    assert hour_of_week(MONDAY_9AM) == 9
+    assert rates[9] == pytest.approx(6, rel=0.01)
+    assert sum(rates) == pytest.approx(rates[9])
+    # Half an hour before, only the half hour from 9:00 counts
+    assert predictor.expected_arrivals(MONDAY_9AM - 1800, 3600) == pytest.approx(3, rel=0.01)
+    assert predictor.expected_arrivals(MONDAY_9AM + 3600, 3600) == pytest.approx(0)
+
+
+def test_prewarm_before_working_hours(fleet):
+    supergirl, wonder_woman, green_arrow, registry = fleet
+    history = HistoryStore()
+    busy_mondays(history, weeks=3, jobs_per_hour=20)
+    predictor = LoadPredictor(history, lead_time=1800, max_prewarm_nodes=2)
+    availability = {supergirl: False, wonder_woman: False, green_arrow: False}
+
+    # 5 jobs expected in the 15 minutes after 9:00: Green Arrow (2 executors) is not enough
+    assert predictor.nodes_to_prewarm(registry, availability, ["Green Arrow", "Supergirl"],
+                                      now=MONDAY_9AM - 900) == [green_arrow, supergirl]
+    # With Supergirl already up, one more node covers it
+    availability[supergirl] = True
+    assert predictor.nodes_to_prewarm(registry, availability, [], now=MONDAY_9AM - 900) == [green_arrow]
+    # Nothing is expected overnight
+    availability[supergirl] = False
+    assert predictor.nodes_to_prewarm(registry, availability, [], now=MONDAY_9AM - 6 * 3600) == []
+
+
+def test_keep_warm_what_would_be_prewarmed(fleet):
+    supergirl, wonder_woman, green_arrow, registry = fleet
+    history = HistoryStore()
+    busy_mondays(history, weeks=3, jobs_per_hour=20)
+    predictor = LoadPredictor(history, lead_time=1800, max_prewarm_nodes=2)
+    availability = {supergirl: True, wonder_woman: True, green_arrow: False}
+
+    # Supergirl's 4 executors cover the 5 jobs expected after 9:00 only along with Wonder Woman's
+    assert predictor.nodes_to_keep_warm(registry, availability, ["Supergirl"],
+                                        now=MONDAY_9AM - 900) == [supergirl, wonder_woman]
+    assert predictor.nodes_to_prewarm(registry, availability, ["Supergirl"], now=MONDAY_9AM - 900) == []
+    # 2.5 jobs are covered by Supergirl alone
+    assert predictor.nodes_to_keep_warm(registry, availability, ["Supergirl"],
+                                        now=MONDAY_9AM - 1350) == [supergirl]
+    # Nothing is expected overnight, so every idle node may shut down
+    assert predictor.nodes_to_keep_warm(registry, availability, [], now=MONDAY_9AM - 6 * 3600) == []
+
+
+def test_shutdown_threshold(fleet):
+    supergirl, wonder_woman, _, _ = fleet
+    history = HistoryStore()
+    busy_mondays(history, weeks=2, jobs_per_hour=10)
+    for gap in (60, 90, 120, 150, 200, 240, 10000):
+        history.record_idle_gap("Supergirl", gap)
+    history.record_boot("Supergirl", 30)
+    predictor = LoadPredictor(history)
+
+    # Not enough history for Wonder Woman
+    assert predictor.shutdown_threshold(wonder_woman, 300, now=MONDAY_9AM) == 300
+    # Overnight, Supergirl shuts down after its usual gap (but never sooner than two boots)
+    assert predictor.shutdown_threshold(supergirl, 300, now=MONDAY_9AM - 6 * 3600) == 240
+    history.record_boot("Supergirl", 600)
+    assert predictor.shutdown_threshold(supergirl, 300, now=MONDAY_9AM - 6 * 3600) == 300
+    # Ahead of expected load, never sooner than the default
+    assert predictor.shutdown_threshold(supergirl, 1000, now=MONDAY_9AM - 1800) == 1000
+
+
+def test_history_persists(tmp_path):
+    path = tmp_path / "history.jsonl"
+    history = HistoryStore(path, max_arrivals=3)
+    for arrival in range(5):
+        history.record_arrival(float(arrival))
+    history.record_boot("Supergirl", 42.0)
+    history.observe_node("Supergirl", busy=False, when=100.0)
+    history.observe_node("Supergirl", busy=False, when=150.0)
+    history.observe_node("Supergirl", busy=True, when=400.0)
+    history.close()
+
+    reloaded = HistoryStore(path, max_arrivals=3)
+    assert list(reloaded.arrivals) == [2.0, 3.0, 4.0]
+    assert list(reloaded.boots["Supergirl"]) == [42.0]
+    assert list(reloaded.idle_gaps["Supergirl"]) == [300.0]
+    # The file was compacted to what is kept
+    assert len(path.read_text().splitlines()) == 5
+
+
+def test_idle_gaps_only_cover_uptime():
+    history = HistoryStore()
+    history.observe_node("Supergirl", busy=False, when=100.0)
+    # Shut down for the night, then booted, and the first job lands a little later
+    history.observe_node_down("Supergirl")
+    history.observe_node("Supergirl", busy=False, when=50000.0)
+    history.observe_node("Supergirl", busy=True, when=50120.0)
+    assert list(history.idle_gaps["Supergirl"]) == [120.0]
+
+
+def test_boot_time(fleet):
+    supergirl, wonder_woman, _, _ = fleet
+    history = HistoryStore()
+    predictor = LoadPredictor(history, default_boot_time=60)
+    wonder_woman.boot_time = 90
+    # The configured boot time, then the default, until boots are recorded
+    assert predictor.boot_time(wonder_woman) == 90
+    assert predictor.boot_time(supergirl) == 60
+    history.record_boot(wonder_woman.name, 40)
+    assert predictor.boot_time(wonder_woman) == 40
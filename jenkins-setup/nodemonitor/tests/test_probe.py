@@ -0,0 +1,101 @@
+""" Tests probing nodes with raw sockets, and the up/down hysteresis """
+import asyncio
+import socket
+import time
+
+import asyncssh
+
+from ..benchmark import FakeNode
+from ..benchmark.fakes import _free_port
+from ..nodes import Node, probe_nodes
+from ..probe import PROBER, Prober, ReachabilityHistory
+
+
+def test_prober():
+
+    async def run():
+        host_key = asyncssh.generate_private_key("ssh-ed25519")
+        up = FakeNode("up", _free_port(), host_key)
+        blackholes = [FakeNode(f"off{i}", _free_port(), host_key, down_mode="blackhole") for i in range(5)]
+        await up.power_on()
+        for node in blackholes:
+            await node.power_off()
+        refused = [_free_port() for _ in range(300)]
+        prober = Prober(timeout=0.5, ttl=2)
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(prober.probe("127.0.0.1", up.port),
+                                           *[prober.probe("127.0.0.1", node.port) for node in blackholes],
+                                           *[prober.probe("127.0.0.1", port) for port in refused])
+            # The connections that never answer share one deadline
+            assert 0.5 <= time.perf_counter() - start < 1
+            assert [reachable for _, reachable in results[:6]] == [True] + [False] * 5
+            assert not any(reachable for _, reachable in results[6:])
+
+            # Cached, unless a fresh probe is asked for
+            start = time.perf_counter()
+            assert await prober.probe("127.0.0.1", blackholes[0].port) == results[1]
+            assert time.perf_counter() - start < 0.1
+            await up.power_off()
+            assert (await prober.probe("127.0.0.1", up.port))[1]
+            assert not (await prober.probe("127.0.0.1", up.port, max_age=0))[1]
+            assert (await prober.probe("localhost", refused[0], max_age=0))[1] is False
+        finally:
+            await up.close()
+            for node in blackholes:
+                await node.close()
+
+    asyncio.run(run())
+
+
+def test_reachability_history():
+    history = ReachabilityHistory(up_after=2, down_after=2)
+    assert history.up is None
+    assert history.observe(True, 1) and history.up
+    # The same probe counted twice is still one probe
+    assert not history.observe(False, 2) and not history.observe(False, 2)
+    assert not history.observe(True, 3) and not history.observe(False, 4)
+    assert history.observe(False, 5) and history.up is False
+    assert not history.observe(True, 6) and history.observe(True, 7) and history.up
+
+
+def test_dropped_probe_keeps_node_times():
+
+    async def run():
+        with socket.socket() as listener:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(8)
+            node = Node("Supergirl", "127.0.0.1", "2C:F0:5D:27:5E:AA", port=listener.getsockname()[1])
+            assert (await probe_nodes([node, node])) == {node: True}
+            woken = node.time_woken
+            assert woken > 0 and node.time_shutdown == 0
+
+            # One lost probe does not make the node count as shut down (and woken again after)
+            node.observe_probe(False)
+            node.observe_probe(True)
+            assert (node.time_woken, node.time_shutdown) == (woken, 0)
+            node.observe_probe(False)
+            node.observe_probe(False)
+            assert node.time_shutdown >= woken and node.reachability.up is False
+            node.observe_probe(True)
+            assert node.time_woken == woken
+
+    asyncio.run(run())
+
+
+def test_probe_nodes_smooths_lost_probes():
+
+    async def run():
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        node = Node("Supergirl", "127.0.0.1", "2C:F0:5D:27:5E:AA", port=listener.getsockname()[1])
+        assert (await probe_nodes([node])) == {node: True}
+        listener.close()
+        # The first probe that fails could have been lost; the second one in a row is believed
+        PROBER.clear()
+        assert (await probe_nodes([node])) == {node: True}
+        PROBER.clear()
+        assert (await probe_nodes([node])) == {node: False}
+
+    asyncio.run(run())
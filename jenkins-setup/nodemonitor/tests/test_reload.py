@@ -0,0 +1,108 @@
+""" Tests reloading the config file while the node monitor runs """
+import asyncio
+import time
+
+import asyncssh
+
+from .. import config as config_module
+from ..config import NodemonitorConfiguration
+from ..encryption import encrypt, make_salt
+from ..globalstate import GlobalState
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import AgentStatus, JenkinsAgent
+from ..registry import NodeRegistry
+from ..reload import ConfigReloader
+import pytest
+
+PASSWORD = "thisisastrongpassword"
+
+
+def write_config(path, num_nodes: int, poll_frequency: int = 30, first_ip: str = "10.0.0.1"):
+    salt = make_salt()
+    key = asyncssh.generate_private_key("ssh-ed25519").export_private_key().decode("utf-8")
+    secrets = [encrypt(secret, PASSWORD, salt=salt) for secret in ("token", "password", key)]
+    sections = [
+        f"[JENKINS]\nurl = http://127.0.0.1:1\nusername = user\ntoken = \"{secrets[0]}\"\n",
+        f"[AGENTS]\nusername = user\npassword = \"{secrets[1]}\"\nprivate_key = \"{secrets[2]}\"\n",
+        f"[SCHEDULER]\npoll_frequency = {poll_frequency}\nnode_priority = node0000\n",
+    ]
+    for i in range(num_nodes):
+        ip = first_ip if i == 0 else f"10.0.{i // 250}.{i % 250 + 2}"
+        sections.append(f"[NODE node{i:04d}]\nip = {ip}\nmac = 00:00:00:00:00:01\naliases = node{i:04d}-cuda\n")
+    path.write_text("\n".join(sections))
+
+
+@pytest.fixture
+def password(monkeypatch):
+    monkeypatch.setattr(config_module, "PASSWORD", PASSWORD)
+
+
+def test_reload(tmp_path, password):
+    path = tmp_path / "config.ini"
+    write_config(path, num_nodes=200)
+    config = NodemonitorConfiguration.parse_configfile(path)
+    assert config.controllers[0].token == "token"
+    nodes = [node_config.create_node() for node_config in config.nodes]
+    jenkins = Jenkins("http://127.0.0.1:1", "user", "token", registry=NodeRegistry(nodes))
+    # An agent Jenkins knows about, but whose node is not in the config yet
+    jenkins.add_agent(JenkinsAgent("node0200-cuda", ["cuda"], AgentStatus.Online, 1, 0))
+    state = GlobalState(
+        jenkins_instance=jenkins,
+        influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+        privileged_ssh_config=config.agent_ssh_config,
+        task_config=config.scheduler_config(),
+        poll_frequency=config.poll_frequency,
+    )
+    reloader = ConfigReloader(path, config)
+    assert not reloader.reload_if_changed(state)
+
+    # Same secrets and key, one more node, a new address for the first one and faster polling
+    text = path.read_text().replace("poll_frequency = 30", "poll_frequency = 10").replace("10.0.0.1\n", "10.9.9.9\n")
+    path.write_text(text + "\n[NODE node0200]\nip = 10.0.1.250\nmac = 00:00:00:00:00:02\naliases = node0200-cuda\n")
+    start = time.perf_counter()
+    assert reloader.reload_if_changed(state)
+    assert time.perf_counter() - start < 0.5
+    assert state.poll_frequency == 10 and state.max_poll_frequency == 40
+    assert state.registry.node("node0000").local_ip_address == "10.9.9.9"
+    assert state.registry.node("node0000").ssh.host == "10.9.9.9"
+    assert state.registry.node_for_agent("node0200-cuda").name == "node0200"
+    assert jenkins.nodes["node0200-cuda"].node is state.registry.node("node0200")
+    # The SSH key was not parsed again, so the cached connections stay valid
+    assert state.privileged_ssh_config.private_key is config.agent_ssh_config.private_key
+
+    # A broken file is ignored
+    path.write_text("[JENKINS]\n")
+    assert not reloader.reload_if_changed(state)
+    assert state.poll_frequency == 10
+
+
+def test_watch_wakes_up_on_request_and_shutdown(tmp_path, password):
+    path = tmp_path / "config.ini"
+    write_config(path, num_nodes=2)
+    config = NodemonitorConfiguration.parse_configfile(path)
+    nodes = [node_config.create_node() for node_config in config.nodes]
+    state = GlobalState(
+        jenkins_instance=Jenkins("http://127.0.0.1:1", "user", "token", registry=NodeRegistry(nodes)),
+        influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+        privileged_ssh_config=config.agent_ssh_config,
+        task_config=config.scheduler_config(),
+        poll_frequency=config.poll_frequency,
+    )
+    reloader = ConfigReloader(path, config, interval=60)
+
+    async def run():
+        state.reset()
+        watch = asyncio.ensure_future(reloader.watch(state))
+        await asyncio.sleep(0.05)
+        path.write_text(path.read_text().replace("poll_frequency = 30", "poll_frequency = 10"))
+        reloader.request(state)
+        await asyncio.sleep(0.05)
+        assert state.poll_frequency == 10
+
+        start = time.perf_counter()
+        state.request_shutdown()
+        await asyncio.wait_for(watch, 1)
+        assert time.perf_counter() - start < 0.5
+
+    asyncio.run(run())
@@ -0,0 +1,181 @@
+""" Tests recording traces and replaying them through the scheduler on a virtual clock """
+import asyncio
+import datetime
+import time
+
+from .. import clock
+from ..benchmark import FakeJenkins
+from ..globalstate import SchedulerConfig
+from ..history import HistoryStore
+from ..jenkins import Jenkins
+from ..nodes import Node
+from ..simulator import Simulation
+from ..trace import TraceRecorder, Workload, read_trace
+import pytest
+
+# A Monday, 08:00 local time
+START = time.mktime(datetime.datetime(2021, 1, 4, 8).timetuple())
+DAY = 24 * 3600
+
+
+def computer(name, labels, busy=0, offline=False, num_executors=2):
+    return dict(displayName=name, offline=offline, numExecutors=num_executors,
+                assignedLabels=[dict(name=label, busyExecutors=busy) for label in [*labels, name]])
+
+
+def record_week(path, days=5):
+    """ Two nodes; every working hour one linux job queues, waits a minute and runs for 20 minutes """
+    recorder = TraceRecorder(path)
+    recorder.record_nodes([Node("cpu", "10.0.0.1", "00:00:00:00:00:01", power=100, boot_time=60),
+                           Node("gpu", "10.0.0.2", "00:00:00:00:00:02", aliases=["gpu-cuda"], power=400)],
+                          when=START)
+    recorder.record_computers("jenkins", [computer("cpu", ["linux"]), computer("gpu", ["linux"], offline=True),
+                                          computer("gpu-cuda", ["cuda"], offline=True, num_executors=1)], when=START)
+    job_id = 0
+    for day in range(days):
+        for hour in range(1, 9):
+            job_id += 1
+            queued = START + day * DAY + hour * 3600
+            item = dict(id=job_id, stuck=False, why="Waiting for next available executor on ‘linux’",
+                        inQueueSince=int(queued * 1000))
+            recorder.record_queue("jenkins", [item], when=queued + 5)
+            recorder.record_queue("jenkins", [], when=queued + 60)
+            recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=1)], when=queued + 60)
+            recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=0)], when=queued + 1260)
+        # A build that started and finished between two polls of the queue, and a cancelled one
+        recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=1)], when=START + day * DAY + 10 * 3600)
+        recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=0)], when=START + day * DAY + 10.5 * 3600)
+        job_id += 1
+        item = dict(id=job_id, stuck=True, why="All nodes of label ‘cuda’ are offline",
+                    inQueueSince=int((START + day * DAY + 11 * 3600) * 1000))
+        recorder.record_queue("jenkins", [item], when=START + day * DAY + 11 * 3600)
+        recorder.record_queue("jenkins", [], when=START + day * DAY + 11 * 3600 + 30)
+    recorder.record_power("gpu", True, when=START + DAY)
+    recorder.record_power("gpu", False, when=START + 2 * DAY)
+    recorder.record("end", "recorder", None, when=START + days * DAY)
+    recorder.close()
+
+
+def record_morning(path, gpu_boot_time, cpu_job_at=None):
+    """ Both nodes off from 08:00 to 11:00, and at most one job, which only the CPU node runs """
+    recorder = TraceRecorder(path)
+    recorder.record_nodes([Node("cpu", "10.0.0.1", "00:00:00:00:00:01", boot_time=60),
+                           Node("gpu", "10.0.0.2", "00:00:00:00:00:02", aliases=["gpu-cuda"],
+                                boot_time=gpu_boot_time)], when=START)
+    recorder.record_computers("jenkins", [computer("cpu", ["linux"], offline=True),
+                                          computer("gpu", ["linux"], offline=True),
+                                          computer("gpu-cuda", ["cuda"], offline=True, num_executors=1)], when=START)
+    if cpu_job_at is not None:
+        queued = START + cpu_job_at
+        item = dict(id=1, stuck=False, why="Waiting for next available executor on ‘cpu’",
+                    inQueueSince=int(queued * 1000))
+        recorder.record_queue("jenkins", [item], when=queued + 5)
+        recorder.record_queue("jenkins", [], when=queued + 60)
+        recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=1)], when=queued + 60)
+        recorder.record_computers("jenkins", [computer("cpu", ["linux"], busy=0)], when=queued + 660)
+    recorder.record("end", "recorder", None, when=START + 3 * 3600)
+    recorder.close()
+
+
+def busy_mondays(weeks=3, jobs_per_hour=6):
+    """ A history of jobs every Monday from 9 to 10 in the weeks before START """
+    history = HistoryStore()
+    for week in range(1, weeks + 1):
+        for job in range(jobs_per_hour):
+            history.record_arrival(START + 3600 - week * 7 * DAY + job * 3600 / jobs_per_hour)
+    return history
+
+
+def test_workload_from_trace(tmp_path):
+    path = tmp_path / "trace.jsonl.gz"
+    record_week(path)
+    workload = Workload.from_trace(read_trace(path))
+    assert workload.start == START and workload.end == START + 5 * DAY
+    assert [node["name"] for node in workload.nodes] == ["cpu", "gpu"]
+    assert len(workload.jobs) == 5 * 9 and workload.skipped == 5
+    queued = [job for job in workload.jobs if job.id > 0]
+    assert {job.duration for job in queued} == {1200}
+    assert [job.why for job in workload.jobs if job.id < 0][0] == "Waiting for next available executor on ‘cpu’"
+    assert workload.initially_on() == ["cpu"]
+    assert workload.recorded_node_hours() == dict(cpu=pytest.approx(5 * 24), gpu=pytest.approx(24))
+
+
+@pytest.mark.parametrize("wake_policy", ["priority", "power"])
+def test_simulation(tmp_path, wake_policy):
+    path = tmp_path / "trace.jsonl"
+    record_week(path)
+    workload = Workload.from_trace(read_trace(path))
+
+    reports = dict()
+    wall_clock = time.perf_counter()
+    for idle_time in (300, 4 * 3600):
+        config = SchedulerConfig(0, idle_time, ["gpu", "cpu"], wake_policy=wake_policy)
+        reports[idle_time] = Simulation(workload, config, poll_frequency=30).run()
+    # Five simulated days, twice, in a few seconds at most
+    assert time.perf_counter() - wall_clock < 10
+    assert clock.now() == pytest.approx(time.time(), abs=5)
+
+    eager, lazy = reports[300], reports[4 * 3600]
+    for report in reports.values():
+        assert report.finished == report.jobs == 45 and report.interrupted == 0
+        assert report.hours == pytest.approx(5 * 24, abs=0.1)
+        assert report.recorded_node_hours == pytest.approx(6 * 24)
+    # Shutting down quickly boots for nearly every job and waits for the boots, but saves energy
+    assert eager.boots > lazy.boots >= 1
+    assert eager.node_hours < lazy.node_hours < eager.recorded_node_hours
+    assert eager.wait(0.5) > lazy.wait(0.5)
+    # The cheaper CPU node covers the linux jobs when watts count
+    assert (eager.energy_kwh < eager.node_hours * 0.2) == (wake_policy == "power")
+    assert "kWh" in str(eager)
+
+
+def test_recorder_skips_unchanged_responses(tmp_path):
+
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fake_jenkins.add_computer("cpu", ["linux"])
+        jenkins = Jenkins(fake_jenkins.url, "user", "token")
+        jenkins.recorder = TraceRecorder(tmp_path / "trace.jsonl")
+        try:
+            for _ in range(3):
+                await jenkins.update_queue()
+                await jenkins.fetch_computers()
+            fake_jenkins.enqueue("linux")
+            await jenkins.update_queue()
+            await jenkins.fetch_computers()
+        finally:
+            jenkins.recorder.close()
+            await jenkins.close()
+            await fake_jenkins.stop()
+
+    asyncio.run(run())
+    events = list(read_trace(tmp_path / "trace.jsonl"))
+    assert [event["kind"] for event in events] == ["queue", "computers", "queue"]
+    assert "linux" in [label["name"] for label in events[1]["data"][0]["assignedLabels"]]
+    assert events[2]["data"][0]["why"].startswith("Waiting for next available executor")
+
+
+def test_prewarm_boots_do_not_hold_up_queued_jobs(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    # The GPU node is pre-warmed for 9:00 but takes 20 minutes to boot; a CPU job queues meanwhile
+    record_morning(path, gpu_boot_time=1200, cpu_job_at=3000)
+    workload = Workload.from_trace(read_trace(path))
+    config = SchedulerConfig(0, 300, ["gpu", "cpu"], boot_timeout=1800)
+    report = Simulation(workload, config, poll_frequency=30, history=busy_mondays()).run()
+    assert report.finished == report.jobs == 1
+    assert report.boots == 2
+    # The CPU node boots right away instead of after the GPU node is up
+    assert report.wait(1) < 300
+
+
+def test_prewarmed_nodes_stay_up_for_the_expected_jobs(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    # Pre-warmed for 9:00, idle past idle_time_before_shutdown, and no job after all
+    record_morning(path, gpu_boot_time=60)
+    workload = Workload.from_trace(read_trace(path))
+    config = SchedulerConfig(0, 300, ["gpu", "cpu"])
+    report = Simulation(workload, config, poll_frequency=30, history=busy_mondays()).run()
+    # Booted once, not shut down and pre-warmed again every few minutes, and off once the busy hour is over
+    assert report.boots == 1
+    assert report.node_hours < 1.5
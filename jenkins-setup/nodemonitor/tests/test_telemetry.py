@@ -0,0 +1,108 @@
+""" Tests the node telemetry probe and what it considers busy """
+import asyncio
+import time
+
+from .. import tasks
+from ..benchmark import FakeFleet, FakeJenkins
+from ..globalstate import GlobalState, SchedulerConfig
+from ..influx import InfluxWriter
+from ..jenkins import Jenkins
+from ..nodes import SSHConfig
+from ..telemetry import MAINTENANCE_TOKEN, BusyPolicy, NodeTelemetry
+import pytest
+
+OUTPUT = """@users
+jenkins jason
+@loadavg
+0.52 0.40 0.30 2/345 6789
+@cpu
+cpu  100 0 50 800 50 0 0 0 0 0
+@containers
+node-exporter
+build-cache
+@gpu
+@maintenance
+"""
+
+
+def test_parse():
+    previous = NodeTelemetry(time=0, cpu_times=(100, 900))
+    telemetry = NodeTelemetry.parse(OUTPUT, when=30, previous=previous)
+    assert telemetry.users == ["jenkins", "jason"]
+    assert telemetry.load_average == (0.52, 0.40, 0.30)
+    assert telemetry.cpu_times == (150, 1000)
+    assert telemetry.cpu_utilization == pytest.approx(0.5)
+    assert telemetry.containers == ["node-exporter", "build-cache"]
+    assert telemetry.gpu_processes == []
+    assert telemetry.maintenance_until is None
+    assert telemetry.fields() == dict(users=2, containers=2, gpu_processes=0, maintenance=False, load1=0.52,
+                                      load5=0.40, load15=0.30, cpu_utilization=pytest.approx(0.5))
+    # Without docker, nvidia-smi or a previous snapshot, those parts are just missing
+    telemetry = NodeTelemetry.parse("@users\n@loadavg\n0.00 0.00 0.00 1/1 1\n", when=30)
+    assert telemetry.users == [] and telemetry.cpu_utilization is None
+
+
+def test_busy_policy():
+    policy = BusyPolicy(ignored_containers=("node-exporter*",), max_cpu_utilization=0.6)
+    telemetry = NodeTelemetry.parse(OUTPUT, when=30, previous=NodeTelemetry(time=0, cpu_times=(100, 900)))
+    assert policy.reasons(telemetry) == ["logged in: jason", "containers running: build-cache"]
+
+    telemetry.users, telemetry.containers = ["jenkins"], ["node-exporter-1"]
+    assert policy.reasons(telemetry) == []
+    telemetry.load_average = (3.5, 1, 1)
+    telemetry.gpu_processes = ["1234, python"]
+    assert policy.reasons(telemetry) == ["GPU processes running: 1234, python", "load average 3.50"]
+
+    telemetry = NodeTelemetry.parse(f"@maintenance\n{MAINTENANCE_TOKEN} {time.time() + 60:.0f}\n", time.time())
+    assert policy.reasons(telemetry)[0].startswith("under maintenance")
+
+
+def test_shutdown_uses_the_cycle_telemetry():
+
+    async def run():
+        fake_jenkins = FakeJenkins()
+        await fake_jenkins.start()
+        fleet = FakeFleet(4, fake_jenkins, up_fraction=1, down_mode="refuse")
+        await fleet.start()
+        busy_node, idle_node = fleet.nodes
+        busy_node.containers = ["build-cache"]
+        idle_node.cpu_ticks = [100, 0, 0, 900, 0, 0, 0, 0]
+        registry = fleet.registry()
+        state = GlobalState(
+            jenkins_instance=Jenkins(fake_jenkins.url, "user", "token", registry=registry),
+            influx_writer=InfluxWriter("http://127.0.0.1:1", "db", "user", "password"),
+            privileged_ssh_config=SSHConfig("user", "password"),
+            task_config=SchedulerConfig(0, 0, []),
+            poll_frequency=30,
+        )
+        try:
+            await state.initialize()
+            availability = {node: True for node in registry}
+            await tasks._collect_telemetry(state, availability)
+            assert state.influx_writer.buffered_points == 2
+            # Everything the node monitor needs comes from one command per node
+            assert [len(node.commands) for node in fleet.nodes] == [1, 1]
+
+            # The idle node's CPUs were busy since the last snapshot
+            idle_node.cpu_ticks = [190, 0, 0, 910, 0, 0, 0, 0]
+            await tasks._collect_telemetry(state, availability)
+            assert registry.node(idle_node.name).telemetry.cpu_utilization == pytest.approx(0.9)
+            for node in registry:
+                node.time_woken = 1
+            await tasks._shutdown_idle_agents(state, availability)
+            assert busy_node.is_up and idle_node.is_up
+            assert [len(node.commands) for node in fleet.nodes] == [2, 2]
+
+            idle_node.cpu_ticks = [190, 0, 0, 1910, 0, 0, 0, 0]
+            await tasks._collect_telemetry(state, availability)
+            await tasks._shutdown_idle_agents(state, availability)
+            assert idle_node.commands[-1] == "sudo shutdown now"
+            assert busy_node.commands[-1] != "sudo shutdown now"
+        finally:
+            for node in registry:
+                node.ssh.close()
+            await state.close()
+            await fleet.stop()
+            await fake_jenkins.stop()
+
+    asyncio.run(run())
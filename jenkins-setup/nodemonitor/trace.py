@@ -0,0 +1,265 @@
+""" Records what the node monitor sees, and turns a recording back into a workload to simulate
+
+A trace is a JSON-lines file (gzipped if its name ends in .gz) of events, each
+{"t": <seconds since the epoch>, "kind": ..., "source": ..., "data": ...}:
+
+- nodes: the configured nodes (name, aliases, capacity, power and boot_time), on startup
+- queue: the items of a controller's queue, whenever the response changed
+- computers: a controller's computers, whenever the response changed
+- power: a node being powered on (1) or told to shut down (0)
+
+Responses that did not change since the last poll are not recorded, so a quiet week costs a few
+kilobytes. Workload.from_trace replays the queue and computers events to recover when each job
+was queued, what it waited for and how long it ran: a job that left the queue is paired with the
+next matching agent whose busy executors went up, and it ran until that agent's count went down
+again (oldest job first). Builds that never showed up in a poll of the queue run as jobs waiting
+for the agent they ran on.
+"""
+import collections
+import datetime
+import gzip
+import json
+import logging
+import pathlib
+from dataclasses import dataclass, field
+from typing import IO, Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from . import clock
+from .jenkins import QueuedJob
+from .nodes import AgentStatus, JenkinsAgent, Node
+from .planner import job_matches
+
+LOGGER = logging.getLogger(__name__)
+
+# A job that left the queue this long before any agent got busier was cancelled, not started
+MAX_START_DELAY = 300
+
+
+def _open(path: pathlib.Path, mode: str) -> IO[str]:
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TraceRecorder:
+
+    def __init__(self, path: Union[str, pathlib.Path], flush_every: int = 50):
+        self.path = pathlib.Path(path)
+        # Events are buffered, and written out every flush_every events and on close
+        self.flush_every = flush_every
+        self._buffer: List[str] = []
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.path}; {len(self._buffer)} buffered events>"
+
+    def record(self, kind: str, source: str, data: Any, when: Optional[float] = None):
+        when = clock.now() if when is None else when
+        self._buffer.append(json.dumps(dict(t=round(when, 3), kind=kind, source=source, data=data),
+                                       separators=(",", ":"), ensure_ascii=False))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def record_nodes(self, nodes: Iterable[Node], when: Optional[float] = None):
+        self.record("nodes", "config", [dict(name=node.name, aliases=list(node.aliases), capacity=node.capacity,
+                                             power=node.power, boot_time=node.boot_time) for node in nodes], when)
+
+    def record_queue(self, controller: str, items: List[Dict[str, Any]], when: Optional[float] = None):
+        self.record("queue", controller, items, when)
+
+    def record_computers(self, controller: str, computers: List[Dict[str, Any]], when: Optional[float] = None):
+        self.record("computers", controller, computers, when)
+
+    def record_power(self, node_name: str, on: bool, when: Optional[float] = None):
+        self.record("power", node_name, int(on), when)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        try:
+            with _open(self.path, "a") as file:
+                file.write("\n".join(self._buffer) + "\n")
+        except OSError as err:
+            LOGGER.error(f"Could not write the trace to {self.path}: {err}")
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def read_trace(path: Union[str, pathlib.Path]) -> Iterator[Dict[str, Any]]:
+    """ The events of a trace, in the order they were recorded """
+    with _open(pathlib.Path(path), "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+@dataclass
+class TraceAgent:
+    controller: str
+    name: str
+    labels: List[str]
+    num_executors: int
+    # Whether the agent was online when the trace starts
+    online: bool = False
+
+
+@dataclass
+class TraceJob:
+    controller: str
+    id: int
+    queued_since: float
+    why: str
+    stuck: bool
+    # Seconds it ran; None until its end is found
+    duration: Optional[float] = None
+    # When it left the queue in the recording
+    started: Optional[float] = None
+
+    def queued_job(self) -> QueuedJob:
+        return QueuedJob(self.id, self.stuck, self.why, datetime.datetime.fromtimestamp(self.queued_since))
+
+
+@dataclass
+class Workload:
+    start: float
+    end: float
+    nodes: List[Dict[str, Any]] = field(default_factory=list)
+    agents: List[TraceAgent] = field(default_factory=list)
+    jobs: List[TraceJob] = field(default_factory=list)
+    # (when, node name, powered on)
+    power_events: List[Tuple[float, str, bool]] = field(default_factory=list)
+    # Jobs that left the queue without running anywhere (cancelled, say)
+    skipped: int = 0
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}; {(self.end - self.start) / 3600:.1f} hours; {len(self.nodes)} nodes; "
+                f"{len(self.agents)} agents; {len(self.jobs)} jobs>")
+
+    @classmethod
+    def from_trace(cls, events: Iterable[Dict[str, Any]]) -> "Workload":
+        builder = _WorkloadBuilder()
+        for event in events:
+            builder.add(event)
+        return builder.finish()
+
+    def initially_on(self) -> List[str]:
+        """ The nodes that had an agent online when the recording started """
+        online = {agent.name for agent in self.agents if agent.online}
+        return [node["name"] for node in self.nodes if online.intersection([node["name"], *node["aliases"]])]
+
+    def recorded_node_hours(self) -> Dict[str, float]:
+        """ Hours each node was on according to the recording """
+        on_since: Dict[str, Optional[float]] = {node["name"]: None for node in self.nodes}
+        for name in self.initially_on():
+            on_since[name] = self.start
+        on_since.update({name: None for _, name, _ in self.power_events if name not in on_since})
+        hours = {name: 0.0 for name in on_since}
+        for when, name, on in self.power_events:
+            if on and on_since[name] is None:
+                on_since[name] = when
+            elif not on and on_since[name] is not None:
+                hours[name] += (when - on_since[name]) / 3600
+                on_since[name] = None
+        for name, since in on_since.items():
+            if since is not None:
+                hours[name] += (self.end - since) / 3600
+        return hours
+
+
+class _WorkloadBuilder:
+
+    def __init__(self):
+        self.start: Optional[float] = None
+        self.end = 0.0
+        self.nodes: List[Dict[str, Any]] = []
+        self.agents: Dict[Tuple[str, str], TraceAgent] = dict()
+        self.jobs: Dict[Tuple[str, int], TraceJob] = dict()
+        self.queued: Dict[str, Dict[int, TraceJob]] = collections.defaultdict(dict)
+        self.busy: Dict[Tuple[str, str], int] = dict()
+        # Jobs that left the queue and have not been seen running yet
+        self.leaving: Dict[str, Deque[TraceJob]] = collections.defaultdict(collections.deque)
+        self.running: Dict[Tuple[str, str], Deque[TraceJob]] = collections.defaultdict(collections.deque)
+        self.power_events: List[Tuple[float, str, bool]] = []
+        self.skipped = 0
+        self._matches: Dict[Tuple[str, str, str], bool] = dict()
+
+    def add(self, event: Dict[str, Any]):
+        when, kind, source, data = event["t"], event["kind"], event["source"], event["data"]
+        self.start = when if self.start is None else self.start
+        self.end = max(self.end, when)
+        if kind == "nodes":
+            self.nodes = data
+        elif kind == "queue":
+            self._queue(source, data, when)
+        elif kind == "computers":
+            self._computers(source, data, when)
+        elif kind == "power":
+            self.power_events.append((when, source, bool(data)))
+
+    def _queue(self, controller: str, items: List[Dict[str, Any]], when: float):
+        queued = dict()
+        for item in items:
+            job = self.queued[controller].get(item["id"])
+            if job is None:
+                job = TraceJob(controller, item["id"], item["inQueueSince"] / 1000, item["why"], item["stuck"])
+                self.jobs[(controller, job.id)] = job
+            queued[job.id] = job
+        for job_id, job in self.queued[controller].items():
+            if job_id not in queued:
+                job.started = when
+                self.leaving[controller].append(job)
+        self.queued[controller] = queued
+
+    def _computers(self, controller: str, computers: List[Dict[str, Any]], when: float):
+        for computer in computers:
+            name = computer["displayName"]
+            labels = [label["name"] for label in computer["assignedLabels"] if "name" in label]
+            agent = self.agents.get((controller, name))
+            if agent is None:
+                agent = self.agents[(controller, name)] = TraceAgent(
+                    controller, name, labels, computer["numExecutors"], online=not computer["offline"])
+            agent.num_executors = computer["numExecutors"]
+            busy = computer["assignedLabels"][0]["busyExecutors"] if computer["assignedLabels"] else 0
+            change = busy - self.busy.get((controller, name), busy)
+            self.busy[(controller, name)] = busy
+            for _ in range(max(change, 0)):
+                self.running[(controller, name)].append(self._started_on(agent, when))
+            for _ in range(max(-change, 0)):
+                if self.running[(controller, name)]:
+                    job = self.running[(controller, name)].popleft()
+                    job.duration = when - job.started
+
+    def _started_on(self, agent: TraceAgent, when: float) -> TraceJob:
+        """ The job that just took an executor on agent """
+        leaving = self.leaving[agent.controller]
+        while leaving and leaving[0].started < when - MAX_START_DELAY:
+            leaving.popleft()
+            self.skipped += 1
+        for job in leaving:
+            if self._can_run(job, agent):
+                leaving.remove(job)
+                return job
+        # A build that came and went between two polls of the queue
+        job = TraceJob(agent.controller, -len(self.jobs), when,
+                       f"Waiting for next available executor on ‘{agent.name}’", False, started=when)
+        self.jobs[(agent.controller, job.id)] = job
+        return job
+
+    def _can_run(self, job: TraceJob, agent: TraceAgent) -> bool:
+        key = (job.why, agent.controller, agent.name)
+        if key not in self._matches:
+            self._matches[key] = job_matches(job.queued_job(),
+                                             JenkinsAgent(agent.name, agent.labels, AgentStatus.Online, 0, 0))
+        return self._matches[key]
+
+    def finish(self) -> Workload:
+        for jobs in self.running.values():
+            for job in jobs:
+                job.duration = self.end - job.started
+        self.skipped += sum(len(leaving) for leaving in self.leaving.values())
+        # Jobs still queued when the recording stopped never ran, so there is nothing to replay
+        jobs = sorted((job for job in self.jobs.values() if job.duration is not None),
+                      key=lambda job: job.queued_since)
+        return Workload(start=self.start or 0.0, end=self.end, nodes=self.nodes, agents=list(self.agents.values()),
+                        jobs=jobs, power_events=self.power_events, skipped=self.skipped)
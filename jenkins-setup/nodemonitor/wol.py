@@ -0,0 +1,66 @@
+""" Non-blocking Wake-on-LAN
+
+Magic packets are sent from a single UDP socket on the event loop to the directed broadcast
+address of each node's subnet, and repeated a few times since a lost datagram is never
+retransmitted.
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+from typing import Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+def magic_packet(mac_address: str) -> bytes:
+    """ 6 bytes of 0xFF followed by the MAC address repeated 16 times """
+    digits = "".join(char for char in mac_address if char not in ":-.")
+    if len(digits) != 12:
+        raise ValueError(f"Invalid MAC address: {mac_address}")
+    return b"\xff" * 6 + bytes.fromhex(digits) * 16
+
+
+def broadcast_address(ip_address: str, prefix_length: int = 24) -> str:
+    """ The directed broadcast address of the subnet ip_address is on (e.g., 192.168.1.255) """
+    return str(ipaddress.ip_network(f"{ip_address}/{prefix_length}", strict=False).broadcast_address)
+
+
+class _WakeOnLanProtocol(asyncio.DatagramProtocol):
+
+    def error_received(self, exc: Exception):
+        LOGGER.warning(f"Failed to send a wake-on-lan packet: {exc}")
+
+
+class WakeOnLan:
+    """ Sends magic packets without blocking the event loop """
+
+    def __init__(self, port: int = 9, repeats: int = 3, interval: float = 0.1):
+        self.port = port
+        self.repeats = repeats
+        self.interval = interval
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}; port={self.port}; {self.repeats} packets per wakeup>"
+
+    async def _get_transport(self) -> asyncio.DatagramTransport:
+        if self._transport is None or self._transport.is_closing():
+            self._transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+                _WakeOnLanProtocol, local_addr=("0.0.0.0", 0), family=socket.AF_INET, allow_broadcast=True,
+            )
+        return self._transport
+
+    async def send(self, mac_address: str, broadcast: str = "255.255.255.255"):
+        """ Sends the magic packet for mac_address to broadcast repeats times """
+        packet = magic_packet(mac_address)
+        transport = await self._get_transport()
+        for index in range(self.repeats):
+            if index:
+                await asyncio.sleep(self.interval)
+            transport.sendto(packet, (broadcast, self.port))
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
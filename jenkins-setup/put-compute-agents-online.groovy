@@ -1,17 +1,34 @@
 /**
  * This script will reconnect every compute agent
  */
+import groovy.transform.Field
 import jenkins.model.Jenkins
 
+// Agents that python -m nodemonitor.fleet --when-idle took offline stay offline while it updates
+// (and maybe reboots) their node; it puts them back online itself. Keep in sync with
+// MAINTENANCE_MESSAGE in nodemonitor/fleet.py
+@Field String MAINTENANCE_MESSAGE = 'Under maintenance by nodemonitor.fleet'
+
+Boolean isUnderMaintenance(def computer) {
+    return computer.isTemporarilyOffline() && computer.getOfflineCauseReason() == MAINTENANCE_MESSAGE
+}
+
 // Mark them *not* temporarily offline
 Jenkins.instance.computers.each { computer ->
-    computer.setTemporarilyOffline(false)
+    if (isUnderMaintenance(computer)) {
+        println("INFO: ${computer.nodeName} is under maintenance. Leaving it offline")
+    } else {
+        computer.setTemporarilyOffline(false)
+    }
 }
 
 /* While they are no longer marked offline temporarily, they may be disconnected
  * and require launching the ssh agent. Check that here.
  */
 Jenkins.instance.computers.each { computer ->
+    if (isUnderMaintenance(computer)) {
+        return
+    }
     if (computer.isOffline()) {
         println("INFO: ${computer.nodeName} is offline. Attempting to launch agent")
         if (computer.isLaunchSupported()) {